@@ -1,5 +1,6 @@
 import gzip
 import json
+from array import array
 from collections import Counter, defaultdict
 from copy import deepcopy
 from math import log1p, sqrt
@@ -7,20 +8,26 @@ from statistics import mean, stdev
 from typing import Dict
 
 import joblib
+import numpy as np
 from recsys.data_generator.accumulators_helpers import (
     add_one_nested_key,
-    add_to_set,
     append_to_list,
     append_to_list_not_null,
     diff,
     diff_ts,
     increment_key_by_one,
     increment_keys_by_one,
+    int_defaultdict,
+    list_defaultdict,
     set_key,
     set_nested_key,
     tryint,
+    unknown,
 )
+from recsys.data_generator.compact_state import DenseCounter, Interner, KeyClicks, PackedDict, SortedSums
+from recsys.data_generator.fingerprints import fingerprint
 from recsys.data_generator.jaccard_sim import ItemPriceSim, JaccardItemSim
+from recsys.data_generator.minhash import SIMILARITIES, top_similar_users
 from recsys.log_utils import get_logger
 from recsys.utils import group_time
 
@@ -48,6 +55,181 @@ ACTIONS_WITH_ITEM_REFERENCE = {
 logger = get_logger()
 
 
+def first_item_stats(columns):
+    """
+    Converts the output of get_stats_batch for a single item back to the get_stats format
+    """
+    return {k: values[0] for k, values in columns.items()}
+
+
+def transpose_stats(stats):
+    """
+    Converts a list of get_stats outputs (one per item) to the get_stats_batch format
+    """
+    columns = {}
+    for n, obs in enumerate(stats):
+        for k, v in obs.items():
+            columns.setdefault(k, [None] * n).append(v)
+    return columns
+
+
+class UserItemGraph:
+    """
+    Shared state component: the bipartite graph of the users and the items they interacted with.
+    The users of every item and the items of every user are the keys of dicts, in the order of the first
+    interaction (like in UserItemInteractions), so the ties of the most similar users are broken the same
+    way after a checkpoint is unpickled. item_user_codes are the rows of the sparse item x user incidence matrix:
+    the codes of the users of every item as a growing int32 array (see cooccurrence_counts).
+    """
+
+    name = "user_item_graph"
+
+    def __init__(self):
+        self.action_types = ACTIONS_WITH_ITEM_REFERENCE
+        self.items_users = defaultdict(dict)
+        self.users_items = defaultdict(dict)
+        self.user_codes = Interner()
+        self.item_user_codes = {}
+
+    def update_acc(self, row):
+        if row["user_id"] not in self.items_users[row["reference"]]:
+            self.item_user_codes.setdefault(row["reference"], array("i")).append(self.user_codes.encode(row["user_id"]))
+        self.items_users[row["reference"]][row["user_id"]] = None
+        self.users_items[row["user_id"]][row["reference"]] = None
+
+    def cooccurrence_counts(self, user_id, item_ids, max_item_degree=None):
+        """
+        For every item the number of paths item <- other user -> item of the user (u . A^T . A restricted to
+        the item_ids, without the user itself). The users of the items of the user are counted once with numpy
+        and looked up for the users of every item, so the cost depends on the degrees of these items only.
+        Items of the user with more than max_item_degree users are skipped.
+        """
+        rows = [
+            self.item_user_codes[item_id]
+            for item_id in self.users_items.get(user_id, ())
+            if max_item_degree is None or len(self.item_user_codes[item_id]) <= max_item_degree
+        ]
+        if not rows or not item_ids:
+            return [0] * len(item_ids)
+        # the number of common items of every other user with the user
+        neighbours = np.concatenate([np.frombuffer(row, dtype=np.int32) for row in rows])
+        users, common = np.unique(neighbours, return_counts=True)
+        common[users == self.user_codes.lookup(user_id)] = 0
+        item_rows = [self.item_user_codes.get(item_id, array("i")) for item_id in item_ids]
+        lengths = [len(row) for row in item_rows]
+        item_users = np.concatenate([np.frombuffer(row, dtype=np.int32) for row in item_rows])
+        positions = np.minimum(np.searchsorted(users, item_users), len(users) - 1)
+        paths = np.where(users[positions] == item_users, common[positions], 0)
+        counts = np.bincount(np.repeat(np.arange(len(item_ids)), lengths), weights=paths, minlength=len(item_ids))
+        return counts.astype(np.int64).tolist()
+
+
+class UserItemInteractions:
+    """
+    Shared state component: the items (as ints) the user interacted with, per user and per (user, session).
+    The items are the keys of a dict, in the order of the first interaction. A set of ints can iterate
+    in another order once it is unpickled from a checkpoint.
+    """
+
+    name = "user_item_interactions"
+
+    def __init__(self):
+        self.action_types = ACTIONS_WITH_ITEM_REFERENCE
+        self.by_user = defaultdict(dict)
+        self.by_session = defaultdict(dict)
+
+    def update_acc(self, row):
+        item_id = tryint(row["reference"])
+        self.by_user[row["user_id"]][item_id] = None
+        self.by_session[(row["user_id"], row["session_id"])][item_id] = None
+
+
+class LastUserClickout:
+    """
+    Shared state component: the item the user clicked out last
+    """
+
+    name = "last_user_clickout"
+
+    def __init__(self):
+        self.action_types = ["clickout item"]
+        self.item = {}
+
+    def update_acc(self, row):
+        self.item[row["user_id"]] = row["reference"]
+
+
+class LastItemClickout:
+    """
+    Shared state component: the timestamp and the user of the last clickout of the item
+    """
+
+    name = "last_item_clickout"
+
+    def __init__(self):
+        self.action_types = ["clickout item"]
+        self.timestamp = {}
+        self.user = {}
+
+    def update_acc(self, row):
+        self.timestamp[row["reference"]] = row["timestamp"]
+        self.user[row["reference"]] = row["user_id"]
+
+
+SHARED_COMPONENTS = {
+    component.name: component for component in [UserItemGraph, UserItemInteractions, LastUserClickout, LastItemClickout]
+}
+
+
+class SharedState:
+    """
+    The named state components, the interners of the ids and the loaded artifacts shared by the accumulators
+    of one get_accumulators call.
+
+    An accumulator reading a component lists the attributes holding it in components. The components are not
+    part of the state of the accumulator, group_accumulators adds them in front of the accumulators,
+    so every component is updated once per event no matter how many accumulators read it.
+    """
+
+    def __init__(self):
+        self.components = {}
+        self.interners = {}
+        self.artifacts = {}
+
+    def get(self, name):
+        if name not in self.components:
+            self.components[name] = SHARED_COMPONENTS[name]()
+        return self.components[name]
+
+    def interner(self, name):
+        if name not in self.interners:
+            self.interners[name] = Interner(name)
+        return self.interners[name]
+
+    def packed_dict(self, fields, bits, default_factory=None):
+        """
+        PackedDict with the shared interners of the fields
+        """
+        return PackedDict([self.interner(name) for name in fields], bits, default_factory)
+
+    def artifact(self, name, load):
+        if name not in self.artifacts:
+            self.artifacts[name] = load()
+        return self.artifacts[name]
+
+
+def shared_components(accumulators):
+    """
+    The state components read by the accumulators, every one of them only once
+    """
+    components = {}
+    for acc in accumulators:
+        for attr in getattr(acc, "components", ()):
+            component = getattr(acc, attr)
+            components.setdefault(id(component), component)
+    return list(components.values())
+
+
 class StatsAcc:
     """
     This is the base class for the accumulator. All other classes should implement get_stats and update_acc methods.
@@ -57,14 +239,27 @@ class StatsAcc:
     StatsAcc(filter=lambda row: row.action_type == "clickout_item",
              init_acc=defaultdict(int),
              updater=lambda acc, row: acc[(row.user_id, row.item_id)]+=1)
+
+    Accumulators whose state and statistics depend only on the history of the current user have
+    user_local = True. They can be calculated in workers sharded by user_id (see generate_data_sharded.py).
+
+    Without an updater acc is a shared state component (see SharedState) which is updated elsewhere.
+
+    get_stats gets the clickout row and the item, a dict with the item_id, rank and price of one impression.
+
+    Statistics which do not depend on the item (get_stats_func reads only the row) have scope="clickout".
+    They are calculated once per clickout and copied to all the impressions.
     """
 
-    def __init__(self, name, action_types, acc, updater, get_stats_func):
+    def __init__(self, name, action_types, acc, updater, get_stats_func, user_local=False, scope="item"):
         self.name = name
-        self.action_types = action_types
+        self.action_types = action_types if updater is not None else []
         self.acc = acc
         self.updater = updater
         self.get_stats_func = get_stats_func
+        self.user_local = user_local
+        self.components = ("acc",) if updater is None else ()
+        self.clickout_features = [name] if scope == "clickout" else []
 
     def filter(self, row):
         return self.action_types(row)
@@ -81,6 +276,8 @@ class ItemLastClickoutStatsInSession:
     It measures how many times the item was the last one being clicked
     """
 
+    features = ["last_clickout_item_stats"]
+
     def __init__(self):
         self.action_types = ["clickout item"]
         self.last_interaction = {}
@@ -105,11 +302,47 @@ class ItemLastClickoutStatsInSession:
         return output
 
 
+def seq_entropy(sequence, ranks):
+    """
+    Gzip length of the sequence with the rank appended and its ratio to the length without the rank
+    """
+    seq = ",".join([str(el) for el in sequence])
+    compressed_without_rank = len(gzip.compress(seq.encode("utf-8")))
+    gzip_len = []
+    entropy = []
+    for rank in ranks:
+        compressed_with_rank = len(gzip.compress((seq + "," + str(rank)).encode("utf-8")))
+        gzip_len.append(compressed_with_rank)
+        entropy.append(compressed_with_rank / compressed_without_rank)
+    return gzip_len, entropy
+
+
 class ClickSequenceFeatures:
     """
     Basic information about the sequence of indices users clicked.
     """
 
+    user_local = True
+    features = [
+        "click_sequence_min",
+        "click_sequence_max",
+        "click_sequence_min_norm",
+        "click_sequence_max_norm",
+        "click_sequence_len",
+        "click_sequence_sd",
+        "click_sequence_mean",
+        "click_sequence_mean_norm",
+        "click_sequence_gzip_len",
+        "click_sequence_entropy",
+    ]
+    clickout_features = [
+        "click_sequence_min",
+        "click_sequence_max",
+        "click_sequence_len",
+        "click_sequence_sd",
+        "click_sequence_mean",
+    ]
+
     def __init__(self):
         self.current_impression = {}
         self.sequences = defaultdict(list)
@@ -121,46 +354,44 @@ class ClickSequenceFeatures:
             self.sequences[key].append(row["index_clicked"])
 
     def get_stats(self, row, item):
+        return first_item_stats(self.get_stats_batch(row, [item]))
+
+    def get_stats_batch(self, row, items):
         key = (row["user_id"], row["session_id"])
+        ranks = [item["rank"] for item in items]
         obs = {}
         sequence = self.sequences[key]
 
         if sequence:
-            obs["click_sequence_min"] = min(sequence)
-            obs["click_sequence_max"] = max(sequence)
-            obs["click_sequence_min_norm"] = obs["click_sequence_min"] - item["rank"]
-            obs["click_sequence_max_norm"] = obs["click_sequence_max"] - item["rank"]
-            obs["click_sequence_len"] = len(sequence)
-            obs["click_sequence_sd"] = stdev(sequence) if len(sequence) > 1 else 0
-            obs["click_sequence_mean"] = mean(sequence)
-            obs["click_sequence_mean_norm"] = obs["click_sequence_mean"] - item["rank"]
-            obs["click_sequence_gzip_len"], obs["click_sequence_entropy"] = self._seq_entropy(sequence, item["rank"])
+            seq_min = min(sequence)
+            seq_max = max(sequence)
+            seq_mean = mean(sequence)
+            gzip_len, entropy = seq_entropy(sequence, ranks)
+            obs["click_sequence_min"] = [seq_min for rank in ranks]
+            obs["click_sequence_max"] = [seq_max for rank in ranks]
+            obs["click_sequence_min_norm"] = [seq_min - rank for rank in ranks]
+            obs["click_sequence_max_norm"] = [seq_max - rank for rank in ranks]
+            obs["click_sequence_len"] = [len(sequence) for rank in ranks]
+            obs["click_sequence_sd"] = [stdev(sequence) if len(sequence) > 1 else 0] * len(ranks)
+            obs["click_sequence_mean"] = [seq_mean for rank in ranks]
+            obs["click_sequence_mean_norm"] = [seq_mean - rank for rank in ranks]
+            obs["click_sequence_gzip_len"] = gzip_len
+            obs["click_sequence_entropy"] = entropy
         else:
-            obs["click_sequence_min"] = -1000
-            obs["click_sequence_max"] = -1000
-            obs["click_sequence_min_norm"] = -1000
-            obs["click_sequence_max_norm"] = -1000
-            obs["click_sequence_len"] = -1000
-            obs["click_sequence_sd"] = -1000
-            obs["click_sequence_mean"] = -1000
-            obs["click_sequence_mean_norm"] = -1000
-            obs["click_sequence_gzip_len"] = -1000
-            obs["click_sequence_entropy"] = -1000
+            for name in self.features:
+                obs[name] = [-1000] * len(ranks)
         return obs
 
-    def _seq_entropy(self, sequence, rank):
-        seq = ",".join([str(el) for el in sequence]).encode("utf-8")
-        seq_with_rank = ",".join([str(el) for el in sequence + [rank]]).encode("utf-8")
-        compressed_with_rank = gzip.compress(seq_with_rank)
-        compressed_without_rank = gzip.compress(seq)
-        return len(compressed_with_rank), (len(compressed_with_rank) / len(compressed_without_rank))
-
 
 class FakeClickSequenceFeatures:
     """
     Basic information about the sequence of indices users interacted with.
     """
 
+    user_local = True
+    features = ["fake_" + name for name in ClickSequenceFeatures.features]
+    clickout_features = ["fake_" + name for name in ClickSequenceFeatures.clickout_features]
+
     def __init__(self):
         self.current_impression = {}
         self.sequences = defaultdict(list)
@@ -172,66 +403,75 @@ class FakeClickSequenceFeatures:
             self.sequences[key].append(row["fake_index_interacted"])
 
     def get_stats(self, row, item):
+        return first_item_stats(self.get_stats_batch(row, [item]))
+
+    def get_stats_batch(self, row, items):
         key = (row["user_id"], row["session_id"])
+        ranks = [item["rank"] for item in items]
         obs = {}
         sequence = self.sequences[key]
 
         if sequence:
-            obs["fake_click_sequence_min"] = min(sequence)
-            obs["fake_click_sequence_max"] = max(sequence)
-            obs["fake_click_sequence_min_norm"] = obs["fake_click_sequence_min"] - item["rank"]
-            obs["fake_click_sequence_max_norm"] = obs["fake_click_sequence_max"] - item["rank"]
-            obs["fake_click_sequence_len"] = len(sequence)
-            obs["fake_click_sequence_sd"] = stdev(sequence) if len(sequence) > 1 else 0
-            obs["fake_click_sequence_mean"] = mean(sequence)
-            obs["fake_click_sequence_mean_norm"] = obs["fake_click_sequence_mean"] - item["rank"]
-            obs["fake_click_sequence_gzip_len"], obs["fake_click_sequence_entropy"] = self._seq_entropy(
-                sequence, item["rank"]
-            )
+            seq_min = min(sequence)
+            seq_max = max(sequence)
+            seq_mean = mean(sequence)
+            gzip_len, entropy = seq_entropy(sequence, ranks)
+            obs["fake_click_sequence_min"] = [seq_min for rank in ranks]
+            obs["fake_click_sequence_max"] = [seq_max for rank in ranks]
+            obs["fake_click_sequence_min_norm"] = [seq_min - rank for rank in ranks]
+            obs["fake_click_sequence_max_norm"] = [seq_max - rank for rank in ranks]
+            obs["fake_click_sequence_len"] = [len(sequence) for rank in ranks]
+            obs["fake_click_sequence_sd"] = [stdev(sequence) if len(sequence) > 1 else 0] * len(ranks)
+            obs["fake_click_sequence_mean"] = [seq_mean for rank in ranks]
+            obs["fake_click_sequence_mean_norm"] = [seq_mean - rank for rank in ranks]
+            obs["fake_click_sequence_gzip_len"] = gzip_len
+            obs["fake_click_sequence_entropy"] = entropy
         else:
-            obs["fake_click_sequence_min"] = -1000
-            obs["fake_click_sequence_max"] = -1000
-            obs["fake_click_sequence_min_norm"] = -1000
-            obs["fake_click_sequence_max_norm"] = -1000
-            obs["fake_click_sequence_len"] = -1000
-            obs["fake_click_sequence_sd"] = -1000
-            obs["fake_click_sequence_mean"] = -1000
-            obs["fake_click_sequence_mean_norm"] = -1000
-            obs["fake_click_sequence_gzip_len"] = -1000
-            obs["fake_click_sequence_entropy"] = -1000
+            for name in self.features:
+                obs[name] = [-1000] * len(ranks)
         return obs
 
-    def _seq_entropy(self, sequence, rank):
-        seq = ",".join([str(el) for el in sequence]).encode("utf-8")
-        seq_with_rank = ",".join([str(el) for el in sequence + [rank]]).encode("utf-8")
-        compressed_with_rank = gzip.compress(seq_with_rank)
-        compressed_without_rank = gzip.compress(seq)
-        return len(compressed_with_rank), (len(compressed_with_rank) / len(compressed_without_rank))
-
 
 class Last10Actions:
     """
     It creates a list of the last 10 actions
     """
 
+    user_local = True
+
     def __init__(self):
         self.current_impression = {}
         self.sequences = defaultdict(list)
         self.action_types = ACTIONS_WITH_ITEM_REFERENCE
 
+    @property
+    def features(self):
+        return [f"cat_action_index_{n}{suffix}" for n in range(10) for suffix in ("", "_norm")]
+
+    @property
+    def clickout_features(self):
+        return [f"cat_action_index_{n}" for n in range(10)]
+
     def update_acc(self, row):
         if row["action_type"] in self.action_types:
             key = (row["user_id"], row["session_id"])
             self.sequences[key].append((row["action_type"], row["fake_index_interacted"]))
 
     def get_stats(self, row, item):
+        return first_item_stats(self.get_stats_batch(row, [item]))
+
+    def get_stats_batch(self, row, items):
         key = (row["user_id"], row["session_id"])
+        ranks = [item["rank"] for item in items]
         obs = {}
         sequence = [(None, None)] * 10 + self.sequences[key]
         for n in range(10):
             action, ind = sequence[-n]
-            obs[f"cat_action_index_{n}"] = "{}{}".format(action, ind) if action else ""
-            obs[f"cat_action_index_{n}_norm"] = "{}{}".format(action, item["rank"] - ind) if action else ""
+            obs[f"cat_action_index_{n}"] = ["{}{}".format(action, ind) if action else ""] * len(ranks)
+            if action:
+                obs[f"cat_action_index_{n}_norm"] = ["{}{}".format(action, rank - ind) for rank in ranks]
+            else:
+                obs[f"cat_action_index_{n}_norm"] = [""] * len(ranks)
         return obs
 
 
@@ -241,11 +481,14 @@ class ClickProbabilityClickOffsetTimeOffset:
     the previous interaction and current timestamp.
     """
 
+    user_local = True
+    artifacts = ("probs",)
+
     def __init__(
         self,
         name="clickout_prob_time_position_offset",
         action_types=None,
-        impressions_type="impressions_raw",
+        impressions_type="impressions_fp",
         index_col="index_clicked",
         probs_path="../../data/click_probs_by_index.joblib",
     ):
@@ -254,8 +497,8 @@ class ClickProbabilityClickOffsetTimeOffset:
         self.index_col = index_col
         self.impressions_type = impressions_type
         self.probs_path = probs_path
-        # tracks the impression per user
-        self.current_impression = defaultdict(str)
+        # tracks the impression (fingerprint) per user
+        self.current_impression = defaultdict(int)
         self.last_timestamp = {}
         self.last_clickout_position = {}
         self.read_probs()
@@ -311,10 +554,13 @@ class PoiFeatures:
     What is the CTR of the item when users are searching for this POI.
     """
 
+    features = ["last_poi", "last_poi_item_clicks", "last_poi_item_impressions", "last_poi_ctr"]
+    clickout_features = ["last_poi"]
+
     def __init__(self):
         self.name = "last_poi_features"
         self.action_types = ["search for poi", "clickout item"]
-        self.last_poi = defaultdict(lambda: "UNK")
+        self.last_poi = defaultdict(unknown)
         self.last_poi_clicks = defaultdict(int)
         self.last_poi_impressions = defaultdict(int)
 
@@ -341,8 +587,10 @@ class IndicesFeatures:
     It has the last 5 indices and timestamps
     """
 
+    user_local = True
+
     def __init__(
-        self, action_types=["clickout item"], impressions_type="impressions_raw", index_key="index_clicked", prefix=""
+        self, action_types=["clickout item"], impressions_type="impressions_fp", index_key="index_clicked", prefix=""
     ):
         self.action_types = action_types
         self.impressions_type = impressions_type
@@ -351,6 +599,20 @@ class IndicesFeatures:
         self.last_timestamps = defaultdict(list)
         self.prefix = prefix
 
+    @property
+    def features(self):
+        return [
+            f"{self.prefix}{name}_{n}"
+            for n in range(1, 6)
+            for name in ("last_index", "last_index_diff", "last_ts_diff")
+        ] + [self.prefix + "n_consecutive_clicks"]
+
+    @property
+    def clickout_features(self):
+        # only the last differences and the consecutive clicks depend on the rank of the item
+        item_features = {self.prefix + "last_index_diff_1", self.prefix + "last_ts_diff_1"}
+        return [name for name in self.features[:-1] if name not in item_features]
+
     def update_acc(self, row):
         # TODO: reset list when there is a change of sort order?
         if row["action_type"] in self.action_types and row[self.index_key] >= 0:
@@ -358,31 +620,41 @@ class IndicesFeatures:
             self.last_timestamps[(row["user_id"], row[self.impressions_type])].append(row["timestamp"])
 
     def get_stats(self, row, item):
+        return first_item_stats(self.get_stats_batch(row, [item]))
+
+    def get_stats_batch(self, row, items):
         last_n = 5
-        last_indices_raw = self.last_indices[(row["user_id"], row[self.impressions_type])]
+        key = (row["user_id"], row[self.impressions_type])
+        last_indices_raw = self.last_indices[key]
         last_indices = [-100] * last_n + last_indices_raw
         last_indices = last_indices[-last_n:]
-        diff_last_indices = diff(last_indices + [item["rank"]])
-
-        last_ts_raw = self.last_timestamps[(row["user_id"], row[self.impressions_type])]
+        last_ts_raw = self.last_timestamps[key]
         last_ts = [-100] * last_n + last_ts_raw
         last_ts = last_ts[-last_n:]
-        diff_last_ts = diff(last_ts + [item["rank"]])
+        # only the last difference depends on the rank of the item
+        diff_last_indices = diff(last_indices)
+        diff_last_ts = diff(last_ts)
+        ranks = [item["rank"] for item in items]
 
         output = {}
         for n in range(1, last_n + 1):
             if last_indices[-n] != -100:
-                output[self.prefix + "last_index_{}".format(n)] = last_indices[-n]
+                output[self.prefix + "last_index_{}".format(n)] = [last_indices[-n]] * len(ranks)
                 # output[self.prefix + "last_index_{}_vs_rank".format(n)] = last_indices[-n] - item["rank"]
-                output[self.prefix + "last_index_diff_{}".format(n)] = diff_last_indices[-n]
-                output[self.prefix + "last_ts_diff_{}".format(n)] = diff_last_ts[-n]
+                if n == 1:
+                    output[self.prefix + "last_index_diff_1"] = [rank - last_indices[-1] for rank in ranks]
+                    output[self.prefix + "last_ts_diff_1"] = [rank - last_ts[-1] for rank in ranks]
+                else:
+                    output[self.prefix + "last_index_diff_{}".format(n)] = [diff_last_indices[-n + 1]] * len(ranks)
+                    output[self.prefix + "last_ts_diff_{}".format(n)] = [diff_last_ts[-n + 1]] * len(ranks)
             else:
-                output[self.prefix + "last_index_{}".format(n)] = None
+                output[self.prefix + "last_index_{}".format(n)] = [None] * len(ranks)
                 # output[self.prefix + "last_index_{}_vs_rank".format(n)] = None
-                output[self.prefix + "last_index_diff_{}".format(n)] = None
-                output[self.prefix + "last_ts_diff_{}".format(n)] = None
-        n_consecutive = self._calculate_n_consecutive_clicks(last_indices_raw, item["rank"])
-        output[self.prefix + "n_consecutive_clicks"] = n_consecutive
+                output[self.prefix + "last_index_diff_{}".format(n)] = [None] * len(ranks)
+                output[self.prefix + "last_ts_diff_{}".format(n)] = [None] * len(ranks)
+        output[self.prefix + "n_consecutive_clicks"] = [
+            self._calculate_n_consecutive_clicks(last_indices_raw, rank) for rank in ranks
+        ]
         return output
 
     def _calculate_n_consecutive_clicks(self, last_indices_raw, rank):
@@ -400,25 +672,35 @@ class PriceSimilarity:
     Similarity of price of the current item vs items that the user clicked before
     """
 
+    user_local = True
+    features = ["avg_price_similarity", "last_price_diff"]
+
     def __init__(self):
         self.action_types = ["clickout item"]
-        self.last_prices = defaultdict(list)
+        # the distinct prices the user clicked (sorted, with prefix sums) and the last one
+        self.clicked_prices = {}
+        self.last_price = {}
 
     def update_acc(self, row):
-        self.last_prices[row["user_id"]].append(row["price_clicked"])
+        if row["user_id"] not in self.clicked_prices:
+            self.clicked_prices[row["user_id"]] = SortedSums(unique=True)
+        self.clicked_prices[row["user_id"]].add(row["price_clicked"])
+        self.last_price[row["user_id"]] = row["price_clicked"]
 
     def get_stats(self, row, item):
-        clickout_prices_list = self.last_prices[row["user_id"]]
-        if not clickout_prices_list:
-            output = 1000
-            last_price_diff = 1000
-        else:
-            diff = [abs(p - item["price"]) for p in list(set(clickout_prices_list))]
-            output = sum(diff) / len(diff)
-            last_price_diff = clickout_prices_list[-1] - item["price"]
+        return first_item_stats(self.get_stats_batch(row, [item]))
+
+    def get_stats_batch(self, row, items):
+        clicked_prices = self.clicked_prices.get(row["user_id"])
         obs = {}
-        obs["avg_price_similarity"] = output
-        obs["last_price_diff"] = last_price_diff
+        if clicked_prices is None:
+            obs["avg_price_similarity"] = [1000] * len(items)
+            obs["last_price_diff"] = [1000] * len(items)
+        else:
+            last_price = self.last_price[row["user_id"]]
+            n = len(clicked_prices)
+            obs["avg_price_similarity"] = [clicked_prices.abs_diffs(item["price"]) / n for item in items]
+            obs["last_price_diff"] = [last_price - item["price"] for item in items]
         return obs
 
 
@@ -427,6 +709,9 @@ class PriceFeatures:
     Some basic features based on the price
     """
 
+    user_local = True
+    features = ["price_vs_max_price", "price_vs_mean_price"]
+
     def __init__(self):
         self.action_types = ["clickout item"]
 
@@ -434,11 +719,14 @@ class PriceFeatures:
         pass
 
     def get_stats(self, row, item):
+        return first_item_stats(self.get_stats_batch(row, [item]))
+
+    def get_stats_batch(self, row, items):
         max_price = max(row["prices"])
         mean_price = sum(row["prices"]) / len(row["prices"])
         obs = {}
-        obs["price_vs_max_price"] = max_price - item["price"]
-        obs["price_vs_mean_price"] = item["price"] / mean_price
+        obs["price_vs_max_price"] = [max_price - item["price"] for item in items]
+        obs["price_vs_mean_price"] = [item["price"] / mean_price for item in items]
         return obs
 
 
@@ -454,67 +742,89 @@ class SimilarityFeatures:
     - similarity to the last item
     """
 
-    def __init__(self, type, hashn):
-        self.action_types = ACTIONS_WITH_ITEM_REFERENCE
+    user_local = True
+    artifacts = ("jacc_sim", "poi_sim", "price_sim")
+    FEATURES = {
+        ("imm", 0): "item_similarity_to_last_clicked_item",
+        ("imm", 1): "avg_similarity_to_interacted_items",
+        ("imm", 2): "avg_similarity_to_interacted_session_items",
+        ("price", 0): "avg_price_similarity_to_interacted_items",
+        ("price", 1): "avg_price_similarity_to_interacted_session_items",
+        ("poi", 0): "poi_item_similarity_to_last_clicked_item",
+        ("poi", 1): "poi_avg_similarity_to_interacted_items",
+        ("poi", 2): "num_pois",
+    }
+
+    components = ("interactions", "last_clickout")
+
+    def __init__(self, type, hashn, state=None):
+        state = state or SharedState()
+        # the state is in the shared components
+        self.action_types = []
         self.type = type
 
         if self.type == "imm":
-            self.jacc_sim = JaccardItemSim(path="../../data/item_metadata_map.joblib")
+            self.jacc_sim = state.artifact(
+                "jacc_sim", lambda: JaccardItemSim(path="../../data/item_metadata_map.joblib")
+            )
         elif self.type == "poi":
-            self.poi_sim = JaccardItemSim(path="../../data/item_pois.joblib")
+            self.poi_sim = state.artifact("poi_sim", lambda: JaccardItemSim(path="../../data/item_pois.joblib"))
         elif self.type == "price":
-            self.price_sim = ItemPriceSim(path="../../data/item_prices.joblib")
-        self.last_item_clickout = defaultdict(int)
-        self.user_item_interactions_list = defaultdict(set)
-        self.user_item_session_interactions_list = defaultdict(set)
+            self.price_sim = state.artifact("price_sim", lambda: ItemPriceSim(path="../../data/item_prices.joblib"))
+        self.interactions = state.get("user_item_interactions")
+        self.last_clickout = state.get("last_user_clickout")
         self.hashn = hashn
 
+    @property
+    def features(self):
+        return [name for (type, hashn), name in self.FEATURES.items() if type == self.type and hashn == self.hashn]
+
     def update_acc(self, row):
-        if row["action_type"] == "clickout item":
-            self.last_item_clickout[row["user_id"]] = row["reference"]
-        if row["action_type"] in ACTIONS_WITH_ITEM_REFERENCE:
-            self.user_item_interactions_list[row["user_id"]].add(tryint(row["reference"]))
-            self.user_item_session_interactions_list[(row["user_id"], row["session_id"])].add(tryint(row["reference"]))
+        pass
 
     def get_stats(self, row, item):
-        user_item_interactions_list = list(self.user_item_interactions_list[row["user_id"]])
+        return first_item_stats(self.get_stats_batch(row, [item]))
+
+    def get_stats_batch(self, row, items):
+        user_item_interactions_list = list(self.interactions.by_user.get(row["user_id"], ()))
         user_item_session_interactions_list = list(
-            self.user_item_session_interactions_list[(row["user_id"], row["session_id"])]
+            self.interactions.by_session.get((row["user_id"], row["session_id"]), ())
         )
-        last_item_clickout = self.last_item_clickout[row["user_id"]]
-        item_id = int(item["item_id"])
+        last_item_clickout = self.last_clickout.item.get(row["user_id"], 0)
         output = {}
         if self.type == "imm":
             if self.hashn == 0:
-                output["item_similarity_to_last_clicked_item"] = self.jacc_sim.two_items(
-                    last_item_clickout, item["item_id"]
-                )
+                output["item_similarity_to_last_clicked_item"] = [
+                    self.jacc_sim.two_items(last_item_clickout, item["item_id"]) for item in items
+                ]
             elif self.hashn == 1:
-                output["avg_similarity_to_interacted_items"] = self.jacc_sim.list_to_item(
-                    user_item_interactions_list, item_id
+                output["avg_similarity_to_interacted_items"] = self.jacc_sim.list_to_items(
+                    user_item_interactions_list, [int(item["item_id"]) for item in items]
                 )
             elif self.hashn == 2:
-                output["avg_similarity_to_interacted_session_items"] = self.jacc_sim.list_to_item(
-                    user_item_session_interactions_list, item_id
+                output["avg_similarity_to_interacted_session_items"] = self.jacc_sim.list_to_items(
+                    user_item_session_interactions_list, [int(item["item_id"]) for item in items]
                 )
         elif self.type == "price":
             if self.hashn == 0:
-                output["avg_price_similarity_to_interacted_items"] = self.price_sim.list_to_item(
-                    user_item_interactions_list, item_id
+                output["avg_price_similarity_to_interacted_items"] = self.price_sim.list_to_items(
+                    user_item_interactions_list, [int(item["item_id"]) for item in items]
                 )
             elif self.hashn == 1:
-                output["avg_price_similarity_to_interacted_session_items"] = self.price_sim.list_to_item(
-                    user_item_session_interactions_list, item_id
+                output["avg_price_similarity_to_interacted_session_items"] = self.price_sim.list_to_items(
+                    user_item_session_interactions_list, [int(item["item_id"]) for item in items]
                 )
         elif self.type == "poi":
             if self.hashn == 0:
-                output["poi_item_similarity_to_last_clicked_item"] = self.poi_sim.two_items(last_item_clickout, item_id)
+                output["poi_item_similarity_to_last_clicked_item"] = [
+                    self.poi_sim.two_items(last_item_clickout, int(item["item_id"])) for item in items
+                ]
             elif self.hashn == 1:
-                output["poi_avg_similarity_to_interacted_items"] = self.poi_sim.list_to_item(
-                    user_item_interactions_list, item_id
+                output["poi_avg_similarity_to_interacted_items"] = self.poi_sim.list_to_items(
+                    user_item_interactions_list, [int(item["item_id"]) for item in items]
                 )
             elif self.hashn == 2:
-                output["num_pois"] = len(self.poi_sim.imm[item_id])
+                output["num_pois"] = [len(self.poi_sim.imm[int(item["item_id"])]) for item in items]
         return output
 
 
@@ -528,6 +838,8 @@ class ItemCTR:
     - CTR corrected (it includes only the impressions that were below "above" the item)
     """
 
+    features = ["clickout_item_clicks", "clickout_item_impressions", "clickout_item_ctr", "clickout_item_ctr_corr"]
+
     def __init__(self, action_types):
         self.action_types = action_types
         self.clicks = defaultdict(int)
@@ -551,12 +863,25 @@ class ItemCTR:
         output["clickout_item_ctr_corr"] = output["clickout_item_clicks"] / (self.impressions_corr[item["item_id"]] + 1)
         return output
 
+    def get_stats_batch(self, row, items):
+        clicks = [self.clicks[item["item_id"]] for item in items]
+        impressions = [self.impressions[item["item_id"]] for item in items]
+        impressions_corr = [self.impressions_corr[item["item_id"]] for item in items]
+        output = {}
+        output["clickout_item_clicks"] = clicks
+        output["clickout_item_impressions"] = impressions
+        output["clickout_item_ctr"] = [c / (i + 1) for c, i in zip(clicks, impressions)]
+        output["clickout_item_ctr_corr"] = [c / (i + 1) for c, i in zip(clicks, impressions_corr)]
+        return output
+
 
 class ItemCTRInteractions:
     """
     Similar to ItemCTR but it is based on the interactions.
     """
 
+    features = ["interact_item_clicks", "interact_item_impressions", "interact_item_ctr"]
+
     def __init__(self):
         self.action_types = ACTIONS_WITH_ITEM_REFERENCE
         self.clicks = defaultdict(int)
@@ -583,6 +908,9 @@ class ItemAverageRank:
     It calculate the average, the last rank per each item
     """
 
+    user_local = True
+    features = ["item_last_rank", "item_avg_rank"]
+
     def __init__(self):
         self.action_types = ["clickout item"]
         self.ranks = defaultdict(list)
@@ -606,21 +934,27 @@ class ItemCTRRankWeighted:
     CTR weighted by the ranking.
     """
 
-    def __init__(self):
+    features = [
+        "clickout_item_clicks_rank_weighted",
+        "clickout_item_impressions_rank_weighted",
+        "clickout_item_ctr_rank_weighted",
+    ]
+
+    def __init__(self, state=None):
+        items = (state or SharedState()).interner("item_id")
         self.action_types = ["clickout item"]
-        self.clicks = defaultdict(int)
-        self.impressions = defaultdict(int)
+        self.clicks = DenseCounter(items)
+        self.impressions = DenseCounter(items)
 
     def update_acc(self, row):
         if row["index_clicked"] != -1000:
-            self.clicks[row["reference"]] += row["index_clicked"] + 1
-            for ind, item_id in enumerate(row["impressions"]):
-                self.impressions[item_id] += ind + 1
+            self.clicks.add(row["reference"], n=row["index_clicked"] + 1)
+            self.impressions.add_many(row["impressions"], n=list(range(1, len(row["impressions"]) + 1)))
 
     def get_stats(self, row, item):
         output = {}
-        output["clickout_item_clicks_rank_weighted"] = self.clicks[item["item_id"]]
-        output["clickout_item_impressions_rank_weighted"] = self.impressions[item["item_id"]]
+        output["clickout_item_clicks_rank_weighted"] = self.clicks.get(item["item_id"])
+        output["clickout_item_impressions_rank_weighted"] = self.impressions.get(item["item_id"])
         output["clickout_item_ctr_rank_weighted"] = output["clickout_item_clicks_rank_weighted"] / (
             output["clickout_item_impressions_rank_weighted"] + 1
         )
@@ -632,6 +966,10 @@ class UserItemAttentionSpan:
     This class calculates how much time the user spends when he interacted with the item.
     """
 
+    user_local = True
+    features = ["user_item_avg_attention", "is_item_within_avg_span", "is_item_within_avg_span_2s"]
+    clickout_features = ["user_item_avg_attention"]
+
     def __init__(self):
         self.action_types = ACTIONS_WITH_ITEM_REFERENCE
         self.user_interaction_times = defaultdict(list)
@@ -651,26 +989,27 @@ class UserItemAttentionSpan:
         self.user_last_interaction_ts[key] = new_ts
 
     def get_stats(self, row, item):
+        return first_item_stats(self.get_stats_batch(row, [item]))
+
+    def get_stats_batch(self, row, items):
         key = (row["user_id"], row["session_id"])
         new_ts = row["timestamp"]
         old_ts = self.user_last_interaction_ts.get(key, 0)
         obs = {}
         if key in self.user_interaction_times:
-            obs["user_item_avg_attention"] = sum(self.user_interaction_times[key]) / (
-                len(self.user_interaction_times[key])
-            )
-            obs["is_item_within_avg_span"] = int(
-                ((new_ts - old_ts) < obs["user_item_avg_attention"])
-                and (self.user_last_interaction_item[key] == item["item_id"])
-            )
-            obs["is_item_within_avg_span_2s"] = int(
-                ((new_ts - old_ts) < (2 * obs["user_item_avg_attention"]))
-                and (self.user_last_interaction_item[key] == item["item_id"])
-            )
+            avg_attention = sum(self.user_interaction_times[key]) / (len(self.user_interaction_times[key]))
+            last_item_id = self.user_last_interaction_item[key]
+            obs["user_item_avg_attention"] = [avg_attention] * len(items)
+            obs["is_item_within_avg_span"] = [
+                int(((new_ts - old_ts) < avg_attention) and (last_item_id == item["item_id"])) for item in items
+            ]
+            obs["is_item_within_avg_span_2s"] = [
+                int(((new_ts - old_ts) < (2 * avg_attention)) and (last_item_id == item["item_id"])) for item in items
+            ]
         else:
-            obs["user_item_avg_attention"] = -1
-            obs["is_item_within_avg_span"] = -1
-            obs["is_item_within_avg_span_2s"] = -1
+            obs["user_item_avg_attention"] = [-1] * len(items)
+            obs["is_item_within_avg_span"] = [-1] * len(items)
+            obs["is_item_within_avg_span_2s"] = [-1] * len(items)
         return obs
 
 
@@ -680,24 +1019,24 @@ class GlobalClickoutTimestamp:
     It also checks if the click was from the same user.
     """
 
-    def __init__(self):
-        self.action_types = ["clickout item"]
-        self.last_ts = {}
-        self.last_user = {}
+    features = ["last_item_timestamp", "last_item_click_same_user"]
+    components = ("last_clickout",)
+
+    def __init__(self, state=None):
+        self.last_clickout = (state or SharedState()).get("last_item_clickout")
+        # the state is in the shared component, it is keyed by the reference string (the impressions are numeric)
+        self.action_types = []
 
     def update_acc(self, row):
-        if not row["reference"].isnumeric():
-            return
-        self.last_ts[int(row["reference"])] = row["timestamp"]
-        self.last_user[int(row["reference"])] = row["user_id"]
+        pass
 
     def get_stats(self, row, item):
         obs = {}
-        if self.last_ts.get(int(item["item_id"])):
-            obs["last_item_timestamp"] = row["timestamp"] - self.last_ts.get(int(item["item_id"]))
+        if self.last_clickout.timestamp.get(item["item_id"]):
+            obs["last_item_timestamp"] = row["timestamp"] - self.last_clickout.timestamp.get(item["item_id"])
         else:
             obs["last_item_timestamp"] = None
-        obs["last_item_click_same_user"] = int(self.last_user.get(int(item["item_id"]), None) == row["user_id"])
+        obs["last_item_click_same_user"] = int(self.last_clickout.user.get(item["item_id"], None) == row["user_id"])
         return obs
 
 
@@ -708,12 +1047,22 @@ class DistinctInteractions:
     that the next item will probably also be unique.
     """
 
+    user_local = True
+
     def __init__(self, name, action_types, by="timestamp"):
         self.name = name
         self.action_types = action_types
         self.counter = defaultdict(int)
         self.item_set = defaultdict(set)
 
+    @property
+    def features(self):
+        return [f"{self.name}_uniq_interactions", f"{self.name}_item_uniq_prob"]
+
+    @property
+    def clickout_features(self):
+        return [f"{self.name}_uniq_interactions"]
+
     def update_acc(self, row):
         key = row["user_id"]
         if row["reference"].isnumeric():
@@ -721,6 +1070,9 @@ class DistinctInteractions:
             self.counter[key] += 1
 
     def get_stats(self, row, item):
+        return first_item_stats(self.get_stats_batch(row, [item]))
+
+    def get_stats_batch(self, row, items):
         key = row["user_id"]
         uniq = len(self.item_set[key])
         all = self.counter[key]
@@ -740,11 +1092,12 @@ class DistinctInteractions:
         """
 
         obs = {}
-        obs[f"{self.name}_uniq_interactions"] = uniq / (all + 1)
-        if int(item["item_id"]) in self.item_set[key]:
-            obs[f"{self.name}_item_uniq_prob"] = 1 - ((uniq + 1) / (all + 2))
-        else:
-            obs[f"{self.name}_item_uniq_prob"] = (uniq + 1) / (all + 2)
+        obs[f"{self.name}_uniq_interactions"] = [uniq / (all + 1)] * len(items)
+        item_set = self.item_set[key]
+        obs[f"{self.name}_item_uniq_prob"] = [
+            1 - ((uniq + 1) / (all + 2)) if int(item["item_id"]) in item_set else (uniq + 1) / (all + 2)
+            for item in items
+        ]
 
         return obs
 
@@ -797,22 +1150,33 @@ class ClickSequenceTrend:
     We use a linear regression and the slope of minimum and maximum index.
     """
 
+    user_local = True
+
     def __init__(self, method="minmax", by="user_id"):
         self.by = by
         self.action_types = ACTIONS_WITH_ITEM_REFERENCE
         self.user_ind = defaultdict(list)
         self.method = method
 
+    @property
+    def features(self):
+        return [f"{name}_{self.method}_by_{self.by}" for name in ("predicted_ind", "predicted_ind_rel", "ind_per_ts")]
+
+    @property
+    def clickout_features(self):
+        return [f"{name}_{self.method}_by_{self.by}" for name in ("predicted_ind", "ind_per_ts")]
+
     def update_acc(self, row):
         if row["fake_index_interacted"] == -1000:
             return
         self.user_ind[row[self.by]].append((row["fake_index_interacted"], row["timestamp"]))
 
     def get_stats(self, row, item):
-        obs = {}
-        obs[f"predicted_ind_{self.method}_by_{self.by}"] = -1
-        obs[f"predicted_ind_rel_{self.method}_by_{self.by}"] = -1
-        obs[f"ind_per_ts_{self.method}_by_{self.by}"] = -1
+        return first_item_stats(self.get_stats_batch(row, [item]))
+
+    def get_stats_batch(self, row, items):
+        predicted_ind = -1
+        ind_per_ts = -1
         if len(self.user_ind[row[self.by]]) >= 2:
             max_ind, max_ts = self.user_ind[row[self.by]][-1]
             if self.method == "minmax":
@@ -820,19 +1184,22 @@ class ClickSequenceTrend:
                 if max_ts - min_ts > 0:
                     ind_per_ts = (max_ind - min_ind) / (max_ts - min_ts)
                     ts_passed = row["timestamp"] - max_ts
-                    obs[f"ind_per_ts_{self.method}_by_{self.by}"] = ind_per_ts
-                    obs[f"predicted_ind_{self.method}_by_{self.by}"] = max_ind + ts_passed * ind_per_ts
+                    predicted_ind = max_ind + ts_passed * ind_per_ts
             elif self.method == "lr":
                 X = [row["timestamp"] - ts for ind, ts in self.user_ind[row[self.by]]]
                 Y = [ind for ind, ts in self.user_ind[row[self.by]]]
                 try:
                     line = fit_lr(X, Y)
-                    obs[f"predicted_ind_{self.method}_by_{self.by}"] = line(row["timestamp"] - max_ts)
+                    predicted_ind = line(row["timestamp"] - max_ts)
                 except ZeroDivisionError:
-                    obs[f"predicted_ind_{self.method}_by_{self.by}"] = -1
-            obs[f"predicted_ind_rel_{self.method}_by_{self.by}"] = (
-                obs[f"predicted_ind_{self.method}_by_{self.by}"] - item["rank"]
-            )
+                    predicted_ind = -1
+            predicted_ind_rel = [predicted_ind - item["rank"] for item in items]
+        else:
+            predicted_ind_rel = [-1] * len(items)
+        obs = {}
+        obs[f"predicted_ind_{self.method}_by_{self.by}"] = [predicted_ind] * len(items)
+        obs[f"predicted_ind_rel_{self.method}_by_{self.by}"] = predicted_ind_rel
+        obs[f"ind_per_ts_{self.method}_by_{self.by}"] = [ind_per_ts] * len(items)
         return obs
 
 
@@ -847,59 +1214,50 @@ class SimilarUsersItemInteraction:
     ITEM <--- interacts with --- USER --- interacts with ---> ITEM
     """
 
-    def __init__(self):
-        self.action_types = ACTIONS_WITH_ITEM_REFERENCE
-        self.items_users = defaultdict(set)
-        self.users_items = defaultdict(set)
-        self.cache_key = None
-        self.item_stats_cached = None
+    features = ["similar_users_item_interaction"]
+
+    components = ("graph",)
+
+    def __init__(self, state=None, max_item_degree=None):
+        """
+        The counts are only calculated for the impressions (see UserItemGraph.cooccurrence_counts).
+        Items of the user with more than max_item_degree users are skipped (all of them are counted by default).
+        """
+        self.graph = (state or SharedState()).get("user_item_graph")
+        # the state is in the shared graph
+        self.action_types = []
+        self.max_item_degree = max_item_degree
 
     def update_acc(self, row):
-        if row["is_test"] == "0":
-            self.items_users[row["reference"]].add(row["user_id"])
-            self.users_items[row["user_id"]].add(row["reference"])
+        pass
 
     def get_stats(self, row, item):
-        items_stats = self.read_stats_from_cache(row)
+        return first_item_stats(self.get_stats_batch(row, [item]))
+
+    def get_stats_batch(self, row, items):
+        item_ids = [item["item_id"] for item in items]
         obs = {}
-        obs["similar_users_item_interaction"] = items_stats[item["item_id"]]
+        obs["similar_users_item_interaction"] = self.graph.cooccurrence_counts(
+            row["user_id"], item_ids, self.max_item_degree
+        )
         return obs
 
-    def read_stats_from_cache(self, row):
-        key = (row["user_id"], row["timestamp"])
-        if self.cache_key == key:
-            items_stats = self.item_stats_cached
-        else:
-            items_stats = self.get_items_stats(row)
-            self.item_stats_cached = items_stats
-            self.cache_key = key
-        return items_stats
-
-    def get_items_stats(self, row):
-        items = defaultdict(int)
-        for item_id in self.users_items[row["user_id"]]:
-            for user_id in self.items_users[item_id]:
-                # discard the self similarity
-                if user_id == row["user_id"]:
-                    continue
-                for item_id_2 in self.users_items[user_id]:
-                    items[item_id_2] += 1
-        return items
-
 
 class GlobalTimestampPerItem:
     """
     Similar to the previous class which extracts the timestamps of clicks on the item
     """
 
-    def __init__(self):
-        self.action_types = ["clickout item"]
-        self.timestamp = {}
-        self.last_user = {}
+    features = ["last_item_time_diff_same_user", "last_item_last_user_id", "last_item_time_diff"]
+    components = ("last_clickout",)
+
+    def __init__(self, state=None):
+        self.last_clickout = (state or SharedState()).get("last_item_clickout")
+        # the state is in the shared component
+        self.action_types = []
 
     def update_acc(self, row):
-        self.timestamp[row["reference"]] = row["timestamp"]
-        self.last_user[row["reference"]] = row["user_id"]
+        pass
 
     def get_stats(self, row, item):
         output = {}
@@ -907,11 +1265,11 @@ class GlobalTimestampPerItem:
         output["last_item_last_user_id"] = None
         output["last_item_time_diff"] = None
 
-        if item["item_id"] in self.timestamp:
-            output["last_item_last_user_id"] = self.last_user[item["item_id"]]
-            output["last_item_time_diff"] = row["timestamp"] - self.timestamp[item["item_id"]]
+        if item["item_id"] in self.last_clickout.timestamp:
+            output["last_item_last_user_id"] = self.last_clickout.user[item["item_id"]]
+            output["last_item_time_diff"] = row["timestamp"] - self.last_clickout.timestamp[item["item_id"]]
             output["last_item_time_diff_same_user"] = output["last_item_time_diff"]
-            if row["user_id"] == self.last_user[item["item_id"]]:
+            if row["user_id"] == self.last_clickout.user[item["item_id"]]:
                 output["last_item_time_diff_same_user"] = None
         return output
 
@@ -921,6 +1279,10 @@ class TimeSinceSessionStart:
     Calculates the time since the start of the session
     """
 
+    user_local = True
+    features = ["session_start_ts"]
+    clickout_features = features
+
     def __init__(self):
         self.action_types = ALL_ACTIONS
         self.session_start = {}
@@ -945,6 +1307,10 @@ class NumberOfSessions:
     Calculates the number of sessions of the current user
     """
 
+    user_local = True
+    features = ["session_count"]
+    clickout_features = features
+
     def __init__(self):
         self.action_types = ALL_ACTIONS
         self.session_count = defaultdict(set)
@@ -963,6 +1329,10 @@ class TimeSinceUserStart:
     Calculates time since first user action
     """
 
+    user_local = True
+    features = ["user_start_ts"]
+    clickout_features = features
+
     def __init__(self):
         self.action_types = ALL_ACTIONS
         self.start = {}
@@ -987,12 +1357,17 @@ class AllFilters:
     Extracts all the filters the user used throughout the history
     """
 
+    user_local = True
+    features = ["alltime_filters"]
+    clickout_features = features
+
     def __init__(self):
         self.action_types = ["filter selection"]
-        self.filters_by_user = defaultdict(set)
+        # the filters are the keys, in the order they were first used
+        self.filters_by_user = defaultdict(dict)
 
     def update_acc(self, row):
-        self.filters_by_user[row["user_id"]].add(row["reference"])
+        self.filters_by_user[row["user_id"]][row["reference"]] = None
 
     def get_stats(self, row, item):
         obs = {}
@@ -1007,19 +1382,27 @@ class MostSimilarUserItemInteraction:
     from them
     
     This class is similar to SimilarUsersItemInteraction but it only focuses on the most similar users.
+
+    similarity is the score of the other users (see minhash.SIMILARITIES), by default the size of the union
+    of the item sets. With lsh (a minhash.MinHashLsh index, updated by this accumulator) only the users from
+    the LSH buckets of the user are scored instead of all the users who share an item with them.
     """
 
-    def __init__(self):
-        self.action_types = ACTIONS_WITH_ITEM_REFERENCE
-        self.items_users = defaultdict(set)
-        self.users_items = defaultdict(set)
+    features = ["most_similar_item_interaction"]
+
+    components = ("graph",)
+
+    def __init__(self, state=None, similarity="union", lsh=None):
+        self.graph = (state or SharedState()).get("user_item_graph")
+        # the state is in the shared graph (and in the index)
+        self.action_types = ACTIONS_WITH_ITEM_REFERENCE if lsh is not None else []
+        self.similarity = similarity
+        self.lsh = lsh
         self.cache_key = None
         self.item_stats_cached = None
 
     def update_acc(self, row):
-        if row["is_test"] == "0":
-            self.items_users[row["reference"]].add(row["user_id"])
-            self.users_items[row["user_id"]].add(row["reference"])
+        self.lsh.add(row["user_id"], row["reference"])
 
     def get_stats(self, row, item):
         items_stats = self.read_stats_from_cache(row)
@@ -1038,19 +1421,25 @@ class MostSimilarUserItemInteraction:
         return items_stats
 
     def get_items_stats(self, row):
-        this_user_items = self.users_items[row["user_id"]]
+        this_user_items = self.graph.users_items[row["user_id"]]
         best_user_id = None
-        best_intersection_len = 0
-        for item_id in this_user_items:
-            for other_user_id in self.items_users[item_id]:
-                if other_user_id == row["user_id"]:
-                    continue
-                intersection_len = len(self.users_items[other_user_id] | this_user_items)
-                if intersection_len > best_intersection_len:
-                    best_user_id = other_user_id
-                    best_intersection_len = intersection_len
+        if self.lsh is not None:
+            candidates = self.lsh.candidates(row["user_id"])
+            best_users = top_similar_users(candidates, this_user_items, self.graph.users_items, 1, self.similarity)
+            best_user_id = best_users[0] if best_users else None
+        else:
+            similarity = SIMILARITIES[self.similarity]
+            best_intersection_len = 0
+            for item_id in this_user_items:
+                for other_user_id in self.graph.items_users[item_id]:
+                    if other_user_id == row["user_id"]:
+                        continue
+                    intersection_len = similarity(self.graph.users_items[other_user_id], this_user_items)
+                    if intersection_len > best_intersection_len:
+                        best_user_id = other_user_id
+                        best_intersection_len = intersection_len
         items = defaultdict(int)
-        for item_id in self.users_items[best_user_id]:
+        for item_id in self.graph.users_items[best_user_id]:
             items[item_id] = 1
         return items
 
@@ -1060,19 +1449,28 @@ class MostSimilarUserItemInteractionv2:
     This is an accumulator that given interaction with items
     Finds users who interacted with the same items and then gathers statistics of interaction
     from them
+
+    similarity and lsh are like in MostSimilarUserItemInteraction, with lsh the k users are distinct.
     """
 
-    def __init__(self, k=1):
-        self.action_types = ACTIONS_WITH_ITEM_REFERENCE
-        self.items_users = defaultdict(set)
-        self.users_items = defaultdict(set)
+    components = ("graph",)
+
+    def __init__(self, k=1, state=None, similarity="union", lsh=None):
+        self.graph = (state or SharedState()).get("user_item_graph")
+        # the state is in the shared graph (and in the index)
+        self.action_types = ACTIONS_WITH_ITEM_REFERENCE if lsh is not None else []
         self.k = k
+        self.similarity = similarity
+        self.lsh = lsh
         self.cache_key = None
         self.item_stats_cached = None
 
+    @property
+    def features(self):
+        return ["most_similar_item_interaction_k_{}".format(self.k)]
+
     def update_acc(self, row):
-        self.items_users[row["reference"]].add(row["user_id"])
-        self.users_items[row["user_id"]].add(row["reference"])
+        self.lsh.add(row["user_id"], row["reference"])
 
     def get_stats(self, row, item):
         items_stats = self.read_stats_from_cache(row)
@@ -1091,18 +1489,25 @@ class MostSimilarUserItemInteractionv2:
         return items_stats
 
     def get_items_stats(self, row):
-        this_user_items = self.users_items[row["user_id"]]
-        user_stats = []
-        for item_id in this_user_items:
-            for other_user_id in self.items_users[item_id]:
-                if other_user_id == row["user_id"]:
-                    continue
-                intersection_len = len(self.users_items[other_user_id] | this_user_items)
-                user_stats.append((other_user_id, intersection_len))
-        selected_users = sorted(user_stats, key=lambda x: x[1], reverse=True)[: self.k]
+        this_user_items = self.graph.users_items[row["user_id"]]
+        if self.lsh is not None:
+            candidates = self.lsh.candidates(row["user_id"])
+            selected_users = top_similar_users(
+                candidates, this_user_items, self.graph.users_items, self.k, self.similarity
+            )
+        else:
+            similarity = SIMILARITIES[self.similarity]
+            user_stats = []
+            for item_id in this_user_items:
+                for other_user_id in self.graph.items_users[item_id]:
+                    if other_user_id == row["user_id"]:
+                        continue
+                    intersection_len = similarity(self.graph.users_items[other_user_id], this_user_items)
+                    user_stats.append((other_user_id, intersection_len))
+            selected_users = [user_id for user_id, _ in sorted(user_stats, key=lambda x: x[1], reverse=True)[: self.k]]
         items = defaultdict(int)
-        for user_id, _ in selected_users:
-            for item_id in self.users_items[user_id]:
+        for user_id in selected_users:
+            for item_id in self.graph.users_items[user_id]:
                 items[item_id] = 1
         return items
 
@@ -1114,6 +1519,8 @@ class ItemCTRInSequence:
     how likely the item was clicked as the last one in the sequence.
     """
 
+    features = ["item_clicks_when_last", "item_impressions_when_last", "item_ctr_when_last", "item_average_seq_pos"]
+
     def __init__(self):
         self.action_types = ["clickout item"]
         self.item_clicks_when_last = defaultdict(int)
@@ -1150,6 +1557,17 @@ class PriceSorted:
     This class creates a feature `wrong_price_sorting` if the sort order is not as it should be.
     """
 
+    user_local = True
+    features = [
+        "price_rem",
+        "are_price_sorted",
+        "are_price_sorted_rev",
+        "prices_sorted_until",
+        "prices_sorted_until_current_rank",
+        "wrong_price_sorting",
+    ]
+    clickout_features = ["are_price_sorted", "are_price_sorted_rev", "prices_sorted_until", "wrong_price_sorting"]
+
     def __init__(self):
         self.action_types = ["clickout item"]
 
@@ -1157,23 +1575,28 @@ class PriceSorted:
         pass
 
     def get_stats(self, row, item):
+        return first_item_stats(self.get_stats_batch(row, [item]))
+
+    def get_stats_batch(self, row, items):
         prices = row["prices"]
-        obs = {}
-        obs["price_rem"] = item["price"] % 100
-        obs["are_price_sorted"] = int(prices == sorted(prices))
-        obs["are_price_sorted_rev"] = int(prices == sorted(prices, reverse=True))
+        are_price_sorted = int(prices == sorted(prices))
 
         # calculates the point until the prices are sorted
-        obs["prices_sorted_until"] = 0
+        prices_sorted_until = 0
         for n in range(len(prices)):
             prices_sorted = int(prices == sorted(prices))
             if not prices_sorted:
                 break
-            obs["prices_sorted_until"] = n
+            prices_sorted_until = n
 
-        obs["prices_sorted_until_current_rank"] = int(item["rank"] < n)
         should_be_sorted = int("Sort by Price" in row["current_filters"])
-        obs["wrong_price_sorting"] = int(should_be_sorted and not obs["are_price_sorted"])
+        obs = {}
+        obs["price_rem"] = [item["price"] % 100 for item in items]
+        obs["are_price_sorted"] = [are_price_sorted] * len(items)
+        obs["are_price_sorted_rev"] = [int(prices == sorted(prices, reverse=True))] * len(items)
+        obs["prices_sorted_until"] = [prices_sorted_until] * len(items)
+        obs["prices_sorted_until_current_rank"] = [int(item["rank"] < n) for item in items]
+        obs["wrong_price_sorting"] = [int(should_be_sorted and not are_price_sorted)] * len(items)
         return obs
 
 
@@ -1183,9 +1606,12 @@ class ActionsTracker:
     It is probably an overkill and it causes the memory to explode.
     """
 
+    user_local = True
+    features = ["actions_tracker"]
+
     def __init__(self):
         self.action_types = ALL_ACTIONS
-        self.all_events_list = defaultdict(lambda: defaultdict(list))
+        self.all_events_list = defaultdict(list_defaultdict)
         self.int_events_list = defaultdict(list)
         self.max_timestamp = defaultdict(int)
 
@@ -1210,37 +1636,47 @@ class ActionsTracker:
         return new_row
 
     def get_stats(self, row, item):
+        return first_item_stats(self.get_stats_batch(row, [item]))
+
+    def get_stats_batch(self, row, items):
+        # the events are the same for all the items, only the relative ranks (rel=True) depend on the item
         all_events_list = self.all_events_list[row["user_id"]]
         max_timestamp = row["timestamp"]
-        obs = {}
+        template = {}
         for action_type in all_events_list.keys():
             for event_num, new_row in enumerate(all_events_list[action_type][::-1][:10]):
                 impressions = new_row["fake_impressions"]
                 prices = new_row["fake_prices"].split("|")
-                # import ipdb; ipdb.set_trace()
                 if action_type == "clickout item" and event_num <= 1:
                     for rank, (item_id, price) in enumerate(zip(impressions, prices)):
                         price = int(price)
-                        obs[f"co_price_{rank:02d}_{event_num:02d}"] = log1p(price)
+                        template[f"co_price_{rank:02d}_{event_num:02d}"] = (log1p(price), False)
 
-                obs[f"{action_type}_{event_num:02d}_timestamp"] = log1p(max_timestamp - new_row["timestamp"])
+                template[f"{action_type}_{event_num:02d}_timestamp"] = (
+                    log1p(max_timestamp - new_row["timestamp"]),
+                    False,
+                )
                 if new_row["action_type"] in ACTIONS_WITH_ITEM_REFERENCE:
                     impressions = new_row["fake_impressions"]
                     if new_row["reference"] in impressions:
-                        obs[f"{action_type}_rank_{event_num:02d}"] = impressions.index(new_row["reference"]) + 1
-                        obs[f"{action_type}_rank_{event_num:02d}_rel"] = item["rank"] - impressions.index(
-                            new_row["reference"]
-                        )
+                        index = impressions.index(new_row["reference"])
+                        template[f"{action_type}_rank_{event_num:02d}"] = (index + 1, False)
+                        template[f"{action_type}_rank_{event_num:02d}_rel"] = (index, True)
 
         int_events_list = self.int_events_list[row["user_id"]]
         for event_num, new_row in enumerate(int_events_list[::-1][:10]):
-            obs[f"interaction_{event_num:02d}_timestamp"] = log1p(max_timestamp - new_row["timestamp"])
+            template[f"interaction_{event_num:02d}_timestamp"] = (log1p(max_timestamp - new_row["timestamp"]), False)
             impressions = new_row["fake_impressions"]
             if new_row["reference"] in impressions:
-                obs[f"interaction_rank_{event_num:02d}"] = impressions.index(new_row["reference"]) + 1
-                obs[f"interaction_rank_{event_num:02d}_rel"] = item["rank"] - impressions.index(new_row["reference"])
+                index = impressions.index(new_row["reference"])
+                template[f"interaction_rank_{event_num:02d}"] = (index + 1, False)
+                template[f"interaction_rank_{event_num:02d}_rel"] = (index, True)
 
-        return {"actions_tracker": json.dumps(obs)}
+        values = []
+        for item in items:
+            obs = {key: item["rank"] - value if rel else value for key, (value, rel) in template.items()}
+            values.append(json.dumps(obs))
+        return {"actions_tracker": values}
 
 
 class PairwiseCTR:
@@ -1254,9 +1690,25 @@ class PairwiseCTR:
     RIGHT_WON = 1
     DRAW = 0
 
+    features = [
+        "pairwise_1_ctr_left_won",
+        "pairwise_1_ctr_right_won",
+        "pairwise_1_ctr_draw",
+        "pairwise_1_rel",
+        "pairwise_2_ctr_left_won",
+        "pairwise_2_ctr_right_won",
+        "pairwise_2_ctr_draw",
+        "pairwise_2_rel",
+    ]
+
     def __init__(self):
         self.action_types = ["clickout item"]
-        self.pairs = defaultdict(Counter)
+        # counts of LEFT_WON, DRAW and RIGHT_WON (column = result + 1) per pair of items packed into one int
+        self.pairs = DenseCounter(Interner(), width=3)
+
+    @staticmethod
+    def pair_key(l, r):
+        return None if l is None or r is None else (l << 32) | r
 
     def update_acc(self, row: Dict):
         if not row["reference"].isnumeric():
@@ -1265,38 +1717,53 @@ class PairwiseCTR:
         if not row["reference"].isnumeric():
             return
         ref = int(row["reference"])
-        for bigr in self.zipngram3(impressions, 2):
-            l, r = bigr
+        pairs = []
+        results = []
+        for l, r in self.zipngram3(impressions, 2):
+            pairs.append(self.pair_key(l, r))
             if ref == l:
-                self.pairs[bigr].update([self.LEFT_WON])
+                results.append(self.LEFT_WON + 1)
             elif ref == r:
-                self.pairs[bigr].update([self.RIGHT_WON])
+                results.append(self.RIGHT_WON + 1)
             else:
-                self.pairs[bigr].update([self.DRAW])
+                results.append(self.DRAW + 1)
+        self.pairs.add_many(pairs, results)
 
     def get_stats(self, row, item):
-        impressions = list(map(int, row["impressions"]))
-        position = item["rank"]
-
-        try:
-            prv_item = impressions[position - 1]
-        except IndexError:
-            prv_item = None
-        this_item = impressions[position]
-        try:
-            next_item = impressions[position + 1]
-        except IndexError:
-            next_item = None
+        return first_item_stats(self.get_stats_batch(row, [item]))
 
-        obs = {}
-        obs["pairwise_1_ctr_left_won"] = self.pairs[(prv_item, this_item)][self.LEFT_WON]
-        obs["pairwise_1_ctr_right_won"] = self.pairs[(prv_item, this_item)][self.RIGHT_WON]
-        obs["pairwise_1_ctr_draw"] = self.pairs[(prv_item, this_item)][self.DRAW]
-        obs["pairwise_1_rel"] = obs["pairwise_1_ctr_left_won"] / (obs["pairwise_1_ctr_right_won"] + 1)
-        obs["pairwise_2_ctr_left_won"] = self.pairs[(this_item, next_item)][self.LEFT_WON]
-        obs["pairwise_2_ctr_right_won"] = self.pairs[(this_item, next_item)][self.RIGHT_WON]
-        obs["pairwise_2_ctr_draw"] = self.pairs[(this_item, next_item)][self.DRAW]
-        obs["pairwise_2_rel"] = obs["pairwise_2_ctr_left_won"] / (obs["pairwise_2_ctr_right_won"] + 1)
+    def get_stats_batch(self, row, items):
+        impressions = list(map(int, row["impressions"]))
+        obs = {
+            "pairwise_1_ctr_left_won": [],
+            "pairwise_1_ctr_right_won": [],
+            "pairwise_1_ctr_draw": [],
+            "pairwise_1_rel": [],
+            "pairwise_2_ctr_left_won": [],
+            "pairwise_2_ctr_right_won": [],
+            "pairwise_2_ctr_draw": [],
+            "pairwise_2_rel": [],
+        }
+        for item in items:
+            position = item["rank"]
+            try:
+                prv_item = impressions[position - 1]
+            except IndexError:
+                prv_item = None
+            this_item = impressions[position]
+            try:
+                next_item = impressions[position + 1]
+            except IndexError:
+                next_item = None
+
+            for n, pair in ((1, (prv_item, this_item)), (2, (this_item, next_item))):
+                counts = self.pairs.row(self.pair_key(*pair))
+                left_won = counts[self.LEFT_WON + 1]
+                right_won = counts[self.RIGHT_WON + 1]
+                obs[f"pairwise_{n}_ctr_left_won"].append(left_won)
+                obs[f"pairwise_{n}_ctr_right_won"].append(right_won)
+                obs[f"pairwise_{n}_ctr_draw"].append(counts[self.DRAW + 1])
+                obs[f"pairwise_{n}_rel"].append(left_won / (right_won + 1))
         return obs
 
     def zipngram3(self, words, n=2):
@@ -1308,6 +1775,8 @@ class RankOfItemsFreshClickout:
     This class calculates rank of items that were clicked in the first 2 steps of the user history.
     """
 
+    features = ["average_fresh_rank", "average_fresh_rank_rel"]
+
     def __init__(self):
         self.action_types = ["clickout item"]
         self.positions = defaultdict(Counter)
@@ -1333,6 +1802,10 @@ class SequenceClickout:
     Similarity between current impression and the previous one
     """
 
+    user_local = True
+    features = ["item_was_in_prv_clickout", "item_clickouts_intersection"]
+    clickout_features = ["item_clickouts_intersection"]
+
     def __init__(self):
         self.action_types = ["clickout item"]
         self.last_impressions = {}
@@ -1342,11 +1815,14 @@ class SequenceClickout:
         self.last_impressions[row["user_id"]] = set(list(map(int, row["impressions"])))
 
     def get_stats(self, row, item):
+        return first_item_stats(self.get_stats_batch(row, [item]))
+
+    def get_stats_batch(self, row, items):
         impressions = set(list(map(int, row["impressions"])))
         obs = {}
         last_impressions = self.last_impressions.get(row["user_id"], set())
-        obs["item_was_in_prv_clickout"] = int(int(item["item_id"]) in last_impressions)
-        obs["item_clickouts_intersection"] = len(last_impressions & impressions)
+        obs["item_was_in_prv_clickout"] = [int(int(item["item_id"]) in last_impressions) for item in items]
+        obs["item_clickouts_intersection"] = [len(last_impressions & impressions)] * len(items)
         return obs
 
 
@@ -1355,23 +1831,29 @@ class SameImpressionsDifferentUser:
     If there was the same impression with the different user calculate CTR of the items
     """
 
+    features = ["same_impression_different_user_clicks", "same_impression_different_user_ctr"]
+
     def __init__(self):
         self.action_types = ["clickout item"]
-        # impressions -> (user, item)
-        self.impressions_clicks = defaultdict(list)
+        # impressions -> clicks of the items, per user too
+        self.impressions_clicks = KeyClicks()
 
     def update_acc(self, row: Dict):
         if row["reference"].isnumeric():
-            key = (row["user_id"], int(row["reference"]))
-            self.impressions_clicks[row["impressions_raw"]].append(key)
+            self.impressions_clicks.add(row["impressions_fp"], row["user_id"], int(row["reference"]))
 
     def get_stats(self, row, item):
+        return first_item_stats(self.get_stats_batch(row, [item]))
+
+    def get_stats_batch(self, row, items):
+        key = row["impressions_fp"]
+        all_clicks = self.impressions_clicks.other_users_clicks(key, row["user_id"])
+        clicks = [
+            self.impressions_clicks.other_users_item_clicks(key, row["user_id"], int(item["item_id"])) for item in items
+        ]
         obs = {}
-        key = (row["user_id"], int(item["item_id"]))
-        all_clicks = [it for user, it in self.impressions_clicks[row["impressions_raw"]] if user != row["user_id"]]
-        item_clicks = [it for it in all_clicks if it == int(item["item_id"])]
-        obs["same_impression_different_user_clicks"] = len(item_clicks)
-        obs["same_impression_different_user_ctr"] = len(item_clicks) / (len(all_clicks) + 1)
+        obs["same_impression_different_user_clicks"] = clicks
+        obs["same_impression_different_user_ctr"] = [n / (all_clicks + 1) for n in clicks]
         return obs
 
 
@@ -1384,26 +1866,36 @@ class SameImpressionsDifferentUserTopN:
     def __init__(self, topn=5):
         self.topn = topn
         self.action_types = ["clickout item"]
-        # impressions -> (user, item)
-        self.impressions_clicks = defaultdict(list)
+        # top impressions -> clicks of the items, per user too
+        self.impressions_clicks = KeyClicks()
+
+    @property
+    def features(self):
+        return [f"same_impression_different_user_clicks_{self.topn}", f"same_impression_different_user_ctr_{self.topn}"]
 
     def update_acc(self, row: Dict):
         if row["reference"].isnumeric():
-            impressions_str = self.extract_top_impressions(row)
-            key = (row["user_id"], int(row["reference"]))
-            self.impressions_clicks[impressions_str].append(key)
+            self.impressions_clicks.add(self.top_impressions_fp(row), row["user_id"], int(row["reference"]))
 
     def extract_top_impressions(self, row):
         return "|".join(row["impressions_raw"].split("|")[: self.topn])
 
+    def top_impressions_fp(self, row):
+        return fingerprint(self.extract_top_impressions(row))
+
     def get_stats(self, row, item):
+        return first_item_stats(self.get_stats_batch(row, [item]))
+
+    def get_stats_batch(self, row, items):
+        # the top impressions are the same for all the items
+        key = self.top_impressions_fp(row)
+        all_clicks = self.impressions_clicks.other_users_clicks(key, row["user_id"])
+        clicks = [
+            self.impressions_clicks.other_users_item_clicks(key, row["user_id"], int(item["item_id"])) for item in items
+        ]
         obs = {}
-        key = (row["user_id"], int(item["item_id"]))
-        impressions_str = self.extract_top_impressions(row)
-        all_clicks = [it for user, it in self.impressions_clicks[impressions_str] if user != row["user_id"]]
-        item_clicks = [it for it in all_clicks if it == int(item["item_id"])]
-        obs[f"same_impression_different_user_clicks_{self.topn}"] = len(item_clicks)
-        obs[f"same_impression_different_user_ctr_{self.topn}"] = len(item_clicks) / (len(all_clicks) + 1)
+        obs[f"same_impression_different_user_clicks_{self.topn}"] = clicks
+        obs[f"same_impression_different_user_ctr_{self.topn}"] = [n / (all_clicks + 1) for n in clicks]
         return obs
 
 
@@ -1412,23 +1904,29 @@ class SameFakeImpressionsDifferentUser:
     This is the same as SameImpressionsDifferentUser but we use all interactions to calculate the CTR
     """
 
+    features = ["same_fake_impression_different_user_clicks", "same_fake_impression_different_user_ctr"]
+
     def __init__(self):
         self.action_types = ACTIONS_WITH_ITEM_REFERENCE
-        # impressions -> (user, item)
-        self.impressions_clicks = defaultdict(list)
+        # fake impressions -> clicks of the items, per user too
+        self.impressions_clicks = KeyClicks()
 
     def update_acc(self, row: Dict):
         if row["reference"].isnumeric():
-            key = (row["user_id"], int(row["reference"]))
-            self.impressions_clicks[row["fake_impressions_raw"]].append(key)
+            self.impressions_clicks.add(row["fake_impressions_fp"], row["user_id"], int(row["reference"]))
 
     def get_stats(self, row, item):
+        return first_item_stats(self.get_stats_batch(row, [item]))
+
+    def get_stats_batch(self, row, items):
+        key = row["impressions_fp"]
+        all_clicks = self.impressions_clicks.other_users_clicks(key, row["user_id"])
+        clicks = [
+            self.impressions_clicks.other_users_item_clicks(key, row["user_id"], int(item["item_id"])) for item in items
+        ]
         obs = {}
-        key = (row["user_id"], int(item["item_id"]))
-        all_clicks = [it for user, it in self.impressions_clicks[row["impressions_raw"]] if user != row["user_id"]]
-        item_clicks = [it for it in all_clicks if it == int(item["item_id"])]
-        obs["same_fake_impression_different_user_clicks"] = len(item_clicks)
-        obs["same_fake_impression_different_user_ctr"] = len(item_clicks) / (len(all_clicks) + 1)
+        obs["same_fake_impression_different_user_clicks"] = clicks
+        obs["same_fake_impression_different_user_ctr"] = [n / (all_clicks + 1) for n in clicks]
         return obs
 
 
@@ -1439,49 +1937,56 @@ class RankBasedCTR:
     highest weight and surrounding ones with lower weights.
     """
 
-    def __init__(self):
+    features = ["rank_based_ctr"]
+    N_RANKS = 25
+
+    def __init__(self, state=None):
+        items = (state or SharedState()).interner("item_id")
         self.action_types = ["clickout item"]
-        self.item_rank_clicks = defaultdict(lambda: dict(zip(range(25), [0] * 25)))
-        self.item_rank_impressions = defaultdict(lambda: dict(zip(range(25), [0] * 25)))
+        self.item_rank_clicks = DenseCounter(items, width=self.N_RANKS)
+        self.item_rank_impressions = DenseCounter(items, width=self.N_RANKS)
 
     def update_acc(self, row: Dict):
         if not row["reference"].isnumeric():
             return
-        item_id = int(row["reference"])
         if row["index_clicked"] == -1000:
             return
-        impressions = list(map(int, row["impressions"]))
-        for rank, item_id in enumerate(impressions):
-            self.item_rank_impressions[item_id][rank] += 1
-        self.item_rank_clicks[item_id][row["index_clicked"]] += 1
+        # the ranks after the 25th are never read
+        impressions = row["impressions"][: self.N_RANKS]
+        self.item_rank_impressions.add_many(impressions, list(range(len(impressions))))
+        if row["index_clicked"] < self.N_RANKS:
+            # the click is counted for the last impression (the item_id left by the loop over the impressions)
+            self.item_rank_clicks.add(row["impressions"][-1], row["index_clicked"])
 
     def get_stats(self, row, item):
-        item_id = int(item["item_id"])
-        rank = int(item["rank"])
+        return first_item_stats(self.get_stats_batch(row, [item]))
+
+    def get_stats_batch(self, row, items):
         obs = {}
+        obs["rank_based_ctr"] = [self.rank_based_ctr(item["item_id"], int(item["rank"])) for item in items]
+        return obs
+
+    def rank_based_ctr(self, item_id, rank):
+        clicks = self.item_rank_clicks.row(item_id)
+        impressions = self.item_rank_impressions.row(item_id)
         if rank == 0:
-            obs["rank_based_ctr"] = (
-                (self.item_rank_clicks[item_id][0] + 1) / (self.item_rank_impressions[item_id][0] + 2) * 0.5
-                + (self.item_rank_clicks[item_id][1] + 1) / (self.item_rank_impressions[item_id][1] + 2) * 0.3
-                + (self.item_rank_clicks[item_id][2] + 1) / (self.item_rank_impressions[item_id][2] + 2) * 0.2
+            return (
+                (clicks[0] + 1) / (impressions[0] + 2) * 0.5
+                + (clicks[1] + 1) / (impressions[1] + 2) * 0.3
+                + (clicks[2] + 1) / (impressions[2] + 2) * 0.2
             )
         elif rank == 24:
-            obs["rank_based_ctr"] = (
-                (self.item_rank_clicks[item_id][24] + 1) / (self.item_rank_impressions[item_id][24] + 2) * 0.5
-                + (self.item_rank_clicks[item_id][23] + 1) / (self.item_rank_impressions[item_id][23] + 2) * 0.3
-                + (self.item_rank_clicks[item_id][22] + 1) / (self.item_rank_impressions[item_id][22] + 2) * 0.2
+            return (
+                (clicks[24] + 1) / (impressions[24] + 2) * 0.5
+                + (clicks[23] + 1) / (impressions[23] + 2) * 0.3
+                + (clicks[22] + 1) / (impressions[22] + 2) * 0.2
             )
         else:
-            obs["rank_based_ctr"] = (
-                (self.item_rank_clicks[item_id][rank - 1] + 1)
-                / (self.item_rank_impressions[item_id][rank - 1] + 2)
-                * 0.25
-                + (self.item_rank_clicks[item_id][rank] + 1) / (self.item_rank_impressions[item_id][rank] + 2) * 0.5
-                + (self.item_rank_clicks[item_id][rank + 1] + 1)
-                / (self.item_rank_impressions[item_id][rank + 1] + 2)
-                * 0.25
+            return (
+                (clicks[rank - 1] + 1) / (impressions[rank - 1] + 2) * 0.25
+                + (clicks[rank] + 1) / (impressions[rank] + 2) * 0.5
+                + (clicks[rank + 1] + 1) / (impressions[rank + 1] + 2) * 0.25
             )
-        return obs
 
 
 class AccByKey:
@@ -1497,8 +2002,17 @@ class AccByKey:
         self.key = key
         self.base_acc = base_acc
         self.action_types = base_acc.action_types
+        self.user_local = getattr(base_acc, "user_local", False)
         self.accs_by_key = {}
 
+    @property
+    def features(self):
+        return [f"{name}_by_{self.key}" for name in accumulator_features(self.base_acc)]
+
+    @property
+    def clickout_features(self):
+        return [f"{name}_by_{self.key}" for name in accumulator_clickout_features(self.base_acc)]
+
     def update_acc(self, row: Dict):
         row["platform_device"] = row["platform"] + row["device"]
         if row[self.key] not in self.accs_by_key:
@@ -1518,55 +2032,153 @@ class AccByKey:
         del row["platform_device"]
         return obs
 
+    def get_stats_batch(self, row, items):
+        if not hasattr(self.base_acc, "get_stats_batch"):
+            return transpose_stats([self.get_stats(row, item) for item in items])
+        row["platform_device"] = row["platform"] + row["device"]
+        acc = self.accs_by_key.get(row[self.key], self.base_acc)
+        obs = {f"{k}_by_{self.key}": values for k, values in acc.get_stats_batch(row, items).items()}
+        del row["platform_device"]
+        return obs
+
+    def get_state(self):
+        return {key: get_state(acc) for key, acc in self.accs_by_key.items()}
+
+    def set_state(self, state):
+        self.accs_by_key = {}
+        for key, acc_state in state.items():
+            self.accs_by_key[key] = deepcopy(self.base_acc)
+            set_state(self.accs_by_key[key], acc_state)
+
+
+def get_state(acc):
+    """
+    Returns the picklable state of the accumulator (for the checkpoints).
+    The functions (updater, get_stats_func...) and the artifacts loaded from the disk are not part of the state,
+    they are recreated when the accumulator is created. Neither are the shared state components, they are saved
+    separately (see shared_components).
+    """
+    if hasattr(acc, "get_state"):
+        return acc.get_state()
+    skip = tuple(getattr(acc, "artifacts", ())) + tuple(getattr(acc, "components", ()))
+    return {k: v for k, v in vars(acc).items() if k not in skip and not callable(v)}
+
+
+def set_state(acc, state):
+    if hasattr(acc, "set_state"):
+        acc.set_state(state)
+        return
+    for k, v in state.items():
+        setattr(acc, k, v)
+
 
-def group_accumulators(accumulators):
+def group_accumulators(accumulators, components=None):
+    """
+    The shared state components of the accumulators (by default shared_components) go first,
+    so they are updated once per event
+    """
+    if components is None:
+        components = shared_components(accumulators)
     accs_by_action_type = defaultdict(list)
-    for acc in accumulators:
+    for acc in list(components) + list(accumulators):
         for action_type in acc.action_types:
             accs_by_action_type[action_type].append(acc)
     return accs_by_action_type
 
 
-def get_accumulators(hashn=None):
+def split_user_local_accumulators(accumulators):
+    user_local = [acc for acc in accumulators if getattr(acc, "user_local", False)]
+    other = [acc for acc in accumulators if not getattr(acc, "user_local", False)]
+    return user_local, other
+
+
+def accumulator_features(acc):
+    """
+    Names of the features the accumulator emits: its features attribute or its name
+    """
+    return list(acc.features) if hasattr(acc, "features") else [acc.name]
+
+
+def accumulator_clickout_features(acc):
+    """
+    Names of the features of the accumulator which depend only on the clickout and not on the item
+    (the clickout_features attribute)
+    """
+    return list(getattr(acc, "clickout_features", ()))
+
+
+def is_clickout_scope(acc):
+    """
+    True if none of the features of the accumulator depends on the item, get_stats can be called once per clickout
+    """
+    clickout_features = accumulator_clickout_features(acc)
+    return bool(clickout_features) and set(clickout_features) >= set(accumulator_features(acc))
+
+
+def feature_lineage(accumulators):
+    """
+    Maps every feature name to the accumulator which emits it
+    """
+    return {feature: acc for acc in accumulators for feature in accumulator_features(acc)}
+
+
+def select_accumulators(accumulators, features):
+    """
+    Keeps only the accumulators which emit at least one of the features
+    """
+    features = set(features)
+    return [acc for acc in accumulators if features.intersection(accumulator_features(acc))]
+
+
+def get_accumulators(hashn=None, features=None):
+    state = SharedState()
     accumulators = [
         StatsAcc(
             name="identical_impressions_item_clicks",
             action_types=["clickout item"],
-            acc=defaultdict(lambda: defaultdict(int)),
-            updater=lambda acc, row: add_one_nested_key(acc, row["impressions_hash"], row["reference"]),
-            get_stats_func=lambda acc, row, item: acc[row["impressions_hash"]][item["item_id"]],
+            acc=defaultdict(int_defaultdict),
+            updater=lambda acc, row: add_one_nested_key(acc, row["impressions_set_fp"], row["reference"]),
+            get_stats_func=lambda acc, row, item: acc[row["impressions_set_fp"]][item["item_id"]],
         ),
         StatsAcc(
             name="identical_impressions_item_clicks2",
             action_types=["clickout item"],
-            acc=defaultdict(lambda: defaultdict(int)),
-            updater=lambda acc, row: add_one_nested_key(acc, row["impressions_raw"], row["reference"]),
-            get_stats_func=lambda acc, row, item: acc[row["impressions_raw"]][item["item_id"]],
+            acc=defaultdict(int_defaultdict),
+            updater=lambda acc, row: add_one_nested_key(acc, row["impressions_fp"], row["reference"]),
+            get_stats_func=lambda acc, row, item: acc[row["impressions_fp"]][item["item_id"]],
         ),
         StatsAcc(
             name="is_impression_the_same",
+            scope="clickout",
             action_types=["clickout item"],
-            acc=defaultdict(str),
-            updater=lambda acc, row: set_key(acc, row["user_id"], row["impressions_hash"]),
-            get_stats_func=lambda acc, row, item: acc.get(row["user_id"]) == row["impressions_hash"],
+            user_local=True,
+            acc=defaultdict(int),
+            updater=lambda acc, row: set_key(acc, row["user_id"], row["impressions_set_fp"]),
+            get_stats_func=lambda acc, row, item: acc.get(row["user_id"]) == row["impressions_set_fp"],
         ),
         StatsAcc(
             name="last_10_actions",
+            scope="clickout",
             action_types=ALL_ACTIONS,
+            user_local=True,
             acc=defaultdict(list),
             updater=lambda acc, row: append_to_list(acc, row["user_id"], ACTION_SHORTENER[row["action_type"]]),
             get_stats_func=lambda acc, row, item: "".join(["q"] + acc[row["user_id"]] + ["x"]),
         ),
         StatsAcc(
             name="last_sort_order",
+            scope="clickout",
             action_types=["change of sort order"],
+            user_local=True,
             acc={},
             updater=lambda acc, row: set_key(acc, row["user_id"], row["reference"]),
             get_stats_func=lambda acc, row, item: acc.get(row["user_id"], "UNK"),
         ),
         StatsAcc(
             name="last_filter_selection",
+            scope="clickout",
             action_types=["filter selection"],
+            user_local=True,
             acc={},
             updater=lambda acc, row: set_key(acc, row["user_id"], row["reference"]),
             get_stats_func=lambda acc, row, item: acc.get(row["user_id"], "UNK"),
@@ -1574,6 +2186,7 @@ def get_accumulators(hashn=None):
         StatsAcc(
             name="last_item_index",
             action_types=["clickout item"],
+            user_local=True,
             acc=defaultdict(list),
             updater=lambda acc, row: append_to_list_not_null(acc, row["user_id"], row["index_clicked"]),
             get_stats_func=lambda acc, row, item: acc[row["user_id"]][-1] - item["rank"]
@@ -1583,6 +2196,7 @@ def get_accumulators(hashn=None):
         StatsAcc(
             name="last_item_fake_index",
             action_types=ACTIONS_WITH_ITEM_REFERENCE,
+            user_local=True,
             acc=defaultdict(list),
             updater=lambda acc, row: append_to_list_not_null(acc, row["user_id"], row["fake_index_interacted"]),
             get_stats_func=lambda acc, row, item: acc[row["user_id"]][-1] - item["rank"]
@@ -1592,37 +2206,42 @@ def get_accumulators(hashn=None):
         StatsAcc(
             name="last_clicked_item_position_same_view",
             action_types=["clickout item"],
+            user_local=True,
             acc={},
-            updater=lambda acc, row: set_key(acc, (row["user_id"], row["impressions_raw"]), row["index_clicked"]),
+            updater=lambda acc, row: set_key(acc, (row["user_id"], row["impressions_fp"]), row["index_clicked"]),
             get_stats_func=lambda acc, row, item: item["rank"]
-            - acc.get((row["user_id"], row["impressions_raw"]), -1000),
+            - acc.get((row["user_id"], row["impressions_fp"]), -1000),
         ),
         StatsAcc(
             name="last_item_index_same_view",
             action_types=["clickout item"],
+            user_local=True,
             acc=defaultdict(list),
             updater=lambda acc, row: append_to_list_not_null(
-                acc, (row["user_id"], row["impressions_raw"]), row["index_clicked"]
+                acc, (row["user_id"], row["impressions_fp"]), row["index_clicked"]
             ),
-            get_stats_func=lambda acc, row, item: acc[(row["user_id"], row["impressions_raw"])][-1] - item["rank"]
-            if acc[(row["user_id"], row["impressions_raw"])]
+            get_stats_func=lambda acc, row, item: acc[(row["user_id"], row["impressions_fp"])][-1] - item["rank"]
+            if acc[(row["user_id"], row["impressions_fp"])]
             else -1000,
         ),
         StatsAcc(
             name="last_item_index_same_fake_view",
             action_types=ACTIONS_WITH_ITEM_REFERENCE,
+            user_local=True,
             acc=defaultdict(list),
             updater=lambda acc, row: append_to_list_not_null(
-                acc, (row["user_id"], row["fake_impressions_raw"]), row["fake_index_interacted"]
+                acc, (row["user_id"], row["fake_impressions_fp"]), row["fake_index_interacted"]
             ),
-            get_stats_func=lambda acc, row, item: acc[(row["user_id"], row["fake_impressions_raw"])][-1] - item["rank"]
-            if acc[(row["user_id"], row["fake_impressions_raw"])]
+            get_stats_func=lambda acc, row, item: acc[(row["user_id"], row["fake_impressions_fp"])][-1] - item["rank"]
+            if acc[(row["user_id"], row["fake_impressions_fp"])]
             else -1000,
         ),
         StatsAcc(
             name="last_event_ts",
+            scope="clickout",
             action_types=ALL_ACTIONS,
-            acc=defaultdict(lambda: defaultdict(int)),
+            user_local=True,
+            acc=defaultdict(int_defaultdict),
             updater=lambda acc, row: set_nested_key(
                 acc, row["user_id"], ACTION_SHORTENER[row["action_type"]], row["timestamp"]
             ),
@@ -1630,10 +2249,12 @@ def get_accumulators(hashn=None):
         ),
         StatsAcc(
             name="last_item_clickout",
+            scope="clickout",
             action_types=["clickout item"],
-            acc={},
-            updater=lambda acc, row: set_key(acc, row["user_id"], row["reference"]),
-            get_stats_func=lambda acc, row, item: acc.get(row["user_id"], 0),
+            user_local=True,
+            acc=state.get("last_user_clickout"),
+            updater=None,
+            get_stats_func=lambda acc, row, item: acc.item.get(row["user_id"], 0),
         ),
         # item ctr
         ItemCTR(action_types=["clickout item"]),
@@ -1654,22 +2275,25 @@ def get_accumulators(hashn=None):
         StatsAcc(
             name="clickout_user_item_clicks",
             action_types=["clickout item"],
-            acc=defaultdict(int),
+            user_local=True,
+            acc=state.packed_dict(("user_id", "item_id"), (32, 31), int),
             updater=lambda acc, row: increment_key_by_one(acc, (row["user_id"], row["reference"])),
-            get_stats_func=lambda acc, row, item: acc[(row["user_id"], item["item_id"])],
+            get_stats_func=lambda acc, row, item: acc.get((row["user_id"], item["item_id"]), 0),
         ),
         StatsAcc(
             name="clickout_user_item_impressions",
             action_types=["clickout item"],
-            acc=defaultdict(int),
+            user_local=True,
+            acc=state.packed_dict(("user_id", "item_id"), (32, 31), int),
             updater=lambda acc, row: increment_keys_by_one(
                 acc, [(row["user_id"], item_id) for item_id in row["impressions"]]
             ),
-            get_stats_func=lambda acc, row, item: acc[(row["user_id"], item["item_id"])],
+            get_stats_func=lambda acc, row, item: acc.get((row["user_id"], item["item_id"]), 0),
         ),
         StatsAcc(
             name="was_interaction_img",
             action_types=["interaction item image"],
+            user_local=True,
             acc={},
             updater=lambda acc, row: set_key(acc, row["user_id"], row["reference"]),
             get_stats_func=lambda acc, row, item: int(acc.get(row["user_id"]) == item["item_id"]),
@@ -1677,21 +2301,24 @@ def get_accumulators(hashn=None):
         StatsAcc(
             name="interaction_img_diff_ts",
             action_types=["interaction item image"],
+            user_local=True,
             acc={},
             updater=lambda acc, row: set_key(acc, (row["user_id"], row["reference"]), row["timestamp"]),
-            get_stats_func=lambda acc, row, item: acc.get((row["user_id"], item["item_id"]), item["timestamp"])
-            - item["timestamp"],
+            get_stats_func=lambda acc, row, item: acc.get((row["user_id"], item["item_id"]), row["timestamp"])
+            - row["timestamp"],
         ),
         StatsAcc(
             name="interaction_img_freq",
             action_types=["interaction item image"],
-            acc=defaultdict(int),
+            user_local=True,
+            acc=state.packed_dict(("user_id", "item_id"), (32, 31), int),
             updater=lambda acc, row: increment_key_by_one(acc, (row["user_id"], row["reference"])),
-            get_stats_func=lambda acc, row, item: acc[(row["user_id"], item["item_id"])],
+            get_stats_func=lambda acc, row, item: acc.get((row["user_id"], item["item_id"]), 0),
         ),
         StatsAcc(
             name="was_interaction_deal",
             action_types=["interaction item deals"],
+            user_local=True,
             acc={},
             updater=lambda acc, row: set_key(acc, row["user_id"], row["reference"]),
             get_stats_func=lambda acc, row, item: int(acc.get(row["user_id"]) == item["item_id"]),
@@ -1699,13 +2326,15 @@ def get_accumulators(hashn=None):
         StatsAcc(
             name="interaction_deal_freq",
             action_types=["interaction item deals"],
-            acc=defaultdict(int),
+            user_local=True,
+            acc=state.packed_dict(("user_id", "item_id"), (32, 31), int),
             updater=lambda acc, row: increment_key_by_one(acc, (row["user_id"], row["reference"])),
-            get_stats_func=lambda acc, row, item: acc[(row["user_id"], item["item_id"])],
+            get_stats_func=lambda acc, row, item: acc.get((row["user_id"], item["item_id"]), 0),
         ),
         StatsAcc(
             name="was_interaction_rating",
             action_types=["interaction item rating"],
+            user_local=True,
             acc={},
             updater=lambda acc, row: set_key(acc, row["user_id"], row["reference"]),
             get_stats_func=lambda acc, row, item: int(acc.get(row["user_id"]) == item["item_id"]),
@@ -1713,13 +2342,15 @@ def get_accumulators(hashn=None):
         StatsAcc(
             name="interaction_rating_freq",
             action_types=["interaction item rating"],
-            acc=defaultdict(int),
+            user_local=True,
+            acc=state.packed_dict(("user_id", "item_id"), (32, 31), int),
             updater=lambda acc, row: increment_key_by_one(acc, (row["user_id"], row["reference"])),
-            get_stats_func=lambda acc, row, item: acc[(row["user_id"], item["item_id"])],
+            get_stats_func=lambda acc, row, item: acc.get((row["user_id"], item["item_id"]), 0),
         ),
         StatsAcc(
             name="was_interaction_info",
             action_types=["interaction item info"],
+            user_local=True,
             acc={},
             updater=lambda acc, row: set_key(acc, row["user_id"], row["reference"]),
             get_stats_func=lambda acc, row, item: int(acc.get(row["user_id"]) == item["item_id"]),
@@ -1727,66 +2358,77 @@ def get_accumulators(hashn=None):
         StatsAcc(
             name="interaction_info_freq",
             action_types=["interaction item info"],
-            acc=defaultdict(int),
+            user_local=True,
+            acc=state.packed_dict(("user_id", "item_id"), (32, 31), int),
             updater=lambda acc, row: increment_key_by_one(acc, (row["user_id"], row["reference"])),
-            get_stats_func=lambda acc, row, item: acc[(row["user_id"], item["item_id"])],
+            get_stats_func=lambda acc, row, item: acc.get((row["user_id"], item["item_id"]), 0),
         ),
         StatsAcc(
             name="was_item_searched",
             action_types=["search for item"],
+            user_local=True,
             acc={},
             updater=lambda acc, row: set_key(acc, row["user_id"], row["reference"]),
             get_stats_func=lambda acc, row, item: int(acc.get(row["user_id"]) == item["item_id"]),
         ),
         StatsAcc(
             name="user_item_interactions_list",
+            scope="clickout",
             action_types=ACTIONS_WITH_ITEM_REFERENCE,
-            acc=defaultdict(set),
-            updater=lambda acc, row: add_to_set(acc, row["user_id"], tryint(row["reference"])),
-            get_stats_func=lambda acc, row, item: list(acc.get(row["user_id"], [])),
+            user_local=True,
+            acc=state.get("user_item_interactions"),
+            updater=None,
+            get_stats_func=lambda acc, row, item: list(acc.by_user.get(row["user_id"], [])),
         ),
         StatsAcc(
             name="user_item_session_interactions_list",
+            scope="clickout",
             action_types=ACTIONS_WITH_ITEM_REFERENCE,
-            acc=defaultdict(set),
-            updater=lambda acc, row: add_to_set(acc, (row["user_id"], row["session_id"]), tryint(row["reference"])),
-            get_stats_func=lambda acc, row, item: list(acc.get((row["user_id"], row["session_id"]), [])),
+            user_local=True,
+            acc=state.get("user_item_interactions"),
+            updater=None,
+            get_stats_func=lambda acc, row, item: list(acc.by_session.get((row["user_id"], row["session_id"]), [])),
         ),
         StatsAcc(
             name="user_rank_preference",
             action_types=["clickout item"],
-            acc=defaultdict(int),
+            user_local=True,
+            acc=state.packed_dict(("user_id", "rank"), (32, 31), int),
             updater=lambda acc, row: increment_key_by_one(acc, (row["user_id"], row["index_clicked"])),
-            get_stats_func=lambda acc, row, item: acc[(row["user_id"], item["rank"])],
+            get_stats_func=lambda acc, row, item: acc.get((row["user_id"], item["rank"]), 0),
         ),
         StatsAcc(
             name="user_fake_rank_preference",
             action_types=ACTIONS_WITH_ITEM_REFERENCE,
-            acc=defaultdict(int),
+            user_local=True,
+            acc=state.packed_dict(("user_id", "rank"), (32, 31), int),
             updater=lambda acc, row: increment_key_by_one(acc, (row["user_id"], row["fake_index_interacted"])),
-            get_stats_func=lambda acc, row, item: acc[(row["user_id"], item["rank"])],
+            get_stats_func=lambda acc, row, item: acc.get((row["user_id"], item["rank"]), 0),
         ),
         StatsAcc(
             name="user_session_rank_preference",
             action_types=["clickout item"],
-            acc=defaultdict(int),
+            user_local=True,
+            acc=state.packed_dict(("user_id", "session_id", "rank"), (24, 31, 8), int),
             updater=lambda acc, row: increment_key_by_one(
                 acc, (row["user_id"], row["session_id"], row["index_clicked"])
             ),
-            get_stats_func=lambda acc, row, item: acc[(row["user_id"], row["session_id"], item["rank"])],
+            get_stats_func=lambda acc, row, item: acc.get((row["user_id"], row["session_id"], item["rank"]), 0),
         ),
         StatsAcc(
             name="user_impression_rank_preference",
             action_types=["clickout item"],
-            acc=defaultdict(int),
+            user_local=True,
+            acc=state.packed_dict(("user_id", "impressions", "rank"), (24, 31, 8), int),
             updater=lambda acc, row: increment_key_by_one(
-                acc, (row["user_id"], row["impressions_hash"], row["index_clicked"])
+                acc, (row["user_id"], row["impressions_set_fp"], row["index_clicked"])
             ),
-            get_stats_func=lambda acc, row, item: acc[(row["user_id"], row["impressions_hash"], item["rank"])],
+            get_stats_func=lambda acc, row, item: acc.get((row["user_id"], row["impressions_set_fp"], item["rank"]), 0),
         ),
         StatsAcc(
             name="interaction_item_image_item_last_timestamp",
             action_types=["interaction item image"],
+            user_local=True,
             acc={},
             updater=lambda acc, row: set_key(
                 acc, (row["user_id"], row["reference"], "interaction item image"), row["timestamp"]
@@ -1798,6 +2440,7 @@ def get_accumulators(hashn=None):
         StatsAcc(
             name="clickout_item_item_last_timestamp",
             action_types=["clickout item"],
+            user_local=True,
             acc={},
             updater=lambda acc, row: set_key(
                 acc, (row["user_id"], row["reference"], "clickout item"), row["timestamp"]
@@ -1808,44 +2451,46 @@ def get_accumulators(hashn=None):
         ),
         StatsAcc(
             name="last_timestamp_clickout",
+            scope="clickout",
             action_types=["clickout item"],
+            user_local=True,
             acc={},
-            updater=lambda acc, row: set_key(acc, (row["user_id"], row["impressions_raw"]), row["timestamp"]),
+            updater=lambda acc, row: set_key(acc, (row["user_id"], row["impressions_fp"]), row["timestamp"]),
             get_stats_func=lambda acc, row, item: row["timestamp"]
-            - acc.get((row["user_id"], item["impressions_raw"]), 0),
+            - acc.get((row["user_id"], row["impressions_fp"]), 0),
         ),
         ClickProbabilityClickOffsetTimeOffset(action_types=["clickout item"]),
         ClickProbabilityClickOffsetTimeOffset(
             name="fake_clickout_prob_time_position_offset",
             action_types=ACTIONS_WITH_ITEM_REFERENCE,
-            impressions_type="fake_impressions_raw",
+            impressions_type="fake_impressions_fp",
             index_col="fake_index_interacted",
         ),
-        SimilarityFeatures("imm", hashn=0),
-        SimilarityFeatures("imm", hashn=1),
-        SimilarityFeatures("imm", hashn=2),
-        SimilarityFeatures("poi", hashn=0),
-        SimilarityFeatures("poi", hashn=1),
-        SimilarityFeatures("poi", hashn=2),
-        SimilarityFeatures("price", hashn=0),
-        SimilarityFeatures("price", hashn=1),
+        SimilarityFeatures("imm", hashn=0, state=state),
+        SimilarityFeatures("imm", hashn=1, state=state),
+        SimilarityFeatures("imm", hashn=2, state=state),
+        SimilarityFeatures("poi", hashn=0, state=state),
+        SimilarityFeatures("poi", hashn=1, state=state),
+        SimilarityFeatures("poi", hashn=2, state=state),
+        SimilarityFeatures("price", hashn=0, state=state),
+        SimilarityFeatures("price", hashn=1, state=state),
         PoiFeatures(),
         ItemLastClickoutStatsInSession(),
         # ItemAttentionSpan(),
         IndicesFeatures(
-            action_types=["clickout item"], prefix="", impressions_type="impressions_raw", index_key="index_clicked"
+            action_types=["clickout item"], prefix="", impressions_type="impressions_fp", index_key="index_clicked"
         ),
         IndicesFeatures(
             action_types=list(ACTIONS_WITH_ITEM_REFERENCE),
             prefix="fake_",
-            impressions_type="fake_impressions_raw",
+            impressions_type="fake_impressions_fp",
             index_key="fake_index_interacted",
         ),
         PriceFeatures(),
         PriceSimilarity(),
-        SimilarUsersItemInteraction(),
-        MostSimilarUserItemInteraction(),
-        GlobalTimestampPerItem(),
+        SimilarUsersItemInteraction(state=state),
+        MostSimilarUserItemInteraction(state=state),
+        GlobalTimestampPerItem(state=state),
         ClickSequenceFeatures(),
         FakeClickSequenceFeatures(),
         TimeSinceSessionStart(),
@@ -1853,7 +2498,7 @@ def get_accumulators(hashn=None):
         NumberOfSessions(),
         AllFilters(),
         ItemCTRInSequence(),
-        ItemCTRRankWeighted(),
+        ItemCTRRankWeighted(state=state),
         Last10Actions(),
         PriceSorted(),
         ActionsTracker(),
@@ -1861,9 +2506,9 @@ def get_accumulators(hashn=None):
         DistinctInteractions(name="interact", action_types=ACTIONS_WITH_ITEM_REFERENCE),
         PairwiseCTR(),
         RankOfItemsFreshClickout(),
-        GlobalClickoutTimestamp(),
+        GlobalClickoutTimestamp(state=state),
         SequenceClickout(),
-        RankBasedCTR(),
+        RankBasedCTR(state=state),
         ItemAverageRank(),
         UserItemAttentionSpan(),
         SameImpressionsDifferentUser(),
@@ -1875,7 +2520,9 @@ def get_accumulators(hashn=None):
     ] + [
         StatsAcc(
             name="{}_count".format(action_type.replace(" ", "_")),
+            scope="clickout",
             action_types=[action_type],
+            user_local=True,
             acc=defaultdict(int),
             updater=lambda acc, row: increment_key_by_one(acc, (row["user_id"], action_type)),
             get_stats_func=lambda acc, row, item: acc.get((row["user_id"], action_type), 0),
@@ -1887,4 +2534,8 @@ def get_accumulators(hashn=None):
         accumulators = [acc for i, acc in enumerate(accumulators) if i % 8 == hashn]
         print("N acc", hashn, len(accumulators))
 
+    if features is not None:
+        accumulators = select_accumulators(accumulators, features)
+        print("N acc for the requested features", len(accumulators))
+
     return accumulators
@@ -1,3 +1,23 @@
+from collections import defaultdict
+
+
+# picklable default factories (lambdas can't be pickled in the checkpoints)
+def int_defaultdict():
+    return defaultdict(int)
+
+
+def list_defaultdict():
+    return defaultdict(list)
+
+
+def unknown():
+    return "UNK"
+
+
+def zero_per_rank():
+    return dict(zip(range(25), [0] * 25))
+
+
 def increment_key_by_one(acc, key):
     acc[key] += 1
     return acc
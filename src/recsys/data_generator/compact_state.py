@@ -0,0 +1,226 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from itertools import accumulate
+
+import numpy as np
+
+from recsys.data_generator.event_store import Vocabulary
+
+
+class Interner(Vocabulary):
+    """
+    Vocabulary shared by the state tables of the accumulators, every id (user_id, item_id...) is stored once
+    and the tables keep only its dense integer code. An interner without a name belongs to a single table.
+    """
+
+    def __init__(self, name=None):
+        super().__init__()
+        self.name = name
+
+    def lookup(self, value):
+        return self.codes.get(value)
+
+    def tables(self):
+        return [self.codes, self.values]
+
+
+class PackedDict:
+    """
+    Replaces a dict keyed by tuples like (user_id, item_id) or (user_id, session_id, rank).
+    Every field of the key is interned and the codes are packed into one int64 (bits per field, at most 63 in total),
+    so the table holds no tuples and no strings. Missing keys behave like in a defaultdict(default_factory).
+    """
+
+    def __init__(self, interners, bits, default_factory=None):
+        if sum(bits) > 63 or len(bits) != len(interners):
+            raise ValueError("A key needs one bit width per field and at most 63 bits in total")
+        self.interners = interners
+        self.bits = bits
+        self.default_factory = default_factory
+        self.values = {}
+
+    def pack(self, key, add=True):
+        """
+        Returns the packed key, None if a field was never seen and add is False
+        """
+        packed = 0
+        for value, interner, bits in zip(key, self.interners, self.bits):
+            code = interner.encode(value) if add else interner.lookup(value)
+            if code is None:
+                return None
+            if code >> bits:
+                raise OverflowError("More than 2 ** %d distinct values in a key field" % bits)
+            packed = (packed << bits) | code
+        return packed
+
+    def unpack(self, packed):
+        key = []
+        for interner, bits in zip(reversed(self.interners), reversed(self.bits)):
+            key.append(interner.decode(packed & ((1 << bits) - 1)))
+            packed >>= bits
+        return tuple(reversed(key))
+
+    def __getitem__(self, key):
+        packed = self.pack(key)
+        if packed in self.values:
+            return self.values[packed]
+        if self.default_factory is None:
+            raise KeyError(key)
+        value = self.values[packed] = self.default_factory()
+        return value
+
+    def __setitem__(self, key, value):
+        self.values[self.pack(key)] = value
+
+    def __contains__(self, key):
+        packed = self.pack(key, add=False)
+        return packed is not None and packed in self.values
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, key, default=None):
+        packed = self.pack(key, add=False)
+        return default if packed is None else self.values.get(packed, default)
+
+    def tables(self):
+        return [self.values]
+
+    def to_dict(self):
+        """
+        The table as the dict keyed by tuples it replaces
+        """
+        return {self.unpack(packed): value for packed, value in self.values.items()}
+
+
+class DenseCounter:
+    """
+    Counters of the keys (items) indexed by the dense code of the key: row code of a numpy array with width
+    counters per key. The array grows by doubling.
+    """
+
+    def __init__(self, interner, width=1, capacity=1024):
+        self.interner = interner
+        self.width = width
+        self.counts = np.zeros((capacity, width), dtype=np.int64)
+
+    def _code(self, key):
+        code = self.interner.encode(key)
+        if code >= len(self.counts):
+            counts = np.zeros((max(2 * len(self.counts), code + 1), self.width), dtype=np.int64)
+            counts[: len(self.counts)] = self.counts
+            self.counts = counts
+        return code
+
+    def add(self, key, column=0, n=1):
+        # the code first, it can grow (replace) the array
+        code = self._code(key)
+        self.counts[code, column] += n
+
+    def add_many(self, keys, columns=0, n=1):
+        """
+        Adds n (a number or one per key) to the column (one per key) of every key, the keys can repeat
+        """
+        if not keys:
+            return
+        codes = [self._code(key) for key in keys]
+        np.add.at(self.counts, (codes, columns), n)
+
+    def get(self, key, column=0):
+        code = self.interner.lookup(key)
+        if code is None or code >= len(self.counts):
+            return 0
+        return int(self.counts[code, column])
+
+    def row(self, key):
+        """
+        All the counters of the key as python ints
+        """
+        code = self.interner.lookup(key)
+        if code is None or code >= len(self.counts):
+            return [0] * self.width
+        return self.counts[code].tolist()
+
+    def __len__(self):
+        return min(len(self.interner), len(self.counts))
+
+    def tables(self):
+        return [self.counts] if self.interner.name else [self.counts, self.interner]
+
+    def to_dict(self):
+        """
+        The counters as the dict (of dicts per column if width > 1) they replace
+        """
+        n = len(self)
+        if self.width == 1:
+            return dict(zip(self.interner.values[:n], self.counts[:n, 0].tolist()))
+        return {key: dict(enumerate(row)) for key, row in zip(self.interner.values[:n], self.counts[:n].tolist())}
+
+
+class SortedSums:
+    """
+    Sorted values (a multiset, a set if unique) with their prefix sums, so the sum of the absolute differences
+    of all the values to x takes two bisections. Adding a value shifts the sums after it.
+    """
+
+    def __init__(self, unique=False):
+        self.unique = unique
+        self.values = []
+        self.sums = [0]
+
+    @classmethod
+    def from_values(cls, values, unique=False):
+        sorted_sums = cls(unique)
+        sorted_sums.values = sorted(set(values) if unique else values)
+        sorted_sums.sums = [0] + list(accumulate(sorted_sums.values))
+        return sorted_sums
+
+    def add(self, value):
+        i = bisect_left(self.values, value)
+        if self.unique and i < len(self.values) and self.values[i] == value:
+            return
+        self.values.insert(i, value)
+        self.sums[i + 1 :] = [total + value for total in self.sums[i:]]
+
+    def __len__(self):
+        return len(self.values)
+
+    def abs_diffs(self, x):
+        """
+        sum(abs(value - x) for value in values)
+        """
+        lo = bisect_left(self.values, x)
+        hi = bisect_right(self.values, x)
+        return (x * lo - self.sums[lo]) + (self.sums[-1] - self.sums[hi] - x * (len(self.values) - hi))
+
+
+class KeyClicks:
+    """
+    Clicks of the items per key (an impression list): in total, per item, per user and per (user, item).
+    The clicks of all the other users are two subtractions instead of a scan of the list of the (user, item) clicks
+    of the key, one entry per distinct (key, user, item).
+    """
+
+    def __init__(self):
+        self.clicks = defaultdict(int)
+        self.item_clicks = defaultdict(int)
+        self.user_clicks = defaultdict(int)
+        self.user_item_clicks = defaultdict(int)
+
+    def add(self, key, user_id, item_id):
+        self.clicks[key] += 1
+        self.item_clicks[(key, item_id)] += 1
+        self.user_clicks[(key, user_id)] += 1
+        self.user_item_clicks[(key, user_id, item_id)] += 1
+
+    def other_users_clicks(self, key, user_id):
+        return self.clicks.get(key, 0) - self.user_clicks.get((key, user_id), 0)
+
+    def other_users_item_clicks(self, key, user_id, item_id):
+        return self.item_clicks.get((key, item_id), 0) - self.user_item_clicks.get((key, user_id, item_id), 0)
+
+    def __len__(self):
+        return len(self.user_item_clicks)
+
+    def tables(self):
+        return [self.clicks, self.item_clicks, self.user_clicks, self.user_item_clicks]
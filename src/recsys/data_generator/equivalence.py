@@ -0,0 +1,326 @@
+import json
+import os
+import tempfile
+import time
+from csv import DictReader
+from itertools import islice
+
+import click
+import numpy as np
+import pandas as pd
+
+import sys
+sys.path.append('/Users/josang-yeon/2020/tobigs/tobigs_reco_conf/recsys2019/src')
+from recsys.data_generator.accumulators import get_accumulators, logger, split_user_local_accumulators
+from recsys.data_generator.feature_store import PART_META, FeatureStore, read_parquet_frame, read_split
+from recsys.data_generator.generate_data_sharded import join_user_shards
+from recsys.data_generator.generate_training_data import CsvWriter, FeatureGenerator, load_event_store
+
+
+class PerItemFeatureGenerator(FeatureGenerator):
+    """
+    Calls get_stats for every item even if the accumulator has get_stats_batch or the clickout scope
+    (the output before the batching)
+    """
+
+    def calculate_stats(self, items, row):
+        stats = []
+        for acc in self.accumulators:
+            values = [acc.get_stats(row, item) for item in items]
+            if values and isinstance(values[0], dict):
+                stats.extend((k, [value.get(k) for value in values]) for k in values[0])
+            else:
+                stats.append((acc.name, values))
+        return stats
+
+
+def run_generator(input, save_as, limit, hashn, generator_class=FeatureGenerator, **kwargs):
+    generator_class(
+        limit=limit,
+        accumulators=get_accumulators(hashn),
+        save_only_features=hashn is not None and hashn != 0,
+        input=input,
+        save_as=save_as,
+        **kwargs
+    ).generate_features()
+    return save_as
+
+
+def run_csv(input, workdir, limit, hashn):
+    return run_generator(input, os.path.join(workdir, "csv.csv"), limit, hashn)
+
+
+def run_per_item(input, workdir, limit, hashn):
+    return run_generator(input, os.path.join(workdir, "per_item.csv"), limit, hashn, PerItemFeatureGenerator)
+
+
+def run_store(input, workdir, limit, hashn):
+    store = load_event_store(os.path.join(workdir, "events.store.joblib"), input)
+    return run_generator(input, os.path.join(workdir, "store.csv"), limit, hashn, store=store)
+
+
+def run_columns(input, workdir, limit, hashn):
+    return run_generator(input, os.path.join(workdir, "columns"), limit, hashn, output_format="columns")
+
+
+def run_parquet(input, workdir, limit, hashn):
+    return run_generator(input, os.path.join(workdir, "output.parquet"), limit, hashn, output_format="parquet")
+
+
+def run_split(input, workdir, limit, hashn):
+    """
+    The clickout and impression tables joined back by clickout_id (saved as a csv)
+    """
+    path = run_generator(input, os.path.join(workdir, "split.csv"), limit, hashn, split_output=True)
+    save_as = os.path.join(workdir, "split_joined.csv")
+    read_split(path).to_csv(save_as, index=False)
+    return save_as
+
+
+def run_resume(input, workdir, limit, hashn):
+    """
+    The first half of the rows saved with a checkpoint, the run resumed from it up to the limit
+    """
+    save_as = os.path.join(workdir, "resume.csv")
+    checkpoint = save_as + ".checkpoint"
+    with open(input) as inp:
+        half = (limit or sum(1 for _ in inp)) // 2
+    run_generator(input, save_as, half, hashn, checkpoint_path=checkpoint)
+    return run_generator(input, save_as, limit, hashn, checkpoint_path=checkpoint, resume_from=checkpoint)
+
+
+def run_push_event(input, workdir, limit, hashn):
+    """
+    The events streamed one by one through FeatureGenerator.push_event, the rows are saved to a csv
+    """
+    generator = FeatureGenerator(
+        limit=None, accumulators=get_accumulators(hashn), save_only_features=hashn is not None and hashn != 0
+    )
+    rows = []
+    with open(input) as inp:
+        # the same number of rows as the limit of FeatureGenerator.read_rows
+        for event in islice(DictReader(inp), limit + 2 if limit else None):
+            rows.extend(generator.push_event(event))
+    save_as = os.path.join(workdir, "push_event.csv")
+    # the columns are known after the first clickout
+    columns = list(rows[0].keys()) if rows else []
+    writer = CsvWriter(save_as, columns)
+    for obs in rows:
+        writer.writerow([obs[name] for name in columns])
+    writer.close()
+    return save_as
+
+
+def run_sharded(input, workdir, limit, hashn, n_shards=2):
+    """
+    The global accumulators and the user local ones in user shards joined like in generate_data_sharded.py
+    """
+    global_path = os.path.join(workdir, "sharded_global.csv")
+    local_paths = [os.path.join(workdir, "sharded_user_%03d.csv" % shard) for shard in range(n_shards)]
+    FeatureGenerator(
+        limit=limit,
+        accumulators=split_user_local_accumulators(get_accumulators(hashn))[1],
+        save_only_features=hashn is not None and hashn != 0,
+        input=input,
+        save_as=global_path,
+    ).generate_features()
+    for shard, path in enumerate(local_paths):
+        FeatureGenerator(
+            limit=limit,
+            accumulators=split_user_local_accumulators(get_accumulators(hashn))[0],
+            save_only_features=True,
+            input=input,
+            save_as=path,
+            shard=(shard, n_shards),
+            index_columns=["clickout_id", "rank"],
+        ).generate_features()
+    save_as = os.path.join(workdir, "sharded.csv")
+    join_user_shards(global_path, local_paths, save_as)
+    return save_as
+
+
+def run_dataframe(input, workdir, limit, hashn):
+    """
+    The DataFrame based generator (feat_gen.py), its rows are saved to a csv
+    """
+    from recsys.feat_gen import FeatureGenerator as DataFrameFeatureGenerator
+
+    # the same number of rows as the limit of FeatureGenerator.read_rows
+    df = pd.read_csv(input, dtype=str, keep_default_na=False, nrows=limit + 2 if limit else None)
+    rows = DataFrameFeatureGenerator(None, get_accumulators(hashn), input_df=df).generate_features()
+    save_as = os.path.join(workdir, "dataframe.csv")
+    columns = list(rows[0].keys()) if rows else []
+    writer = CsvWriter(save_as, columns)
+    for obs in rows:
+        writer.writerow([obs.get(name) for name in columns])
+    writer.close()
+    return save_as
+
+
+MODES = {
+    "csv": run_csv,
+    "per_item": run_per_item,
+    "store": run_store,
+    "columns": run_columns,
+    "parquet": run_parquet,
+    "split": run_split,
+    "resume": run_resume,
+    "push_event": run_push_event,
+    "sharded": run_sharded,
+    "dataframe": run_dataframe,
+}
+
+
+def read_output(path):
+    if os.path.isdir(path):
+        # a part of the feature store, its meta has the same format as a manifest
+        return FeatureStore(os.path.join(path, PART_META)).read()
+    if path.endswith(".parquet"):
+        return read_parquet_frame(path)
+    return pd.read_csv(path)
+
+
+def as_strings(values):
+    return ["" if value != value or value is None else str(value) for value in values.tolist()]
+
+
+def numeric(values):
+    """
+    The column as float64, None if it has values which are not numbers
+    """
+    if values.dtype.kind in "iufb":
+        return values.to_numpy(dtype=np.float64)
+    converted = pd.to_numeric(values, errors="coerce")
+    if (converted.isna() & values.notna() & (values != "")).any():
+        return None
+    return converted.to_numpy(dtype=np.float64)
+
+
+def divergent_rows(reference, candidate, rtol, atol):
+    """
+    Boolean mask of the rows where the two columns differ. Numeric columns are compared with the tolerances
+    (nan equals nan), the rest as the strings the csv would have.
+    """
+    if reference.dtype.kind in "iufb" or candidate.dtype.kind in "iufb":
+        reference_numbers, candidate_numbers = numeric(reference), numeric(candidate)
+        if reference_numbers is not None and candidate_numbers is not None:
+            return ~np.isclose(reference_numbers, candidate_numbers, rtol=rtol, atol=atol, equal_nan=True)
+    return np.array(as_strings(reference), dtype=object) != np.array(as_strings(candidate), dtype=object)
+
+
+def compare_outputs(reference, candidate, rtol=1e-9, atol=1e-12):
+    """
+    Compares the two feature DataFrames column by column. Returns a report with the missing and extra columns,
+    the number of divergent rows per column and the first divergence (the first row and the features
+    which differ in it).
+    """
+    report = {
+        "rows": [len(reference), len(candidate)],
+        "missing_columns": [column for column in reference.columns if column not in candidate.columns],
+        "extra_columns": [column for column in candidate.columns if column not in reference.columns],
+        "divergent_columns": {},
+        "first_divergence": None,
+    }
+    if len(reference) != len(candidate):
+        return report
+    first_row = None
+    masks = {}
+    for column in reference.columns:
+        if column not in candidate.columns:
+            continue
+        mask = divergent_rows(reference[column], candidate[column], rtol, atol)
+        if mask.any():
+            masks[column] = mask
+            report["divergent_columns"][column] = int(mask.sum())
+            row = int(np.argmax(mask))
+            first_row = row if first_row is None else min(first_row, row)
+    if first_row is not None:
+        features = [column for column, mask in masks.items() if mask[first_row]]
+        report["first_divergence"] = {
+            "row": first_row,
+            "clickout_id": str(reference["clickout_id"].iloc[first_row]) if "clickout_id" in reference else None,
+            "rank": str(reference["rank"].iloc[first_row]) if "rank" in reference else None,
+            "features": {
+                column: [as_strings(output[column].iloc[[first_row]])[0] for output in (reference, candidate)]
+                for column in features
+            },
+        }
+    return report
+
+
+def is_equivalent(report):
+    return (
+        report["rows"][0] == report["rows"][1]
+        and not report["missing_columns"]
+        and not report["divergent_columns"]
+    )
+
+
+def timed(mode, input, workdir, limit, hashn):
+    logger.info("Running %s" % mode)
+    start = time.perf_counter()
+    path = MODES[mode](input, workdir, limit, hashn)
+    return path, time.perf_counter() - start
+
+
+def log_report(mode, report, reference_time, candidate_time):
+    logger.info(
+        "%s: %.1fs (reference %.1fs, %.2fx)" % (mode, candidate_time, reference_time, reference_time / candidate_time)
+    )
+    if report["rows"][0] != report["rows"][1]:
+        logger.info("%s: %d rows instead of %d" % (mode, report["rows"][1], report["rows"][0]))
+    if report["missing_columns"]:
+        logger.info("%s: missing columns %s" % (mode, ", ".join(report["missing_columns"])))
+    if report["extra_columns"]:
+        logger.info("%s: extra columns %s" % (mode, ", ".join(report["extra_columns"])))
+    divergence = report["first_divergence"]
+    if divergence:
+        logger.info(
+            "%s: first divergence at row %d (clickout_id %s, rank %s)"
+            % (mode, divergence["row"], divergence["clickout_id"], divergence["rank"])
+        )
+        for column, (expected, actual) in divergence["features"].items():
+            logger.info("%s:     %s: %r != %r" % (mode, column, expected, actual))
+        for column, n in sorted(report["divergent_columns"].items(), key=lambda item: item[1], reverse=True):
+            logger.info("%s: %8d divergent rows  %s" % (mode, n, column))
+    if is_equivalent(report):
+        logger.info("%s: equivalent to the reference" % mode)
+
+
+@click.command()
+@click.option("--input", default="../../../data/events_sorted.csv", help="Events to generate the features from")
+@click.option("--limit", type=int, default=None, help="Number of rows to process")
+@click.option("--hashn", type=int, default=None, help="Chunk number")
+@click.option("--reference", type=click.Choice(sorted(MODES)), default="csv", help="Reference generator")
+@click.option(
+    "--candidate", type=click.Choice(sorted(MODES)), multiple=True, required=True, help="Candidate generator(s)"
+)
+@click.option("--rtol", type=float, default=1e-9, help="Relative tolerance of the numeric features")
+@click.option("--atol", type=float, default=1e-12, help="Absolute tolerance of the numeric features")
+@click.option("--workdir", type=str, default=None, help="Directory for the outputs (a temporary one by default)")
+@click.option("--report", type=str, default=None, help="Save the comparison (json) to this path")
+def main(input, limit, hashn, reference, candidate, rtol, atol, workdir, report):
+    """
+    Runs the reference and the candidate generators on the same input and checks that the features are the same
+    """
+    workdir = workdir or tempfile.mkdtemp(prefix="equivalence_")
+    os.makedirs(workdir, exist_ok=True)
+    reference_path, reference_time = timed(reference, input, workdir, limit, hashn)
+    reference_output = read_output(reference_path)
+    reports = {}
+    for mode in candidate:
+        path, candidate_time = timed(mode, input, workdir, limit, hashn)
+        reports[mode] = compare_outputs(reference_output, read_output(path), rtol, atol)
+        reports[mode]["time"] = candidate_time
+        reports[mode]["reference_time"] = reference_time
+        log_report(mode, reports[mode], reference_time, candidate_time)
+    if report:
+        with open(report, "wt") as out:
+            json.dump(reports, out, indent=2)
+    failed = [mode for mode, mode_report in reports.items() if not is_equivalent(mode_report)]
+    if failed:
+        raise click.ClickException("Not equivalent to %s: %s" % (reference, ", ".join(failed)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+import pickle
+import struct
+from csv import DictReader
+from multiprocessing import Process, Queue, Semaphore
+from queue import Full
+
+try:
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError:
+    # python < 3.8, the events go through QueueRing
+    SharedMemory = None
+
+from recsys.data_generator.accumulators import get_accumulators, logger
+from recsys.data_generator.generate_training_data import FeatureGenerator
+
+HEADER = struct.Struct("q")
+END_OF_EVENTS = -1
+
+
+class EventRing:
+    """
+    Shared memory ring buffer with one writer and a fixed number of readers.
+
+    The ring has n_slots slots of slot_size bytes, every slot holds one pickled batch of events prefixed with its length.
+    Every reader has its own pair of semaphores: filled counts the slots published but not read yet,
+    free counts the slots the writer can still overwrite. The writer waits for all the readers before
+    reusing a slot, so it is at most n_slots batches ahead of the slowest reader and the memory used is
+    n_slots * slot_size regardless of the size of the input.
+    """
+
+    def __init__(self, n_readers, n_slots=8, slot_size=16 * 1024 * 1024):
+        self.n_slots = n_slots
+        self.slot_size = slot_size
+        self.shm = SharedMemory(create=True, size=n_slots * slot_size)
+        self.name = self.shm.name
+        self.filled = [Semaphore(0) for _ in range(n_readers)]
+        self.free = [Semaphore(n_slots) for _ in range(n_readers)]
+        self.slot = 0
+        # writer side only, used to stop waiting for readers that died
+        self.workers = []
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["shm"]
+        state["workers"] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = SharedMemory(name=self.name)
+
+    def publish(self, rows):
+        payload = pickle.dumps(rows, protocol=pickle.HIGHEST_PROTOCOL)
+        if HEADER.size + len(payload) > self.slot_size:
+            if len(rows) == 1:
+                raise ValueError("Event does not fit into the ring slot (%d bytes)" % self.slot_size)
+            half = len(rows) // 2
+            self.publish(rows[:half])
+            self.publish(rows[half:])
+            return
+        self._write(payload, len(payload))
+
+    def close(self):
+        self._write(b"", END_OF_EVENTS)
+
+    def _write(self, payload, length):
+        for free in self.free:
+            while not free.acquire(timeout=5):
+                if any(p.exitcode is not None for p in self.workers):
+                    raise RuntimeError("Worker exited before reading all the events")
+        start = self.slot * self.slot_size
+        HEADER.pack_into(self.shm.buf, start, length)
+        self.shm.buf[start + HEADER.size : start + HEADER.size + len(payload)] = payload
+        for filled in self.filled:
+            filled.release()
+        self.slot = (self.slot + 1) % self.n_slots
+
+    def read(self, reader):
+        """
+        Yields the events published to the ring, reader is the number of the reader
+        """
+        slot = 0
+        while True:
+            self.filled[reader].acquire()
+            start = slot * self.slot_size
+            (length,) = HEADER.unpack_from(self.shm.buf, start)
+            if length == END_OF_EVENTS:
+                break
+            rows = pickle.loads(self.shm.buf[start + HEADER.size : start + HEADER.size + length])
+            self.free[reader].release()
+            slot = (slot + 1) % self.n_slots
+            yield from rows
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class QueueRing:
+    """
+    EventRing for python < 3.8 (without multiprocessing.shared_memory): every reader has a queue of at most
+    n_slots pickled batches, so the writer is also at most n_slots batches ahead of the slowest reader.
+    A batch is pickled once for all the readers.
+    """
+
+    def __init__(self, n_readers, n_slots=8, slot_size=None):
+        self.queues = [Queue(n_slots) for _ in range(n_readers)]
+        # writer side only, used to stop waiting for readers that died
+        self.workers = []
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["workers"] = []
+        return state
+
+    def publish(self, rows):
+        self._write(pickle.dumps(rows, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def close(self):
+        self._write(None)
+
+    def _write(self, payload):
+        for queue in self.queues:
+            while True:
+                try:
+                    queue.put(payload, timeout=5)
+                    break
+                except Full:
+                    if any(p.exitcode is not None for p in self.workers):
+                        raise RuntimeError("Worker exited before reading all the events")
+
+    def read(self, reader):
+        """
+        Yields the events published to the ring, reader is the number of the reader
+        """
+        while True:
+            payload = self.queues[reader].get()
+            if payload is None:
+                break
+            yield from pickle.loads(payload)
+
+    def unlink(self):
+        for queue in self.queues:
+            queue.close()
+
+
+def read_events(input, limit):
+    with open(input) as inp:
+        for i, row in enumerate(DictReader(inp)):
+            yield FeatureGenerator.prepare_row(row)
+            if limit and i > limit:
+                break
+
+
+def publish_events(ring, rows, batch_size):
+    """
+    Publishes the prepared rows to all the workers in batches of batch_size
+    """
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            ring.publish(batch)
+            batch = []
+    if batch:
+        ring.publish(batch)
+    ring.close()
+
+
+def generate_features_from_ring(ring, reader, hashn, limit, save_as, output_format):
+    feature_generator = FeatureGenerator(
+        limit=limit,
+        accumulators=get_accumulators(hashn),
+        save_only_features=hashn != 0,
+        save_as=save_as,
+        rows=ring.read(reader),
+        output_format=output_format,
+    )
+    feature_generator.generate_features()
+
+
+def fan_out(
+    hashns,
+    input,
+    save_as,
+    limit=None,
+    store=None,
+    n_slots=8,
+    slot_size=16 * 1024 * 1024,
+    batch_size=10000,
+    output_format="csv",
+):
+    """
+    Generates the features of every accumulator group in hashns in its own process.
+    The events are read once in this process (from the csv or the event store) and shared with the workers
+    through an EventRing (a QueueRing without shared memory). save_as is a pattern formatted with the hashn.
+    """
+    ring_class = EventRing if SharedMemory is not None else QueueRing
+    ring = ring_class(len(hashns), n_slots=n_slots, slot_size=slot_size)
+    ps = [
+        Process(
+            target=generate_features_from_ring, args=(ring, reader, hashn, limit, save_as % hashn, output_format)
+        )
+        for reader, hashn in enumerate(hashns)
+    ]
+    try:
+        for p in ps:
+            p.start()
+        ring.workers = ps
+        logger.info("Publishing events to %d workers" % len(ps))
+        rows = store.iter_rows(limit=limit) if store is not None else read_events(input, limit)
+        publish_events(ring, rows, batch_size)
+        for p in ps:
+            p.join()
+    finally:
+        ring.unlink()
+    failed = [hashn for hashn, p in zip(hashns, ps) if p.exitcode != 0]
+    if failed:
+        raise RuntimeError("Feature generation failed for hashn %s" % failed)
@@ -0,0 +1,291 @@
+import csv
+from array import array
+
+import joblib
+import numpy as np
+
+from recsys.data_generator.fingerprints import impressions_fingerprints
+
+NO_INDEX = -1000
+CLICKOUT = "clickout item"
+LIST_COLUMNS = ("impressions", "fake_impressions")
+PRICES_COLUMN = "prices"
+# the columns the rows of the clickouts have on top of the others
+CLICKOUT_ONLY_COLUMNS = ("impressions_raw", "impressions_fp", "impressions_set_fp", "index_clicked", "price_clicked")
+
+
+class Vocabulary:
+    """
+    Interns string values into dense integer codes.
+    """
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+        return code
+
+    def decode(self, code):
+        return self.values[code]
+
+
+class RaggedBuilder:
+    """
+    Collects variable length int lists into one values array plus offsets.
+    """
+
+    def __init__(self, typecode="i"):
+        self.offsets = array("q", [0])
+        self.values = array(typecode)
+
+    def append(self, values):
+        self.values.extend(values)
+        self.offsets.append(len(self.values))
+
+    def append_empty(self):
+        self.offsets.append(len(self.values))
+
+    def build(self):
+        offsets = np.frombuffer(self.offsets, dtype=np.int64).copy()
+        values = np.frombuffer(self.values, dtype=self.values.typecode).copy()
+        return offsets, values
+
+
+class EventStore:
+    """
+    The events from events_sorted.csv parsed once into a compact columnar form.
+
+    - every plain column is stored as int32 codes into a Vocabulary (user_id, session_id, action_type, platform, city...)
+    - timestamp is an int64 column
+    - impression lists (impressions and fake_impressions share one vocabulary) and price lists are interned
+      and kept as ragged offsets + values arrays of item codes / prices
+    - index_clicked, fake_index_interacted and price_clicked are precomputed, so are the fingerprints of every
+      distinct impression list
+
+    The store can be saved once and memory mapped by all the workers, so the csv is parsed only once.
+    iter_rows yields the same rows FeatureGenerator.prepare_row produces from the csv.
+    """
+
+    def __init__(self):
+        self.columns = []
+        self.vocabularies = {}
+        self.codes = {}
+        self.timestamp = None
+        self.items = Vocabulary()
+        self.lists = Vocabulary()
+        self.list_offsets = None
+        self.list_items = None
+        self.list_fingerprints = None
+        self.list_set_fingerprints = None
+        self.price_lists = Vocabulary()
+        self.price_offsets = None
+        self.price_values = None
+        self.index_clicked = None
+        self.fake_index_interacted = None
+        self.price_clicked = None
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    @property
+    def string_columns(self):
+        return [name for name in self.columns if name not in ("timestamp", PRICES_COLUMN) + LIST_COLUMNS]
+
+    @classmethod
+    def from_csv(cls, path, limit=None):
+        store = cls()
+        with open(path) as inp:
+            reader = csv.reader(inp)
+            store.columns = next(reader)
+            store._parse(reader, limit)
+        return store
+
+    def _parse(self, reader, limit):
+        positions = {name: n for n, name in enumerate(self.columns)}
+        string_columns = [(name, positions[name], Vocabulary(), array("i")) for name in self.string_columns]
+        timestamp_pos = positions["timestamp"]
+        action_type_pos = positions["action_type"]
+        reference_pos = positions["reference"]
+        impressions_pos = positions["impressions"]
+        fake_impressions_pos = positions["fake_impressions"]
+        prices_pos = positions[PRICES_COLUMN]
+
+        timestamps = array("q")
+        impressions_codes = array("i")
+        fake_impressions_codes = array("i")
+        prices_codes = array("i")
+        index_clicked = array("h")
+        fake_index_interacted = array("h")
+        price_clicked = array("i")
+        lists = RaggedBuilder()
+        parsed_prices = {}
+
+        for i, values in enumerate(reader):
+            for name, pos, vocabulary, codes in string_columns:
+                codes.append(vocabulary.encode(values[pos]))
+            timestamps.append(int(values[timestamp_pos]))
+            reference = values[reference_pos]
+
+            fake_impressions = values[fake_impressions_pos].split("|")
+            fake_impressions_codes.append(self._encode_list(values[fake_impressions_pos], fake_impressions, lists))
+            fake_index_interacted.append(self._find(reference, fake_impressions))
+
+            impressions = values[impressions_pos].split("|")
+            impressions_codes.append(self._encode_list(values[impressions_pos], impressions, lists))
+            price_code = self.price_lists.encode(values[prices_pos])
+            prices_codes.append(price_code)
+            if values[action_type_pos] == CLICKOUT:
+                if price_code not in parsed_prices:
+                    parsed_prices[price_code] = list(map(int, values[prices_pos].split("|")))
+                ind = self._find(reference, impressions)
+                index_clicked.append(ind)
+                price_clicked.append(parsed_prices[price_code][ind] if ind >= 0 else 0)
+            else:
+                index_clicked.append(NO_INDEX)
+                price_clicked.append(0)
+
+            if limit and i > limit:
+                break
+
+        for name, pos, vocabulary, codes in string_columns:
+            self.vocabularies[name] = vocabulary
+            self.codes[name] = np.frombuffer(codes, dtype=np.int32).copy()
+        self.codes["impressions"] = np.frombuffer(impressions_codes, dtype=np.int32).copy()
+        self.codes["fake_impressions"] = np.frombuffer(fake_impressions_codes, dtype=np.int32).copy()
+        self.codes[PRICES_COLUMN] = np.frombuffer(prices_codes, dtype=np.int32).copy()
+        self.timestamp = np.frombuffer(timestamps, dtype=np.int64).copy()
+        self.index_clicked = np.frombuffer(index_clicked, dtype=np.int16).copy()
+        self.fake_index_interacted = np.frombuffer(fake_index_interacted, dtype=np.int16).copy()
+        self.price_clicked = np.frombuffer(price_clicked, dtype=np.int32).copy()
+        self.list_offsets, self.list_items = lists.build()
+        self.fingerprint_lists()
+
+        # only the price lists of clickouts are parsed, the rest stays as raw strings
+        prices = RaggedBuilder()
+        for code in range(len(self.price_lists)):
+            if code in parsed_prices:
+                prices.append(parsed_prices[code])
+            else:
+                prices.append_empty()
+        self.price_offsets, self.price_values = prices.build()
+
+    def fingerprint_lists(self):
+        fingerprints = [impressions_fingerprints(raw, raw.split("|")) for raw in self.lists.values]
+        self.list_fingerprints = [ordered for ordered, _ in fingerprints]
+        self.list_set_fingerprints = [order_insensitive for _, order_insensitive in fingerprints]
+
+    def _encode_list(self, raw, items, lists):
+        """
+        Interns the impression list and stores its item codes when it is seen for the first time
+        """
+        code = self.lists.codes.get(raw)
+        if code is None:
+            code = self.lists.encode(raw)
+            lists.append([self.items.encode(item_id) for item_id in items])
+        return code
+
+    @staticmethod
+    def _find(reference, items):
+        return items.index(reference) if reference in items else NO_INDEX
+
+    def save(self, path):
+        joblib.dump(self, path)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        return joblib.load(path, mmap_mode=mmap_mode)
+
+    def iter_rows(self, limit=None, mask=None, start=0, chunk_size=100000):
+        """
+        Yields the rows (from the row number start) as dicts. If the boolean mask is given the rows outside of it
+        are yielded as None, so the position of each row is preserved.
+        """
+        # the same limit semantics as FeatureGenerator.read_rows
+        n_rows = min(len(self), limit + 2) if limit else len(self)
+        for start in range(start, n_rows, chunk_size):
+            yield from self._iter_chunk(start, min(start + chunk_size, n_rows), mask)
+
+    def _iter_chunk(self, start, stop, mask=None):
+        """
+        Builds the chunk column by column (every distinct list decoded once) and zips the columns into the rows.
+        The rows are fresh dicts (the accumulators add keys to them) with their own lists, the keys are in the order
+        FeatureGenerator.prepare_row adds them.
+        """
+        selected = np.asarray(mask[start:stop]) if mask is not None else None
+
+        def column(values):
+            # plain ndarray, slicing a memmap row by row is slow
+            values = np.asarray(values[start:stop])
+            return (values[selected] if selected is not None else values).tolist()
+
+        clickout_code = self.vocabularies["action_type"].codes.get(CLICKOUT)
+        clickouts = [code == clickout_code for code in column(self.codes["action_type"])]
+        impressions = column(self.codes["impressions"])
+        fake_impressions = column(self.codes["fake_impressions"])
+        prices = column(self.codes[PRICES_COLUMN])
+        lists = self.lists.values
+        price_lists = self.price_lists.values
+        decoded = self.decode_lists(
+            set(fake_impressions) | {code for code, clickout in zip(impressions, clickouts) if clickout}
+        )
+        decoded_prices = self.decode_price_lists({code for code, clickout in zip(prices, clickouts) if clickout})
+
+        values = {}
+        for name in self.string_columns:
+            vocabulary = self.vocabularies[name].values
+            values[name] = [vocabulary[code] for code in column(self.codes[name])]
+        values["timestamp"] = column(self.timestamp)
+        values["fake_impressions"] = [list(decoded[code]) for code in fake_impressions]
+        values["impressions"] = [
+            list(decoded[code]) if clickout else lists[code] for code, clickout in zip(impressions, clickouts)
+        ]
+        values[PRICES_COLUMN] = [
+            list(decoded_prices[code]) if clickout else price_lists[code] for code, clickout in zip(prices, clickouts)
+        ]
+        values["fake_impressions_raw"] = [lists[code] for code in fake_impressions]
+        values["fake_impressions_fp"] = [self.list_fingerprints[code] for code in fake_impressions]
+        values["fake_index_interacted"] = column(self.fake_index_interacted)
+        # only the clickouts have the last columns, zip drops them from the other rows
+        values["impressions_raw"] = [lists[code] for code in impressions]
+        values["impressions_fp"] = [self.list_fingerprints[code] for code in impressions]
+        values["impressions_set_fp"] = [self.list_set_fingerprints[code] for code in impressions]
+        values["index_clicked"] = column(self.index_clicked)
+        values["price_clicked"] = column(self.price_clicked)
+
+        keys = self.columns + ["fake_impressions_raw", "fake_impressions_fp", "fake_index_interacted"]
+        clickout_keys = keys + list(CLICKOUT_ONLY_COLUMNS)
+        rows = (
+            dict(zip(clickout_keys if clickout else keys, row))
+            for clickout, row in zip(clickouts, zip(*[values[name] for name in clickout_keys]))
+        )
+        if selected is None:
+            yield from rows
+        else:
+            for is_selected in selected.tolist():
+                yield next(rows) if is_selected else None
+
+    def decode_lists(self, list_codes):
+        """
+        The item ids of every list code
+        """
+        offsets = np.asarray(self.list_offsets)
+        list_items = np.asarray(self.list_items)
+        items = self.items.values
+        return {
+            code: tuple(items[item] for item in list_items[offsets[code] : offsets[code + 1]].tolist())
+            for code in list_codes
+        }
+
+    def decode_price_lists(self, price_codes):
+        offsets = np.asarray(self.price_offsets)
+        price_values = np.asarray(self.price_values)
+        return {code: tuple(price_values[offsets[code] : offsets[code + 1]].tolist()) for code in price_codes}
@@ -0,0 +1,581 @@
+import json
+import os
+from array import array
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from recsys.data_generator.event_store import Vocabulary
+
+PART_META = "part.json"
+
+
+def csv_value(value):
+    # what DictWriter would write to the csv
+    if value is None:
+        return ""
+    return value if isinstance(value, str) else str(value)
+
+
+class ColumnBuffer:
+    """
+    Collects the values of one feature column and keeps them typed.
+
+    The column starts as int64, becomes float64 when a float (or None -> nan) shows up and falls back to
+    interned strings when a non numeric value shows up. Strings that all turn out to be numbers are converted back
+    to numbers in finish, so the stored column has the type pandas.read_csv would infer for it.
+    """
+
+    def __init__(self):
+        self.kind = "int"
+        self.values = array("q")
+        self.vocabulary = None
+
+    def append(self, value):
+        if isinstance(value, bool):
+            value = int(value)
+        if self.kind == "int":
+            if isinstance(value, int):
+                self.values.append(value)
+                return
+            if isinstance(value, float) or value is None:
+                self.values = array("d", self.values)
+                self.kind = "float"
+            else:
+                self._to_strings()
+        if self.kind == "float":
+            if isinstance(value, (int, float)):
+                self.values.append(value)
+                return
+            if value is None:
+                self.values.append(np.nan)
+                return
+            self._to_strings()
+        self.values.append(self.vocabulary.encode(csv_value(value)))
+
+    def _to_strings(self):
+        self.vocabulary = Vocabulary()
+        codes = array("i")
+        for value in self.values:
+            if self.kind == "float" and value != value:
+                value = None
+            elif self.kind == "float" and value == int(value):
+                # the int -> float promotion is not visible in the csv
+                value = int(value)
+            codes.append(self.vocabulary.encode(csv_value(value)))
+        self.values = codes
+        self.kind = "str"
+
+    def finish(self):
+        """
+        Returns (values array, categories or None)
+        """
+        if self.kind == "int":
+            return np.frombuffer(self.values, dtype=np.int64), None
+        if self.kind == "float":
+            return np.frombuffer(self.values, dtype=np.float64), None
+        codes = np.frombuffer(self.values, dtype=np.int32)
+        numbers = parse_numbers(self.vocabulary.values)
+        if numbers is not None:
+            return numbers[codes], None
+        return codes, self.vocabulary.values
+
+
+def parse_numbers(values):
+    """
+    Converts the strings to numbers the way pandas.read_csv does, returns None if any of them is not a number
+    """
+    numbers = []
+    for value in values:
+        if value == "":
+            numbers.append(np.nan)
+            continue
+        if value in ("True", "False"):
+            numbers.append(int(value == "True"))
+            continue
+        try:
+            numbers.append(int(value))
+        except ValueError:
+            try:
+                numbers.append(float(value))
+            except ValueError:
+                return None
+    if all(isinstance(number, int) for number in numbers):
+        return np.array(numbers, dtype=np.int64)
+    return np.array(numbers, dtype=np.float64)
+
+
+def chunk_file(column, chunk, suffix=".npy"):
+    return "%04d.%06d%s" % (column, chunk, suffix)
+
+
+class ColumnStoreWriter:
+    """
+    Writes the feature rows (the values in the order of the columns) to the path directory (a part of the feature
+    store). Every chunk_size rows the buffered values are saved as one .npy file per column, so only one chunk
+    of the output is in memory. Categorical chunks are saved as int32 codes plus their categories.
+    FeatureStore puts the chunks of a column back together.
+    """
+
+    def __init__(self, path, columns, chunk_size=100000):
+        self.path = path
+        self.columns = list(columns)
+        self.chunk_size = chunk_size
+        self.buffers = [ColumnBuffer() for _ in self.columns]
+        self.buffered = 0
+        self.n_rows = 0
+        # the saved chunks of every column
+        self.chunks = [[] for _ in self.columns]
+        os.makedirs(self.path, exist_ok=True)
+
+    def writerow(self, values):
+        for value, buffer in zip(values, self.buffers):
+            buffer.append(value)
+        self.buffered += 1
+        self.n_rows += 1
+        if self.buffered == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffered:
+            return
+        for n, (buffer, chunks) in enumerate(zip(self.buffers, self.chunks)):
+            values, categories = buffer.finish()
+            chunk = {"file": chunk_file(n, len(chunks)), "categories": None, "n_rows": self.buffered}
+            np.save(os.path.join(self.path, chunk["file"]), values)
+            if categories is not None:
+                chunk["categories"] = chunk_file(n, len(chunks), ".categories.json")
+                with open(os.path.join(self.path, chunk["categories"]), "wt") as out:
+                    json.dump(categories, out)
+            chunks.append(chunk)
+        self.buffers = [ColumnBuffer() for _ in self.columns]
+        self.buffered = 0
+
+    def get_state(self):
+        # the buffered rows are saved as a (short) chunk, so the state is the list of the chunk files
+        self.flush()
+        return {"columns": self.columns, "chunk_size": self.chunk_size, "n_rows": self.n_rows, "chunks": self.chunks}
+
+    @classmethod
+    def from_state(cls, path, state):
+        writer = cls(path, state["columns"], state["chunk_size"])
+        writer.n_rows = state["n_rows"]
+        writer.chunks = state["chunks"]
+        # the chunks written after the checkpoint
+        saved = {chunk[key] for chunks in writer.chunks for chunk in chunks for key in ("file", "categories")}
+        for name in os.listdir(path):
+            if name.endswith((".npy", ".categories.json")) and name not in saved:
+                os.remove(os.path.join(path, name))
+        return writer
+
+    def close(self):
+        self.flush()
+        columns = [{"name": name, "chunks": chunks} for name, chunks in zip(self.columns, self.chunks)]
+        with open(os.path.join(self.path, PART_META), "wt") as out:
+            json.dump({"n_rows": self.n_rows, "columns": columns}, out)
+
+
+def write_manifest(manifest_path, part_paths):
+    """
+    Concatenates the parts logically: the manifest only points to the chunk files of the columns.
+    All the parts have to have the same number of rows (they come from the same clickouts in the same order).
+    If a column is in more than one part the first one is used.
+    """
+    root = os.path.dirname(os.path.abspath(manifest_path))
+    n_rows = None
+    columns = {}
+    for part_path in part_paths:
+        with open(os.path.join(part_path, PART_META)) as inp:
+            part = json.load(inp)
+        if n_rows is None:
+            n_rows = part["n_rows"]
+        elif part["n_rows"] != n_rows:
+            raise ValueError("Part %s has %d rows instead of %d" % (part_path, part["n_rows"], n_rows))
+        for column in part["columns"]:
+            if column["name"] in columns:
+                continue
+            for chunk in column["chunks"]:
+                for key in ("file", "categories"):
+                    if chunk[key] is not None:
+                        chunk[key] = os.path.relpath(os.path.join(os.path.abspath(part_path), chunk[key]), root)
+            columns[column["name"]] = column
+    with open(manifest_path, "wt") as out:
+        json.dump({"n_rows": n_rows, "columns": list(columns.values())}, out)
+
+
+def chunk_values(values, categories, dtype):
+    """
+    The values of a chunk (codes if it has categories) as an array of the dtype of the column
+    """
+    if categories is not None:
+        return np.array(categories, dtype=object)[values]
+    if dtype == object:
+        return np.array([csv_value(number_value(value)) for value in values.tolist()], dtype=object)
+    return np.asarray(values).astype(dtype, copy=False)
+
+
+def row_indices(rows):
+    """
+    The row indices of a boolean mask or of a list of indices
+    """
+    rows = np.asarray(rows)
+    if rows.dtype == bool:
+        return np.flatnonzero(rows)
+    return rows.astype(np.int64, copy=False)
+
+
+class FeatureStore:
+    """
+    Reads the columns listed in the manifest. The column chunks are memory mapped, so reading a subset of
+    the columns and rows only touches these.
+    """
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        with open(manifest_path) as inp:
+            manifest = json.load(inp)
+        self.n_rows = manifest["n_rows"]
+        self.columns_meta = {column["name"]: column for column in manifest["columns"]}
+        self.columns = [column["name"] for column in manifest["columns"]]
+        self.root = os.path.dirname(os.path.abspath(manifest_path))
+
+    def __len__(self):
+        return self.n_rows
+
+    def column(self, name, rows=None):
+        """
+        The values of the column (rows are indices or a boolean mask). Only the rows which are read are taken
+        from the memory mapped chunks. If any chunk has strings the numbers of the other chunks are converted
+        to strings (like in the csv), ints and floats give floats.
+        """
+        chunks = [self.read_chunk(chunk) for chunk in self.columns_meta[name]["chunks"]]
+        if any(categories is not None for _, categories in chunks):
+            dtype = np.dtype(object)
+        else:
+            dtype = np.result_type(*[values.dtype for values, _ in chunks]) if chunks else np.dtype(np.int64)
+        if rows is None:
+            parts = [chunk_values(values, categories, dtype) for values, categories in chunks]
+            return np.concatenate(parts) if parts else np.empty(0, dtype=dtype)
+        indices = row_indices(rows)
+        if len(chunks) == 1:
+            values, categories = chunks[0]
+            return chunk_values(values[indices], categories, dtype)
+        starts = np.cumsum([0] + [chunk["n_rows"] for chunk in self.columns_meta[name]["chunks"]])
+        chunk_of = np.searchsorted(starts, indices, side="right") - 1
+        result = np.empty(len(indices), dtype=dtype)
+        for n, (values, categories) in enumerate(chunks):
+            selected = chunk_of == n
+            if selected.any():
+                result[selected] = chunk_values(values[indices[selected] - starts[n]], categories, dtype)
+        return result
+
+    def read_chunk(self, chunk):
+        values = np.load(os.path.join(self.root, chunk["file"]), mmap_mode="r")
+        categories = None
+        if chunk["categories"] is not None:
+            with open(os.path.join(self.root, chunk["categories"])) as inp:
+                categories = json.load(inp)
+        return values, categories
+
+    def read(self, columns=None, rows=None):
+        """
+        Returns a DataFrame with the columns (all by default) and rows (indices or a boolean mask)
+        """
+        columns = columns or self.columns
+        rows = row_indices(rows) if rows is not None else None
+        return pd.DataFrame({name: self.column(name, rows) for name in columns}, columns=columns)
+
+
+# the kinds of the parquet columns in the order they widen: ints to floats, numbers to (dictionary) strings
+KINDS = ("int", "float", "str")
+
+
+def column_kind(values, categories):
+    if categories is not None:
+        return "str"
+    return "float" if values.dtype.kind == "f" else "int"
+
+
+class ParquetBatchWriter:
+    """
+    Buffers the feature rows (the values in the order of the columns) and writes them as compressed parquet
+    row groups of batch_size rows.
+    Numbers are stored as int64/float64 and strings are dictionary encoded.
+
+    The kind of a column (see KINDS) is the widest kind of its batches so far. When a batch needs a wider kind
+    than the one in the file (a float in an int column, a string in a numeric one) the row groups written
+    so far are rewritten one by one with the wider kinds, so the result does not depend on the batch size.
+    A column without any value is a float column of nulls, like pandas.read_csv reads it.
+    """
+
+    def __init__(self, path, columns, batch_size=100000, compression="snappy"):
+        self.path = path
+        self.columns = list(columns)
+        self.batch_size = batch_size
+        self.compression = compression
+        self.buffers = [ColumnBuffer() for _ in self.columns]
+        self.n_rows = 0
+        self.kinds = None
+        self.writer = None
+
+    def writerow(self, values):
+        for value, buffer in zip(values, self.buffers):
+            buffer.append(value)
+        self.n_rows += 1
+        if self.n_rows % self.batch_size == 0:
+            self.flush()
+
+    def flush(self):
+        batch = [buffer.finish() for buffer in self.buffers]
+        self.buffers = [ColumnBuffer() for _ in self.columns]
+        kinds = [column_kind(values, categories) for values, categories in batch]
+        if self.kinds is not None:
+            kinds = [max(written, kind, key=KINDS.index) for written, kind in zip(self.kinds, kinds)]
+            if kinds != self.kinds:
+                self.widen(kinds)
+        self.kinds = kinds
+        arrays = [to_arrow(values, categories, kind) for (values, categories), kind in zip(batch, kinds)]
+        self.write_table(pa.Table.from_arrays(arrays, names=self.columns))
+
+    def write_table(self, table):
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema, compression=self.compression)
+        self.writer.write_table(table)
+
+    def widen(self, kinds):
+        """
+        Rewrites the row groups written so far with the wider kinds of the columns
+        """
+        self.writer.close()
+        self.writer = None
+        narrow_path = self.path + ".narrow"
+        os.replace(self.path, narrow_path)
+        written = pq.ParquetFile(narrow_path)
+        for n in range(written.num_row_groups):
+            row_group = written.read_row_group(n)
+            arrays = [
+                row_group.column(i) if kind == written_kind else widen_column(row_group.column(i), kind)
+                for i, (written_kind, kind) in enumerate(zip(self.kinds, kinds))
+            ]
+            self.write_table(pa.Table.from_arrays(arrays, names=self.columns))
+        os.remove(narrow_path)
+
+    def close(self):
+        if self.n_rows % self.batch_size or self.writer is None:
+            self.flush()
+        self.writer.close()
+
+    def get_state(self):
+        raise ValueError("Checkpoints are not supported for the parquet output")
+
+
+def number_value(value):
+    """
+    The number as it is in the csv: None for nan and an int for a whole float (the int -> float promotion
+    of ColumnBuffer is not visible in the csv)
+    """
+    if value is None or value != value:
+        return None
+    if isinstance(value, float) and value == int(value):
+        return int(value)
+    return value
+
+
+def to_arrow(values, categories, kind):
+    """
+    Converts the output of ColumnBuffer.finish to an arrow array of the kind
+    """
+    if categories is not None:
+        return pa.DictionaryArray.from_arrays(pa.array(values), pa.array(categories, type=pa.string()))
+    if kind == "str":
+        strings = [csv_value(number_value(value)) for value in values.tolist()]
+        return pa.array(strings, type=pa.string()).dictionary_encode()
+    if kind == "float":
+        values = values.astype(np.float64)
+    mask = np.isnan(values) if values.dtype.kind == "f" else None
+    return pa.array(values, mask=mask if mask is not None and mask.any() else None)
+
+
+def widen_column(column, kind):
+    """
+    Converts a written numeric column to the wider kind
+    """
+    values = column.to_pylist()
+    if kind == "float":
+        return pa.array(values, type=pa.float64())
+    return pa.array([csv_value(number_value(value)) for value in values], type=pa.string()).dictionary_encode()
+
+
+def join_parquet_parts(part_paths, save_as, compression="snappy"):
+    """
+    Joins the parquet files of the accumulator groups column-wise one row group at a time
+    (the groups write the same rows in the same batches). If a column is in more than one part the first one is used.
+    """
+    parts = [pq.ParquetFile(path) for path in part_paths]
+    n_row_groups = parts[0].num_row_groups
+    for path, part in zip(part_paths, parts):
+        if part.metadata.num_rows != parts[0].metadata.num_rows or part.num_row_groups != n_row_groups:
+            raise ValueError("Part %s is not aligned with %s" % (path, part_paths[0]))
+
+    writer = None
+    for n in range(n_row_groups):
+        arrays = []
+        names = []
+        for part in parts:
+            row_group = part.read_row_group(n)
+            for name, column in zip(row_group.schema.names, row_group.columns):
+                if name not in names:
+                    names.append(name)
+                    arrays.append(column)
+        table = pa.Table.from_arrays(arrays, names=names)
+        if writer is None:
+            writer = pq.ParquetWriter(save_as, table.schema, compression=compression)
+        writer.write_table(table)
+    if writer is not None:
+        writer.close()
+
+
+def read_parquet_frame(path, columns=None):
+    """
+    Reads the parquet file to a DataFrame with plain object columns for the strings (like pandas.read_csv)
+    """
+    df = pq.read_table(path, columns=columns).to_pandas()
+    for name in df.columns:
+        if df[name].dtype.name == "category":
+            df[name] = df[name].astype(object)
+    return df
+
+
+def clickouts_path(path):
+    """
+    Path of the clickout table of the split output whose impression table is path
+    """
+    root, ext = os.path.splitext(path)
+    return root + "_clickouts" + ext
+
+
+class SplitWriter:
+    """
+    Writes the feature rows (with the columns) as two tables with writer_class (CsvWriter, ColumnStoreWriter or
+    ParquetBatchWriter). The impression table (path) has the clickout_id and the item columns of every impression,
+    the clickout table (clickouts_path(path)) the columns which are the same for all the impressions of a clickout,
+    written once (from the row of rank 0). read_clickouts and join_clickouts put them back together.
+    """
+
+    def __init__(self, writer_class, path, columns, impression_columns, clickout_columns):
+        self.columns = list(columns)
+        self.impression_columns = list(impression_columns)
+        self.clickout_columns = list(clickout_columns)
+        self.impressions = writer_class(path, self.impression_columns)
+        self.clickouts = writer_class(clickouts_path(path), self.clickout_columns)
+        self.set_positions()
+
+    def set_positions(self):
+        self.rank_position = self.columns.index("rank")
+        self.impression_positions = [self.columns.index(name) for name in self.impression_columns]
+        self.clickout_positions = [self.columns.index(name) for name in self.clickout_columns]
+
+    def writerow(self, values):
+        self.impressions.writerow([values[position] for position in self.impression_positions])
+        if values[self.rank_position] == 0:
+            self.clickouts.writerow([values[position] for position in self.clickout_positions])
+
+    def close(self):
+        self.impressions.close()
+        self.clickouts.close()
+
+    def get_state(self):
+        return {
+            "columns": self.columns,
+            "impression_columns": self.impression_columns,
+            "clickout_columns": self.clickout_columns,
+            "impressions": self.impressions.get_state(),
+            "clickouts": self.clickouts.get_state(),
+        }
+
+    @classmethod
+    def from_state(cls, writer_class, path, state):
+        writer = cls.__new__(cls)
+        writer.columns = state["columns"]
+        writer.impression_columns = state["impression_columns"]
+        writer.clickout_columns = state["clickout_columns"]
+        writer.impressions = writer_class.from_state(path, state["impressions"])
+        writer.clickouts = writer_class.from_state(clickouts_path(path), state["clickouts"])
+        writer.set_positions()
+        return writer
+
+
+def table_columns(path):
+    """
+    Column names of a table written by one of the writers: a csv, a parquet file, a part of the feature store
+    (directory) or the manifest of the feature store
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, PART_META)
+    if path.endswith(".json"):
+        return FeatureStore(path).columns
+    if path.endswith(".parquet"):
+        return pq.read_schema(path).names
+    return list(pd.read_csv(path, nrows=0).columns)
+
+
+def read_clickouts(path, clickout_ids, columns=None):
+    """
+    Reads the rows of the clickout table with the clickout_ids (and the clickout_id column + columns).
+    The column store reads only these rows, the csv is read in chunks.
+    """
+    clickout_ids = np.unique(np.asarray(clickout_ids))
+    if columns is not None:
+        columns = ["clickout_id"] + [name for name in columns if name != "clickout_id"]
+    if os.path.isdir(path) or path.endswith(".json"):
+        store = FeatureStore(os.path.join(path, PART_META) if os.path.isdir(path) else path)
+        # the clickouts are written in the order of their ids
+        all_ids = store.column("clickout_id")
+        rows = np.searchsorted(all_ids, clickout_ids)
+        found = rows < len(all_ids)
+        rows = rows[found][all_ids[rows[found]] == clickout_ids[found]]
+        return store.read(columns=columns, rows=rows)
+    if path.endswith(".parquet"):
+        df = read_parquet_frame(path, columns=columns)
+        return df[df["clickout_id"].isin(clickout_ids)]
+    chunks = [
+        chunk[chunk["clickout_id"].isin(clickout_ids)]
+        for chunk in pd.read_csv(path, usecols=columns, chunksize=100000)
+    ]
+    return pd.concat(chunks, axis=0) if chunks else pd.read_csv(path, usecols=columns, nrows=0)
+
+
+def join_clickouts(impressions, clickouts):
+    """
+    Adds the columns of the clickout table to the impressions (the order of the impressions is kept)
+    """
+    clickouts = clickouts[[name for name in clickouts.columns if name == "clickout_id" or name not in impressions]]
+    df = impressions.merge(clickouts, on="clickout_id", how="left", sort=False)
+    df.index = impressions.index
+    return df
+
+
+def read_split(path, columns=None, nrows=None, clickouts=None):
+    """
+    Reads the impression table (csv or parquet) of the split output and joins the clickout table
+    (clickouts_path(path) by default) to it. Only the clickouts of the impressions which are read are loaded.
+    """
+    clickouts = clickouts or clickouts_path(path)
+    impression_columns = None
+    clickout_columns = None
+    if columns is not None:
+        in_clickouts = set(table_columns(clickouts))
+        impression_columns = ["clickout_id"] + [
+            name for name in columns if name != "clickout_id" and name not in in_clickouts
+        ]
+        clickout_columns = [name for name in columns if name in in_clickouts]
+    if path.endswith(".parquet"):
+        impressions = read_parquet_frame(path, columns=impression_columns)
+        if nrows is not None:
+            impressions = impressions.iloc[:nrows]
+    else:
+        impressions = pd.read_csv(path, usecols=impression_columns, nrows=nrows)
+    df = join_clickouts(impressions, read_clickouts(clickouts, impressions["clickout_id"], clickout_columns))
+    return df[columns] if columns is not None else df
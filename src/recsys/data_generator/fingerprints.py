@@ -0,0 +1,37 @@
+from hashlib import blake2b
+
+
+def fingerprint(value):
+    """
+    Signed 64-bit fingerprint of the string. Unlike hash() it is the same in every process (and in the checkpoints).
+    """
+    return int.from_bytes(blake2b(value.encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+
+
+def impressions_fingerprints(raw, items):
+    """
+    Returns the ordered (of impressions_raw) and the order-insensitive (of the sorted items) fingerprints
+    of the impression list
+    """
+    return fingerprint(raw), fingerprint("|".join(sorted(items)))
+
+
+class FingerprintCheck:
+    """
+    Validation mode: remembers the impression list of every fingerprint and raises ValueError when two different
+    lists get the same one. It keeps all the lists in memory, so it is meant for test runs.
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def check(self, row):
+        self._check(row["fake_impressions_fp"], row["fake_impressions_raw"])
+        if "impressions_fp" in row:
+            self._check(row["impressions_fp"], row["impressions_raw"])
+            self._check(row["impressions_set_fp"], "|".join(sorted(row["impressions"])))
+
+    def _check(self, fp, value):
+        seen = self.values.setdefault(fp, value)
+        if seen != value:
+            raise ValueError("Fingerprint collision %d: %r and %r" % (fp, seen, value))
@@ -0,0 +1,93 @@
+from itertools import chain
+
+import numpy as np
+import pandas as pd
+
+from recsys.data_generator.fingerprints import fingerprint, impressions_fingerprints
+
+# columns prepare_row adds to the clickouts only
+CLICKOUT_COLUMNS = ("impressions_raw", "impressions_fp", "impressions_set_fp", "index_clicked", "price_clicked")
+
+
+def index_in_lists(lists, values, missing=-1000):
+    """
+    Position of the value in the list (the first one) for every row, missing if it is not in the list.
+    The lists are flattened, so there is no python call per row.
+    """
+    lengths = lists.map(len).to_numpy(dtype=np.int64)
+    starts = np.cumsum(lengths) - lengths
+    rows = np.repeat(np.arange(len(lists)), lengths)
+    flat = np.fromiter(chain.from_iterable(lists), dtype=object, count=lengths.sum())
+    hits = np.flatnonzero(flat == np.asarray(values, dtype=object)[rows])
+    rows_hit, first = np.unique(rows[hits], return_index=True)
+    index = np.full(len(lists), missing, dtype=np.int64)
+    index[rows_hit] = hits[first] - starts[rows_hit]
+    return index
+
+
+def split_ints(strings):
+    """
+    Splits the "|" separated numbers (the prices) to lists of ints.
+    Returns the lists, all the numbers as one int array and where the list of every row starts in it.
+    """
+    lists = strings.str.split("|")
+    lengths = lists.map(len).to_numpy(dtype=np.int64)
+    starts = np.cumsum(lengths) - lengths
+    flat = np.fromiter(chain.from_iterable(lists), dtype=object, count=lengths.sum()).astype(np.int64)
+    values = flat.tolist()
+    return [values[start : start + length] for start, length in zip(starts, lengths)], flat, starts
+
+
+def put(df, column, positions, values, default=None):
+    """
+    Sets the column to the values (lists are fine) at the positions, the other rows keep their value
+    (or get the default if the column is new)
+    """
+    column_values = df[column].tolist() if column in df else [default] * len(df)
+    for position, value in zip(positions, values):
+        column_values[position] = value
+    df[column] = pd.Series(column_values, index=df.index, dtype=object)
+
+
+def preprocess_events(df):
+    """
+    Does what FeatureGenerator.prepare_row (generate_training_data.py) does to every row for the whole DataFrame
+    at once: splits the impressions and prices, finds the clicked index and price and fingerprints the impressions.
+    """
+    df["timestamp"] = df["timestamp"].astype(int)
+    df["fake_impressions_raw"] = df["fake_impressions"]
+    df["fake_impressions_fp"] = df["fake_impressions_raw"].map(fingerprint)
+    df["fake_impressions"] = df["fake_impressions"].str.split("|")
+    df["fake_index_interacted"] = index_in_lists(df["fake_impressions"], df["reference"])
+
+    positions = np.flatnonzero((df["action_type"] == "clickout item").to_numpy())
+    clickouts = df.iloc[positions]
+    impressions = clickouts["impressions"].str.split("|")
+    fingerprints = [impressions_fingerprints(raw, items) for raw, items in zip(clickouts["impressions"], impressions)]
+    index_clicked = index_in_lists(impressions, clickouts["reference"])
+    prices, flat_prices, prices_starts = split_ints(clickouts["prices"])
+    clicked = index_clicked >= 0
+    price_clicked = np.zeros(len(positions), dtype=np.int64)
+    price_clicked[clicked] = flat_prices[prices_starts[clicked] + index_clicked[clicked]]
+
+    put(df, "impressions_raw", positions, clickouts["impressions"])
+    put(df, "impressions", positions, impressions)
+    put(df, "impressions_fp", positions, [fp for fp, _ in fingerprints])
+    put(df, "impressions_set_fp", positions, [set_fp for _, set_fp in fingerprints])
+    put(df, "index_clicked", positions, index_clicked.tolist())
+    put(df, "prices", positions, prices)
+    put(df, "price_clicked", positions, price_clicked.tolist())
+    return df
+
+
+def event_records(df, chunk_size=10000):
+    """
+    The rows of the preprocessed DataFrame as plain dicts (like the rows of the csv path), the clickout columns
+    are only in the clickouts. The dicts are made chunk_size rows at a time.
+    """
+    for start in range(0, len(df), chunk_size):
+        for row in df.iloc[start : start + chunk_size].to_dict("records"):
+            if row["action_type"] != "clickout item":
+                for column in CLICKOUT_COLUMNS:
+                    del row[column]
+            yield row
@@ -1,13 +1,47 @@
-import subprocess
 import os
 
-ps = []
-for n in range(8):
-    args = ["python", "generate_training_data.py", "--limit", "1000000", "--hashn", str(n)]
-    p = subprocess.Popen(args)
-    ps.append(p)
+import click
+import sys
+sys.path.append('/Users/josang-yeon/2020/tobigs/tobigs_reco_conf/recsys2019/src')
+from recsys.data_generator.event_fanout import fan_out
+from recsys.data_generator.feature_store import join_parquet_parts, write_manifest
 
-for p in ps:
-    p.wait()
 
-os.system("paste -d, ../../../data/events_sorted_trans_0{0..7}.csv > ../../../data/events_sorted_trans_all.csv")
+@click.command()
+@click.option("--n-slots", type=int, default=8, help="Number of batches in the event ring")
+@click.option("--slot-size", type=int, default=16, help="Size of one shared memory ring slot in MB")
+@click.option(
+    "--output-format",
+    type=click.Choice(["csv", "columns", "parquet"]),
+    default="csv",
+    help="csv files merged with paste, typed column files with a manifest or parquet files joined by row groups",
+)
+def main(n_slots, slot_size, output_format):
+    fan_out(
+        hashns=list(range(8)),
+        input="../../../data/events_sorted.csv",
+        save_as="../../../data/events_sorted_trans_%03d." + output_format,
+        limit=1000000,
+        n_slots=n_slots,
+        slot_size=slot_size * 1024 * 1024,
+        output_format=output_format,
+    )
+
+    if output_format == "columns":
+        write_manifest(
+            "../../../data/events_sorted_trans_all.json",
+            ["../../../data/events_sorted_trans_%03d.columns" % n for n in range(8)],
+        )
+        return
+    if output_format == "parquet":
+        join_parquet_parts(
+            ["../../../data/events_sorted_trans_%03d.parquet" % n for n in range(8)],
+            "../../../data/events_sorted_trans_all.parquet",
+        )
+        return
+
+    os.system("paste -d, ../../../data/events_sorted_trans_0{0..7}.csv > ../../../data/events_sorted_trans_all.csv")
+
+
+if __name__ == "__main__":
+    main()
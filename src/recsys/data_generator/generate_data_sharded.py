@@ -0,0 +1,90 @@
+import heapq
+import os
+import subprocess
+from csv import reader, writer
+from multiprocessing import cpu_count
+
+import click
+import sys
+sys.path.append('/Users/josang-yeon/2020/tobigs/tobigs_reco_conf/recsys2019/src')
+from recsys.data_generator.generate_training_data import load_event_store
+
+
+def read_shard(path):
+    with open(path) as inp:
+        for row in reader(inp):
+            yield row
+
+
+def join_user_shards(global_path, local_paths, save_as):
+    """
+    The global file has a row for every (clickout_id, rank) in the order of the events.
+    Every local file has the rows of its users only (also in the order of the events), so the local files are
+    merged by (clickout_id, rank) and pasted next to the global rows.
+    """
+    local_readers = []
+    local_header = None
+    for path in local_paths:
+        rows = read_shard(path)
+        header = next(rows, None)
+        if header is None:
+            # no clickouts of the users from this shard
+            continue
+        local_header = header
+        local_readers.append(rows)
+
+    key = lambda row: (int(row[0]), int(row[1]))
+    local_rows = heapq.merge(*local_readers, key=key)
+
+    with open(global_path) as inp, open(save_as, "wt") as out:
+        global_rows = reader(inp)
+        global_header = next(global_rows)
+        clickout_pos = global_header.index("clickout_id")
+        rank_pos = global_header.index("rank")
+        w = writer(out, lineterminator="\n")
+        w.writerow(global_header + (local_header[2:] if local_header else []))
+        for global_row in global_rows:
+            local_row = next(local_rows, None) if local_header else ["", ""]
+            if local_row is None or local_row[:2] != [global_row[clickout_pos], global_row[rank_pos]]:
+                raise ValueError(
+                    "User shards are not aligned with the global file at clickout %s rank %s"
+                    % (global_row[clickout_pos], global_row[rank_pos])
+                )
+            w.writerow(global_row + local_row[2:])
+        if next(local_rows, None) is not None:
+            raise ValueError("User shards have more rows than the global file")
+
+
+@click.command()
+@click.option("--limit", type=int, help="Number of rows to process")
+@click.option("--n-shards", type=int, default=max(cpu_count() - 1, 1), help="Number of user shards")
+def main(limit, n_shards):
+    # parse the csv once, the workers memory map the store
+    store_path = "../../../data/events_sorted.store.joblib"
+    load_event_store(store_path, "../../../data/events_sorted.csv")
+
+    common_args = ["--store", store_path] + (["--limit", str(limit)] if limit else [])
+    global_path = "../../../data/events_sorted_trans_global.csv"
+    local_paths = ["../../../data/events_sorted_trans_user_%03d.csv" % shard for shard in range(n_shards)]
+
+    ps = [
+        subprocess.Popen(
+            ["python", "generate_training_data.py", "--partition", "global", "--save-as", global_path] + common_args
+        )
+    ]
+    for shard, path in enumerate(local_paths):
+        args = ["python", "generate_training_data.py", "--partition", "user_local", "--save-as", path]
+        args += ["--n-shards", str(n_shards), "--shard", str(shard)] + common_args
+        ps.append(subprocess.Popen(args))
+
+    for p in ps:
+        if p.wait() != 0:
+            raise RuntimeError("Feature generation failed: %s" % " ".join(p.args))
+
+    join_user_shards(global_path, local_paths, "../../../data/events_sorted_trans_all.csv")
+    for path in [global_path] + local_paths:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,136 +1,606 @@
-from csv import DictReader, DictWriter
+import csv
+import os
+import pickle
+import zlib
+from collections import defaultdict
+from itertools import islice, repeat
+from csv import DictReader
 
 import click
+import numpy as np
 import sys
 sys.path.append('/Users/josang-yeon/2020/tobigs/tobigs_reco_conf/recsys2019/src')
-from recsys.data_generator.accumulators import get_accumulators, logger, group_accumulators
+from recsys.data_generator.accumulators import (
+    accumulator_clickout_features,
+    get_accumulators,
+    logger,
+    get_state,
+    group_accumulators,
+    is_clickout_scope,
+    set_state,
+    shared_components,
+    split_user_local_accumulators,
+)
+from recsys.data_generator.event_store import EventStore
+from recsys.data_generator.feature_store import ColumnStoreWriter, ParquetBatchWriter, SplitWriter
+from recsys.data_generator.fingerprints import FingerprintCheck, fingerprint, impressions_fingerprints
+from recsys.data_generator.memory import MemoryMonitor
+from recsys.data_generator.profiling import Profiler
+
+
+# columns of the feature rows which differ between the impressions of a clickout (besides the item features)
+IMPRESSION_COLUMNS = ("clickout_id", "rank", "item_id", "was_clicked", "price")
+# columns added to the columns of the row, in this order
+ITEM_COLUMNS = ("item_id", "item_id_clicked", "was_clicked", "clickout_id", "rank", "price")
+# columns of the row which are not saved
+DROPPED_COLUMNS = {
+    "fake_impressions",
+    "fake_impressions_raw",
+    "fake_impressions_fp",
+    "fake_prices",
+    "impressions",
+    "impressions_raw",
+    "impressions_fp",
+    "impressions_set_fp",
+    "prices",
+    "action_type",
+}
+
+
+def user_shard(user_id, n_shards):
+    # crc32 instead of hash() because it has to be the same in every process
+    return zlib.crc32(user_id.encode("utf-8")) % n_shards
+
+
+class CsvWriter:
+    """
+    Writes the rows (the values in the order of the fieldnames) like DictWriter would write them as dicts
+    """
+
+    def __init__(self, path, fieldnames):
+        self.out = open(path, "wt")
+        self.fieldnames = list(fieldnames)
+        self.w = csv.writer(self.out, lineterminator="\n")
+        if fieldnames:
+            self.w.writerow(self.fieldnames)
+
+    def writerow(self, values):
+        self.w.writerow(values)
+
+    def close(self):
+        self.out.close()
+
+    def get_state(self):
+        self.out.flush()
+        return {"fieldnames": self.fieldnames, "position": self.out.tell()}
+
+    @classmethod
+    def from_state(cls, path, state):
+        """
+        Continues writing the file from the checkpoint, everything written after it is dropped
+        """
+        writer = cls.__new__(cls)
+        writer.out = open(path, "r+")
+        writer.out.seek(state["position"])
+        writer.out.truncate()
+        writer.fieldnames = state["fieldnames"]
+        writer.w = csv.writer(writer.out, lineterminator="\n")
+        return writer
+
+
+class RowEmitter:
+    """
+    Makes the output rows (tuples) of the impressions of a clickout from the statistics of the accumulators.
+    The columns are resolved once from the first clickout: the columns of the row (without DROPPED_COLUMNS),
+    ITEM_COLUMNS and the features, or only the index columns and the features with save_only_features.
+    Every next clickout only puts its values to the positions of the columns.
+    """
+
+    def __init__(self, save_only_features=False, index_columns=()):
+        self.save_only_features = save_only_features
+        self.index_columns = list(index_columns)
+        self.columns = None
+        self.features = None
+
+    def resolve(self, row, stats):
+        features = [name for name, _ in stats]
+        if self.save_only_features:
+            columns = self.index_columns + features
+        else:
+            # a name which repeats keeps its first position (like the keys of a dict)
+            columns = list(
+                dict.fromkeys([name for name in row if name not in DROPPED_COLUMNS] + list(ITEM_COLUMNS) + features)
+            )
+        self.set_columns(columns, features)
+
+    def set_columns(self, columns, features):
+        self.columns = columns
+        self.features = features
+        # the features overwrite the columns of the row and the item columns with the same name
+        self.feature_positions = defaultdict(list)
+        self.row_positions = []
+        self.item_positions = []
+        for position, name in enumerate(columns):
+            if name in features:
+                self.feature_positions[name].append(position)
+            elif name in ITEM_COLUMNS:
+                self.item_positions.append((position, name))
+            else:
+                self.row_positions.append((position, name))
+        self.feature_positions = dict(self.feature_positions)
+
+    def get_state(self):
+        return {"columns": self.columns, "features": self.features} if self.columns is not None else None
+
+    def set_state(self, state):
+        if state is not None:
+            self.set_columns(state["columns"], state["features"])
+
+    def rows(self, clickout_id, row, n, stats):
+        """
+        stats are the (feature, values of the n impressions) of the clickout
+        """
+        if n == 0:
+            return iter(())
+        if self.columns is None:
+            self.resolve(row, stats)
+        columns = [None] * len(self.columns)
+        for position, name in self.row_positions:
+            columns[position] = repeat(row.get(name), n)
+        for position, name in self.item_positions:
+            columns[position] = self.item_column(name, clickout_id, row, n)
+        for name, values in stats:
+            positions = self.feature_positions.get(name)
+            if positions is None:
+                raise ValueError("The feature %s is not in the output columns (fixed by the first clickout)" % name)
+            for position in positions:
+                columns[position] = values
+        for position, values in enumerate(columns):
+            if values is None:
+                # a feature the accumulators did not return for this clickout
+                columns[position] = repeat(None, n)
+        return zip(*columns)
+
+    @staticmethod
+    def item_column(name, clickout_id, row, n):
+        if name == "item_id":
+            return row["impressions"]
+        if name == "price":
+            return row["prices"]
+        if name == "rank":
+            return range(n)
+        if name == "was_clicked":
+            return [int(row["reference"] == item_id) for item_id in row["impressions"]]
+        if name == "item_id_clicked":
+            return repeat(row["reference"], n)
+        return repeat(clickout_id, n)
+
 
 class FeatureGenerator:
-    def __init__(self, limit, accumulators, save_only_features=False, input=None, save_as=None):
+    def __init__(
+        self,
+        limit,
+        accumulators,
+        save_only_features=False,
+        input=None,
+        save_as=None,
+        store=None,
+        shard=None,
+        index_columns=(),
+        rows=None,
+        output_format="csv",
+        split_output=False,
+        checkpoint_path=None,
+        checkpoint_every=None,
+        resume_from=None,
+        profile=None,
+        profile_every=None,
+        memory_every=None,
+        memory_budget=None,
+        memory_action="warn",
+        check_fingerprints=False,
+    ):
+        """
+        shard is a (shard, n_shards) tuple. If it is set only the events of the users from this shard are processed
+        (the clickout ids stay the same as in the full run). index_columns are saved together with the features
+        when save_only_features is set. rows is an iterable of already prepared rows (see event_fanout.py)
+        used instead of reading the input. With output_format="columns" save_as is a directory of typed column
+        files and with "parquet" a parquet file (see feature_store.py) instead of a csv.
+
+        With split_output the rows are saved as two tables (see SplitWriter): the impression table save_as
+        with the item columns and the item features and the clickout table (save_as with the _clickouts suffix)
+        with the event columns and the clickout scope features, one row per clickout.
+
+        Every checkpoint_every rows the state of all the accumulators and of the output is saved to checkpoint_path
+        (together with the number of rows already processed). resume_from is a checkpoint to continue from.
+        The parquet output does not support checkpoints.
+
+        profile is a path of the json report with the time spent in every accumulator and rows/s, clickouts/s.
+        It is saved at the end of the run and every profile_every rows. Without profile nothing is measured.
+
+        Every memory_every rows the memory of the accumulators and the RSS are logged. If the RSS is above
+        memory_budget (bytes) it warns or with memory_action="abort" saves a checkpoint (if checkpoint_path is set)
+        and raises MemoryError.
+
+        check_fingerprints validates that different impression lists never get the same fingerprint
+        (see fingerprints.py).
+        """
+        if output_format == "parquet" and (checkpoint_path or resume_from):
+            # a parquet file can not be reopened for appending, the checkpoint would fail only when it is saved
+            raise ValueError("Checkpoints are not supported for the parquet output, use csv or columns")
         self.limit = limit
+        self.components = shared_components(accumulators)
+        self.memory_every = memory_every
+        self.memory_monitor = (
+            MemoryMonitor(self.components + accumulators, memory_budget, memory_action) if memory_every else None
+        )
+        # before the profiler wraps the accumulators
+        self.clickout_scope = [is_clickout_scope(acc) for acc in accumulators]
+        self.clickout_features = {name for acc in accumulators for name in accumulator_clickout_features(acc)}
+        self.profiler = Profiler(accumulators, self.components, profile) if profile else None
+        components = self.components
+        if self.profiler:
+            accumulators = self.profiler.accumulators
+            components = self.profiler.components
+        self.profile_every = profile_every
         self.accumulators = accumulators
-        self.accs_by_action_type = group_accumulators(accumulators)
+        self.accs_by_action_type = group_accumulators(accumulators, components)
         self.save_only_features = save_only_features
         self.input = input
         self.save_as = save_as
+        self.store = store
+        self.shard = shard
+        self.index_columns = list(index_columns)
+        self.rows = rows
+        self.output_format = output_format
+        self.split_output = split_output
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.resume_from = resume_from
+        self.fingerprint_check = FingerprintCheck() if check_fingerprints else None
+        self.start = 0
+        self.writer = None
+        # the split output needs the clickout_id and rank of every row
+        split_index = ["clickout_id", "rank"] if split_output else []
+        self.emitter = RowEmitter(
+            save_only_features, split_index + [name for name in self.index_columns if name not in split_index]
+        )
+        self.n_events = 0
         print("Number of accumulators %d" % len(self.accumulators))
 
-    def calculate_features_per_item(self, clickout_id, item_id, price, rank, row):
-        obs = row.copy()
-        obs["item_id"] = item_id
-        obs["item_id_clicked"] = row["reference"]
-        obs["was_clicked"] = int(row["reference"] == item_id)
-        obs["clickout_id"] = clickout_id
-        obs["rank"] = rank
-        obs["price"] = price
-        obs["current_filters"] = row["current_filters"]
-        obs["clickout_step_rev"] = row["clickout_step_rev"]
-        obs["clickout_step"] = row["clickout_step"]
-        obs["clickout_max_step"] = row["clickout_max_step"]
-        features = self.update_obs_with_acc(obs, row)
-        del obs["fake_impressions"]
-        del obs["fake_impressions_raw"]
-        del obs["fake_prices"]
-        del obs["impressions"]
-        del obs["impressions_hash"]
-        del obs["impressions_raw"]
-        del obs["prices"]
-        del obs["action_type"]
-        return obs, features
-
-    def update_obs_with_acc(self, obs, row):
-        features = []
-        for acc in self.accumulators:
-            value = acc.get_stats(row, obs)
-            if isinstance(value, dict):
-                for k, v in value.items():
-                    obs[k] = v
-                    features.append(k)
+    def calculate_features_per_clickout(self, clickout_id, row):
+        """
+        Returns the output rows (tuples with the values of self.emitter.columns) of the impressions
+        """
+        items = [
+            {"item_id": item_id, "rank": rank, "price": price}
+            for rank, (item_id, price) in enumerate(zip(row["impressions"], row["prices"]))
+        ]
+        return self.emitter.rows(clickout_id, row, len(items), self.calculate_stats(items, row))
+
+    def calculate_stats(self, items, row):
+        """
+        Returns the (feature, values of the items) of all the accumulators.
+        Accumulators with get_stats_batch calculate the statistics for all the impressions at once,
+        the rest is called per item. The statistics of the accumulators with the clickout scope (see StatsAcc)
+        are calculated for the first item and repeated for the others.
+        """
+        stats = []
+        n = len(items)
+        for acc, clickout_scope in zip(self.accumulators, self.clickout_scope):
+            if clickout_scope and items:
+                value = acc.get_stats(row, items[0])
+                if isinstance(value, dict):
+                    stats.extend((k, repeat(v, n)) for k, v in value.items())
+                else:
+                    stats.append((acc.name, repeat(value, n)))
+            elif hasattr(acc, "get_stats_batch"):
+                stats.extend(acc.get_stats_batch(row, items).items())
             else:
-                obs[acc.name] = acc.get_stats(row, obs)
-                features.append(acc.name)
-        return features
+                values = [acc.get_stats(row, item) for item in items]
+                if values and isinstance(values[0], dict):
+                    stats.extend((k, [value.get(k) for value in values]) for k in values[0])
+                else:
+                    stats.append((acc.name, values))
+        return stats
 
     def generate_features(self):
         logger.info("Starting feature generation")
+        if self.resume_from:
+            self.load_checkpoint(self.resume_from)
         rows_gen = self.read_rows()
         logger.info("Starting processing")
         output_obs_gen = self.process_rows(rows_gen)
         self.save_rows(output_obs_gen)
 
-    def save_rows(self, output_obs):
-        out = open(self.save_as, "wt")
-        first_row = True
-        for obs, features in output_obs:
-            if first_row:
-                if self.save_only_features:
-                    dw = DictWriter(out, fieldnames=features, lineterminator="\n")
-                else:
-                    dw = DictWriter(out, fieldnames=obs.keys(), lineterminator="\n")
-                dw.writeheader()
-                first_row = False
-            if self.save_only_features:
-                obs = {k: v for k, v in obs.items() if k in features}
-                dw.writerow(obs)
-            else:
-                dw.writerow(obs)
-        out.close()
+    def save_rows(self, output_rows):
+        for values in output_rows:
+            if self.writer is None:
+                self.writer = self.create_writer(self.emitter.columns, self.emitter.features)
+            self.writer.writerow(values)
+        if self.writer is None:
+            # no clickouts, the output is empty
+            self.writer = self.create_writer(self.emitter.index_columns if self.split_output else [], [])
+        self.writer.close()
+
+    def create_writer(self, columns, features):
+        if not self.split_output:
+            return self.writer_class()(self.save_as, columns)
+        # the event columns and the clickout scope features go to the clickout table
+        clickout_columns = [
+            name
+            for name in columns
+            if name in self.clickout_features or (name not in features and name not in IMPRESSION_COLUMNS)
+        ]
+        impression_columns = [name for name in columns if name not in clickout_columns]
+        return SplitWriter(
+            self.writer_class(),
+            self.save_as,
+            columns,
+            ["clickout_id", "rank"] + [name for name in impression_columns if name not in ("clickout_id", "rank")],
+            ["clickout_id"] + clickout_columns,
+        )
+
+    def writer_class(self):
+        if self.output_format == "columns":
+            return ColumnStoreWriter
+        if self.output_format == "parquet":
+            return ParquetBatchWriter
+        return CsvWriter
+
+    def save_checkpoint(self, offset):
+        """
+        Called before the row number offset is processed, so all the output of the previous rows is already written
+        """
+        logger.info("Saving checkpoint at row %d" % offset)
+        checkpoint = {
+            "offset": offset,
+            "accumulators": [getattr(acc, "name", type(acc).__name__) for acc in self.accumulators],
+            "states": [get_state(acc) for acc in self.accumulators],
+            "components": {component.name: get_state(component) for component in self.components},
+            "writer": self.writer.get_state() if self.writer is not None else None,
+            "emitter": self.emitter.get_state(),
+        }
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "wb") as out:
+            pickle.dump(checkpoint, out, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def load_checkpoint(self, path):
+        with open(path, "rb") as inp:
+            checkpoint = pickle.load(inp)
+        names = [getattr(acc, "name", type(acc).__name__) for acc in self.accumulators]
+        if checkpoint["accumulators"] != names:
+            raise ValueError("The checkpoint %s was saved with different accumulators" % path)
+        if set(checkpoint.get("components", {})) != {component.name for component in self.components}:
+            raise ValueError("The checkpoint %s was saved with different shared state components" % path)
+        for acc, state in zip(self.accumulators, checkpoint["states"]):
+            set_state(acc, state)
+        for component in self.components:
+            set_state(component, checkpoint["components"][component.name])
+        if checkpoint["writer"] is not None and self.split_output:
+            self.writer = SplitWriter.from_state(self.writer_class(), self.save_as, checkpoint["writer"])
+        elif checkpoint["writer"] is not None:
+            self.writer = self.writer_class().from_state(self.save_as, checkpoint["writer"])
+        self.emitter.set_state(checkpoint["emitter"])
+        self.start = checkpoint["offset"]
+        logger.info("Resuming from row %d" % self.start)
 
     def read_rows(self):
+        """
+        Rows of the users outside of the shard are yielded as None
+        """
+        if self.rows is not None:
+            yield from self.rows
+            return
+        if self.store is not None:
+            print("Reading rows from the event store")
+            yield from self.store.iter_rows(limit=self.limit, mask=self.store_shard_mask(), start=self.start)
+            return
         inp = open(self.input)
         dr = DictReader(inp)
         print("Reading rows")
-        for i, row in enumerate(dr):
-            yield row
+        for i, row in enumerate(islice(dr, self.start, None), self.start):
+            if self.shard is None or user_shard(row["user_id"], self.shard[1]) == self.shard[0]:
+                yield self.prepare_row(row)
+            else:
+                yield None
             if self.limit and i > self.limit:
                 break
         inp.close()
 
+    def store_shard_mask(self):
+        if self.shard is None:
+            return None
+        shard, n_shards = self.shard
+        users = self.store.vocabularies["user_id"].values
+        users_in_shard = np.array([user_shard(user_id, n_shards) == shard for user_id in users], dtype=bool)
+        return users_in_shard[self.store.codes["user_id"]]
+
+    @staticmethod
+    def prepare_row(row):
+        row["timestamp"] = int(row["timestamp"])
+
+        row["fake_impressions_raw"] = row["fake_impressions"]
+        row["fake_impressions_fp"] = fingerprint(row["fake_impressions_raw"])
+        row["fake_impressions"] = row["fake_impressions"].split("|")
+        row["fake_index_interacted"] = (
+            row["fake_impressions"].index(row["reference"])
+            if row["reference"] in row["fake_impressions"]
+            else -1000
+        )
+
+        if row["action_type"] == "clickout item":
+            row["impressions_raw"] = row["impressions"]
+            row["impressions"] = row["impressions"].split("|")
+            # the impression lists are keyed by their fingerprints in the accumulators
+            row["impressions_fp"], row["impressions_set_fp"] = impressions_fingerprints(
+                row["impressions_raw"], row["impressions"]
+            )
+            row["index_clicked"] = (
+                row["impressions"].index(row["reference"]) if row["reference"] in row["impressions"] else -1000
+            )
+            row["prices"] = list(map(int, row["prices"].split("|")))
+            row["price_clicked"] = row["prices"][row["index_clicked"]] if row["index_clicked"] >= 0 else 0
+        return row
+
     def process_rows(self, rows):
-        for clickout_id, row in enumerate(rows):
+        offset = self.start
+        for clickout_id, row in enumerate(rows, self.start):
             if clickout_id % 100000 == 0:
                 print(self.save_as, clickout_id)
-            row["timestamp"] = int(row["timestamp"])
-
-            row["fake_impressions_raw"] = row["fake_impressions"]
-            row["fake_impressions"] = row["fake_impressions"].split("|")
-            row["fake_index_interacted"] = (
-                row["fake_impressions"].index(row["reference"])
-                if row["reference"] in row["fake_impressions"]
-                else -1000
-            )
+            if self.checkpoint_every and clickout_id % self.checkpoint_every == 0 and clickout_id != self.start:
+                self.save_checkpoint(clickout_id)
+            offset = clickout_id + 1
+            if row is None:
+                continue
+            yield from self.process_row(clickout_id, row)
+            if self.profiler:
+                self.profiler.add_row(row)
+                if self.profile_every and self.profiler.rows % self.profile_every == 0:
+                    self.profiler.save()
+            if self.memory_monitor and offset % self.memory_every == 0:
+                self.check_memory(offset)
+        if self.checkpoint_path:
+            # lets the run continue when new events are appended to the input
+            self.save_checkpoint(offset)
+        if self.profiler:
+            self.profiler.save()
 
-            if row["action_type"] == "clickout item":
-                row["impressions_raw"] = row["impressions"]
-                row["impressions"] = row["impressions"].split("|")
-                row["impressions_hash"] = "|".join(sorted(row["impressions"]))
-                row["index_clicked"] = (
-                    row["impressions"].index(row["reference"]) if row["reference"] in row["impressions"] else -1000
-                )
-                row["prices"] = list(map(int, row["prices"].split("|")))
-                row["price_clicked"] = row["prices"][row["index_clicked"]] if row["index_clicked"] >= 0 else 0
-                for rank, (item_id, price) in enumerate(zip(row["impressions"], row["prices"])):
-                    obs, features = self.calculate_features_per_item(clickout_id, item_id, price, rank, row)
-                    yield obs, features
+    def check_memory(self, offset):
+        try:
+            self.memory_monitor.check(offset)
+        except MemoryError:
+            if self.checkpoint_path:
+                self.save_checkpoint(offset)
+            raise
 
-            if int(row["is_test"]) == 0:
-                for acc in self.accs_by_action_type[row["action_type"]]:
-                    acc.update_acc(row)
+    def process_row(self, clickout_id, row):
+        """
+        Returns the output rows of the impressions if the row is a clickout and updates the accumulators
+        """
+        output = []
+        if self.fingerprint_check:
+            self.fingerprint_check.check(row)
+        if row["action_type"] == "clickout item":
+            output = list(self.calculate_features_per_clickout(clickout_id, row))
+
+        if int(row["is_test"]) == 0:
+            for acc in self.accs_by_action_type[row["action_type"]]:
+                acc.update_acc(row)
+        return output
+
+    def push_event(self, event):
+        """
+        Streaming API: processes one event (a dict with the columns of events_sorted.csv, in time order) without
+        touching the disk. Returns the feature rows of the impressions for a clickout, an empty list otherwise.
+
+        generator = FeatureGenerator(limit=None, accumulators=get_accumulators())
+        for event in events:
+            rows = generator.push_event(event)
+        """
+        row = self.prepare_row(dict(event))
+        clickout_id = self.n_events
+        self.n_events += 1
+        return [dict(zip(self.emitter.columns, values)) for values in self.process_row(clickout_id, row)]
+
+
+def load_event_store(path, csv_path):
+    if os.path.exists(path):
+        logger.info("Loading the event store %s" % path)
+        return EventStore.load(path)
+    logger.info("Building the event store from %s" % csv_path)
+    store = EventStore.from_csv(csv_path)
+    store.save(path)
+    return store
 
 
 @click.command()
 @click.option("--limit", type=int, help="Number of rows to process")
 @click.option("--hashn", type=int, default=None, help="Chunk number")
-def main(limit, hashn):
+@click.option("--store", type=str, default=None, help="Path to the event store (created from the csv if missing)")
+@click.option(
+    "--partition",
+    type=click.Choice(["all", "user_local", "global"]),
+    default="all",
+    help="Run all, only user local or only global accumulators",
+)
+@click.option("--n-shards", type=int, default=None, help="Number of user shards")
+@click.option("--shard", type=int, default=None, help="User shard number")
+@click.option("--save-as", type=str, default=None, help="Output path")
+@click.option("--output-format", type=click.Choice(["csv", "columns", "parquet"]), default="csv", help="Output format")
+@click.option("--split-output", is_flag=True, help="Save a clickout table and an impression table")
+@click.option("--checkpoint-every", type=int, default=None, help="Save a checkpoint every n rows")
+@click.option("--checkpoint-path", type=str, default=None, help="Checkpoint path (save_as + .checkpoint by default)")
+@click.option("--resume-from", type=str, default=None, help="Checkpoint to resume from")
+@click.option("--profile", type=str, default=None, help="Save the accumulators profile (json) to this path")
+@click.option("--profile-every", type=int, default=None, help="Save the profile every n rows")
+@click.option("--memory-every", type=int, default=None, help="Log the memory of the accumulators every n rows")
+@click.option("--memory-budget", type=int, default=None, help="Memory budget in MB")
+@click.option("--memory-action", type=click.Choice(["warn", "abort"]), default="warn", help="Over the budget action")
+@click.option("--features", type=str, default=None, help="File with the requested features (one per line)")
+@click.option("--vectorizer-features", is_flag=True, help="Calculate only the features make_vectorizer_1 reads")
+@click.option("--check-fingerprints", is_flag=True, help="Check the impression fingerprints for collisions")
+def main(
+    limit,
+    hashn,
+    store,
+    partition,
+    n_shards,
+    shard,
+    save_as,
+    output_format,
+    split_output,
+    checkpoint_every,
+    checkpoint_path,
+    resume_from,
+    profile,
+    profile_every,
+    memory_every,
+    memory_budget,
+    memory_action,
+    features,
+    vectorizer_features,
+    check_fingerprints,
+):
+    if output_format == "parquet" and (checkpoint_every or checkpoint_path or resume_from):
+        # before the store is built and anything is written
+        raise click.UsageError("Checkpoints are not supported for the parquet output, use csv or columns")
     print(hashn)
-    save_as = "../../../data/events_sorted_trans_%03d.csv" % (hashn)
-    accumulators = get_accumulators(hashn)
+    save_as = save_as or "../../../data/events_sorted_trans_%03d.csv" % (hashn)
+    requested_features = None
+    if features:
+        with open(features) as inp:
+            requested_features = [line.strip() for line in inp if line.strip()]
+    if vectorizer_features:
+        # imported only here, the vectorizers need sklearn and the item artifacts
+        from recsys.vectorizers import make_vectorizer_1_features
+
+        requested_features = (requested_features or []) + make_vectorizer_1_features()
+    accumulators = get_accumulators(hashn, features=requested_features)
+    if partition != "all":
+        user_local, other = split_user_local_accumulators(accumulators)
+        accumulators = user_local if partition == "user_local" else other
     feature_generator = FeatureGenerator(
         limit=limit,
         accumulators=accumulators,
-        save_only_features=hashn != 0,
+        save_only_features=(hashn is not None and hashn != 0) or partition == "user_local",
         input="../../../data/events_sorted.csv",
         save_as=save_as,
+        store=load_event_store(store, "../../../data/events_sorted.csv") if store else None,
+        shard=(shard, n_shards) if n_shards else None,
+        index_columns=["clickout_id", "rank"] if partition == "user_local" else [],
+        output_format=output_format,
+        split_output=split_output,
+        checkpoint_path=checkpoint_path or (save_as + ".checkpoint" if checkpoint_every else None),
+        checkpoint_every=checkpoint_every,
+        resume_from=resume_from,
+        profile=profile,
+        profile_every=profile_every,
+        memory_every=memory_every,
+        memory_budget=memory_budget * 2 ** 20 if memory_budget else None,
+        memory_action=memory_action,
+        check_fingerprints=check_fingerprints,
     )
     feature_generator.generate_features()
 
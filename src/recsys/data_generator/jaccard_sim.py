@@ -1,14 +1,61 @@
+from collections import OrderedDict
+
 import joblib
 import numpy as np
 
+from recsys.data_generator.compact_state import SortedSums
+
+# bits set in every byte value, popcount of numpy < 2.0 (no np.bitwise_count)
+BYTE_POPCOUNT = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.int64)
+
 
 def jaccard(a, b):
     return len(a & b) / (len(a | b) + 1)
 
 
+def popcount(words):
+    """
+    Number of set bits of the uint64 words summed over the last axis
+    """
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    return BYTE_POPCOUNT[words.view(np.uint8)].sum(axis=-1)
+
+
 class JaccardItemSim:
-    def __init__(self, path):
+    """
+    Jaccard similarity of the sets of the items (properties, pois) in imm.
+
+    The sets are also packed to bit arrays: row code of a uint64 matrix per item, one bit per distinct value,
+    row 0 is the empty set of the unknown items. list_to_items compares all the impressions to all the other items
+    with one popcount of the matrix. If the values need more than max_words words per item the matrix would be too
+    large and the similarities are computed on the sets. two_items keeps the last cache_size pairs.
+    """
+
+    def __init__(self, path, max_words=64, cache_size=2 ** 16):
         self.imm = joblib.load(path)
+        self.cache_size = cache_size
+        self.pairs = OrderedDict()
+        self.item_codes = {}
+        self.bits = None
+        self.sizes = None
+        self.pack(max_words)
+
+    def pack(self, max_words):
+        values = sorted(set().union(*self.imm.values()), key=str)
+        n_words = max((len(values) + 63) // 64, 1)
+        if n_words > max_words:
+            return
+        value_codes = {value: code for code, value in enumerate(values)}
+        self.item_codes = {item: code for code, item in enumerate(self.imm, 1)}
+        rows = [code for item, code in self.item_codes.items() for _ in self.imm[item]]
+        columns = np.array([value_codes[value] for item in self.item_codes for value in self.imm[item]], dtype=np.int64)
+        self.bits = np.zeros((len(self.item_codes) + 1, n_words), dtype=np.uint64)
+        np.bitwise_or.at(self.bits, (rows, columns >> 6), np.left_shift(np.uint64(1), (columns & 63).astype(np.uint64)))
+        self.sizes = popcount(self.bits)
+
+    def codes(self, items):
+        return np.array([self.item_codes.get(item, 0) for item in items], dtype=np.int64)
 
     def list_to_item(self, other_items, item):
         if other_items:
@@ -17,9 +64,33 @@ class JaccardItemSim:
         else:
             return 0
 
+    def list_to_items(self, other_items, items):
+        """
+        list_to_item of every item, the similarities of all the pairs (other item, item) in one numpy operation.
+        The similarities of an item are summed in the order of other_items like in list_to_item.
+        """
+        if not other_items:
+            return [0] * len(items)
+        if self.bits is None:
+            return [self.list_to_item(other_items, item) for item in items]
+        other_codes = self.codes(other_items)
+        codes = self.codes(items)
+        intersections = popcount(self.bits[other_codes][:, None, :] & self.bits[codes][None, :, :])
+        unions = self.sizes[other_codes][:, None] + self.sizes[codes][None, :] - intersections
+        sims = intersections / (unions + 1)
+        # summed by python, numpy can sum pairwise and change the last digit
+        return [sum(column) / len(other_items) for column in sims.T.tolist()]
+
     def two_items(self, a, b):
         if b != 0:
-            return jaccard(self.imm[a], self.imm[b])
+            sim = self.pairs.get((a, b))
+            if sim is not None:
+                self.pairs.move_to_end((a, b))
+                return sim
+            sim = self.pairs[(a, b)] = jaccard(self.imm.get(a, set()), self.imm.get(b, set()))
+            if len(self.pairs) > self.cache_size:
+                self.pairs.popitem(last=False)
+            return sim
         else:
             return 0
 
@@ -39,9 +110,31 @@ class JaccardItemSim:
 
 
 class ItemPriceSim:
+    """
+    Average absolute difference of the price of the item to the prices of the other items.
+    list_to_items sorts the prices of the other items once (with prefix sums) and answers every item
+    with two binary searches.
+    """
+
+    default_sim = 1000
+
     def __init__(self, path):
         self.item_prices = joblib.load(path)
 
+    def list_to_items(self, other_items, items):
+        """
+        list_to_item of every item, up to the rounding of the prefix sums
+        """
+        other_prices = SortedSums.from_values(self.item_prices[a] for a in other_items if a in self.item_prices)
+        if not other_prices:
+            return [self.default_sim] * len(items)
+        return [
+            other_prices.abs_diffs(self.item_prices[item]) / len(other_prices)
+            if item in self.item_prices
+            else self.default_sim
+            for item in items
+        ]
+
     def list_to_item(self, other_items, item):
         default_sim = 1000
         if other_items and item in self.item_prices:
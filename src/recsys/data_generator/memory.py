@@ -0,0 +1,183 @@
+import sys
+from csv import DictReader
+from itertools import islice
+
+import click
+
+from recsys.data_generator.accumulators import get_accumulators, get_state, group_accumulators, logger
+
+CONTAINERS = (dict, list, set, frozenset, tuple)
+
+
+def process_rss():
+    """
+    Resident set size of the process in bytes
+    """
+    try:
+        with open("/proc/self/status") as inp:
+            for line in inp:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+
+    # peak instead of current RSS, in bytes on mac and in kilobytes on linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def estimate_size(obj, sample_size=20, depth=4):
+    """
+    Estimates the deep size of obj in bytes. Only sample_size elements of every container are measured
+    and the result is scaled by the number of elements, so the cost does not depend on the size of the state.
+    """
+    size = sys.getsizeof(obj)
+    if hasattr(obj, "tables"):
+        # compact state tables (see compact_state.py), the shared interners are counted separately
+        return size + sum(estimate_size(table, sample_size, depth) for table in obj.tables())
+    if depth == 0 or not isinstance(obj, CONTAINERS) or not obj:
+        return size
+    if isinstance(obj, dict):
+        sample = list(islice(obj.items(), sample_size))
+    else:
+        sample = list(islice(obj, sample_size))
+    sampled = sum(estimate_size(value, sample_size, depth - 1) for value in sample)
+    return size + sampled * len(obj) / len(sample)
+
+
+def count_entries(obj):
+    return len(obj) if isinstance(obj, CONTAINERS) or hasattr(obj, "tables") else 0
+
+
+def state_interners(state):
+    """
+    The shared (named) interners used by the compact tables in the state of an accumulator
+    """
+    interners = []
+    for value in state.values():
+        interners.extend(getattr(value, "interners", ()))
+        if hasattr(value, "interner"):
+            interners.append(value.interner)
+    return [interner for interner in interners if interner.name]
+
+
+def accumulator_key(acc):
+    name = getattr(acc, "name", None)
+    return "%s(%s)" % (type(acc).__name__, name) if name else type(acc).__name__
+
+
+class MemoryMonitor:
+    """
+    Estimates the memory used by the state of every accumulator (entries in its dicts/sets/lists and their
+    sampled size) together with the RSS of the process and logs it as a table.
+
+    If budget (in bytes) is set and the RSS is above it, it warns or raises MemoryError (action="abort"),
+    so the run can be stopped (and checkpointed) before the machine runs out of memory.
+    """
+
+    def __init__(self, accumulators, budget=None, action="warn", sample_size=20):
+        self.accumulators = accumulators
+        self.budget = budget
+        self.action = action
+        self.sample_size = sample_size
+
+    def table(self):
+        rows = []
+        interners = {}
+        for acc in self.accumulators:
+            state = get_state(acc)
+            rows.append(
+                {
+                    "accumulator": accumulator_key(acc),
+                    "entries": sum(count_entries(value) for value in state.values()),
+                    "bytes": sum(estimate_size(value, self.sample_size) for value in state.values()),
+                }
+            )
+            for interner in state_interners(state):
+                interners[id(interner)] = interner
+        for interner in interners.values():
+            rows.append(
+                {
+                    "accumulator": accumulator_key(interner),
+                    "entries": len(interner),
+                    "bytes": estimate_size(interner, self.sample_size),
+                }
+            )
+        return sorted(rows, key=lambda row: row["bytes"], reverse=True)
+
+    def check(self, n_rows):
+        rss = process_rss()
+        table = self.table()
+        logger.info("Memory after %d rows: RSS %.1f MB" % (n_rows, rss / 2 ** 20))
+        for row in table:
+            logger.info("%10.1f MB %12d entries  %s" % (row["bytes"] / 2 ** 20, row["entries"], row["accumulator"]))
+
+        if self.budget and rss > self.budget:
+            message = "RSS %.1f MB is above the memory budget %.1f MB (largest accumulator %s)" % (
+                rss / 2 ** 20,
+                self.budget / 2 ** 20,
+                table[0]["accumulator"] if table else None,
+            )
+            if self.action == "abort":
+                raise MemoryError(message)
+            logger.warning(message)
+        return rss, table
+
+
+def compaction_table(accumulators, sample_size=20):
+    """
+    Estimated size of the compact tables (see compact_state.py) of every accumulator before (as the dicts keyed by
+    tuples they replace) and after the compaction. The shared interners are one row each.
+    """
+    rows = []
+    interners = {}
+    for acc in accumulators:
+        state = get_state(acc)
+        tables = [value for value in state.values() if hasattr(value, "to_dict")]
+        if not tables:
+            continue
+        rows.append(
+            {
+                "accumulator": accumulator_key(acc),
+                "before": sum(estimate_size(table.to_dict(), sample_size) for table in tables),
+                "after": sum(estimate_size(table, sample_size) for table in tables),
+            }
+        )
+        for interner in state_interners(state):
+            interners[id(interner)] = interner
+    for interner in interners.values():
+        rows.append({"accumulator": accumulator_key(interner), "before": 0, "after": estimate_size(interner)})
+    return rows
+
+
+@click.command()
+@click.option("--input", default="../../../data/events_sorted.csv", help="Events to update the accumulators with")
+@click.option("--limit", type=int, default=1000000, help="Number of rows to process")
+def main(input, limit):
+    """
+    Logs the memory of the compact state tables before and after the compaction
+    """
+    from recsys.data_generator.generate_training_data import FeatureGenerator
+
+    accumulators = get_accumulators()
+    accs_by_action_type = group_accumulators(accumulators)
+    with open(input) as inp:
+        for row in islice(DictReader(inp), limit):
+            row = FeatureGenerator.prepare_row(row)
+            if int(row["is_test"]) == 0:
+                for acc in accs_by_action_type[row["action_type"]]:
+                    acc.update_acc(row)
+
+    rows = compaction_table(accumulators)
+    for row in rows:
+        ratio = "%5.1fx" % (row["before"] / row["after"]) if row["before"] else "     -"
+        before, after = row["before"] / 2 ** 20, row["after"] / 2 ** 20
+        logger.info("%10.2f MB -> %8.2f MB %s  %s" % (before, after, ratio, row["accumulator"]))
+    before = sum(row["before"] for row in rows)
+    after = sum(row["after"] for row in rows)
+    logger.info("%10.2f MB -> %8.2f MB %5.1fx  total" % (before / 2 ** 20, after / 2 ** 20, before / max(after, 1)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+import time
+from collections import defaultdict
+from csv import DictReader
+from itertools import islice
+
+import click
+import numpy as np
+
+from recsys.data_generator.fingerprints import fingerprint
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def union_size(a, b):
+    return len(a.keys() | b.keys())
+
+
+def intersection_size(a, b):
+    return len(a.keys() & b.keys())
+
+
+def jaccard(a, b):
+    union = len(a.keys() | b.keys())
+    return len(a.keys() & b.keys()) / union if union else 0
+
+
+# similarities of the item sets of two users (dicts with the items as the keys, see UserItemGraph),
+# "union" is what MostSimilarUserItemInteraction always used
+SIMILARITIES = {"union": union_size, "intersection": intersection_size, "jaccard": jaccard}
+
+
+class MinHashLsh:
+    """
+    MinHash signatures of the item sets of the users with an LSH banding index.
+
+    The signature has bands * rows minimums of universal hashes of the items, it is updated when the user
+    interacts with an item. Users whose signatures are the same in all the rows of at least one band share
+    a bucket and are candidates of each other: with the Jaccard similarity J of their item sets
+    the probability is 1 - (1 - J ** rows) ** bands (see benchmark below to choose the parameters).
+    Every user is in one bucket per band.
+    """
+
+    def __init__(self, bands=16, rows=4, seed=1):
+        self.bands = bands
+        self.rows = rows
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, 1 << 32, size=bands * rows, dtype=np.uint64)
+        self.b = rng.randint(0, 1 << 32, size=bands * rows, dtype=np.uint64)
+        # the rows of a band are combined to one key with odd multipliers
+        self.band_weights = rng.randint(0, 1 << 63, size=rows, dtype=np.uint64) | np.uint64(1)
+        self.signatures = {}
+        self.band_keys = {}
+        self.buckets = [defaultdict(set) for _ in range(bands)]
+
+    def item_hashes(self, item_id):
+        x = np.uint64(fingerprint(str(item_id)) & 0xFFFFFFFF)
+        return (self.a * x + self.b) % MERSENNE_PRIME & MAX_HASH
+
+    def keys(self, signature):
+        return (signature.reshape(self.bands, self.rows) * self.band_weights).sum(axis=1).tolist()
+
+    def add(self, user_id, item_id):
+        hashes = self.item_hashes(item_id)
+        signature = self.signatures.get(user_id)
+        if signature is not None:
+            if not (hashes < signature).any():
+                # the item is already in the set or it does not change the signature
+                return
+            hashes = np.minimum(signature, hashes)
+        self.signatures[user_id] = hashes
+        keys = self.keys(hashes)
+        old_keys = self.band_keys.get(user_id)
+        for band, key in enumerate(keys):
+            if old_keys is not None:
+                if old_keys[band] == key:
+                    continue
+                bucket = self.buckets[band][old_keys[band]]
+                bucket.discard(user_id)
+                if not bucket:
+                    del self.buckets[band][old_keys[band]]
+            self.buckets[band][key].add(user_id)
+        self.band_keys[user_id] = keys
+
+    def candidates(self, user_id):
+        """
+        The users who share at least one bucket with the user
+        """
+        users = set()
+        for bucket, key in zip(self.buckets, self.band_keys.get(user_id, ())):
+            users |= bucket.get(key, set())
+        users.discard(user_id)
+        return users
+
+
+def top_similar_users(candidates, user_items, users_items, k, similarity="union"):
+    """
+    The k candidates with the highest exact similarity of their items (users_items) to user_items.
+    Candidates without any similarity are dropped, the ties are ordered by the user id.
+    """
+    similarity = SIMILARITIES[similarity]
+    scores = [(similarity(users_items[user_id], user_items), user_id) for user_id in candidates]
+    scores = sorted((score, user_id) for score, user_id in scores if score > 0)
+    scores.sort(key=lambda score_user: score_user[0], reverse=True)
+    return [user_id for _, user_id in scores[:k]]
+
+
+def exact_similar_users(user_id, users_items, items_users, k, similarity="union"):
+    """
+    The scan the accumulators do without the index: all the users who share an item with the user
+    """
+    user_items = users_items[user_id]
+    candidates = {other_user_id for item_id in user_items for other_user_id in items_users[item_id]}
+    candidates.discard(user_id)
+    return top_similar_users(candidates, user_items, users_items, k, similarity)
+
+
+def recall(found, exact, user_items, users_items, similarity):
+    """
+    Share of the exact top k found by the index. A user with the same similarity as the last of the exact top k
+    counts as found (the order of the ties is arbitrary).
+    """
+    if not exact:
+        return None
+    similarity = SIMILARITIES[similarity]
+    threshold = similarity(users_items[exact[-1]], user_items)
+    hits = sum(1 for user_id in found if similarity(users_items[user_id], user_items) >= threshold)
+    return min(hits, len(exact)) / len(exact)
+
+
+@click.command()
+@click.option("--input", default="../../../data/events_sorted.csv", help="Events to replay")
+@click.option("--limit", type=int, default=None, help="Number of events to replay")
+@click.option("--bands", type=int, multiple=True, default=[8, 16, 32], help="Numbers of bands to try")
+@click.option("--rows", type=int, multiple=True, default=[2, 4], help="Rows per band to try")
+@click.option("--k", type=int, default=1, help="Number of the most similar users")
+@click.option("--similarity", type=click.Choice(sorted(SIMILARITIES)), default="jaccard", help="Re-ranking similarity")
+@click.option("--every", type=int, default=10, help="Query every n-th clickout")
+def benchmark(input, limit, bands, rows, k, similarity, every):
+    """
+    Replays the events, for every n-th clickout finds the k most similar users with the exact scan
+    and with the index of every (bands, rows) and reports the recall, the number of candidates and the time
+    """
+    # imported here, accumulators.py imports this module
+    from recsys.data_generator.accumulators import ACTIONS_WITH_ITEM_REFERENCE
+
+    users_items = defaultdict(dict)
+    items_users = defaultdict(dict)
+    configs = [(n_bands, n_rows) for n_bands in bands for n_rows in rows]
+    indices = {config: MinHashLsh(*config) for config in configs}
+    recalls = {config: [] for config in configs}
+    candidates = {config: 0 for config in configs}
+    times = {config: 0.0 for config in configs}
+    exact_time = 0.0
+    n_queries = 0
+    n_clickouts = 0
+    with open(input) as inp:
+        for row in islice(DictReader(inp), limit):
+            if row["action_type"] == "clickout item":
+                n_clickouts += 1
+                if n_clickouts % every == 0 and users_items.get(row["user_id"]):
+                    n_queries += 1
+                    user_items = users_items[row["user_id"]]
+                    start = time.perf_counter()
+                    exact = exact_similar_users(row["user_id"], users_items, items_users, k, similarity)
+                    exact_time += time.perf_counter() - start
+                    for config, index in indices.items():
+                        start = time.perf_counter()
+                        users = index.candidates(row["user_id"])
+                        found = top_similar_users(users, user_items, users_items, k, similarity)
+                        times[config] += time.perf_counter() - start
+                        candidates[config] += len(users)
+                        value = recall(found, exact, user_items, users_items, similarity)
+                        if value is not None:
+                            recalls[config].append(value)
+            if int(row["is_test"]) == 0 and row["action_type"] in ACTIONS_WITH_ITEM_REFERENCE:
+                users_items[row["user_id"]][row["reference"]] = None
+                items_users[row["reference"]][row["user_id"]] = None
+                for index in indices.values():
+                    index.add(row["user_id"], row["reference"])
+
+    print("%d queries, exact scan %.3f ms/query" % (n_queries, 1000 * exact_time / max(n_queries, 1)))
+    print("%6s %5s %8s %11s %9s" % ("bands", "rows", "recall", "candidates", "ms/query"))
+    for config in configs:
+        print(
+            "%6d %5d %8.4f %11.1f %9.3f"
+            % (
+                config[0],
+                config[1],
+                float(np.mean(recalls[config])) if recalls[config] else float("nan"),
+                candidates[config] / max(n_queries, 1),
+                1000 * times[config] / max(n_queries, 1),
+            )
+        )
+
+
+if __name__ == "__main__":
+    benchmark()
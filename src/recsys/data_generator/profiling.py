@@ -0,0 +1,127 @@
+import json
+import time
+
+from recsys.data_generator.accumulators import get_state, set_state
+
+
+class CallStats:
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+
+    def to_dict(self):
+        return {"calls": self.calls, "wall": self.wall, "cpu": self.cpu}
+
+
+class ProfiledAccumulator:
+    """
+    Wraps an accumulator (or a shared state component) and measures the wall and CPU time of update_acc
+    and get_stats(_batch). Everything else is delegated to the wrapped accumulator. The features of
+    an accumulator which does not declare them are learned from the first get_stats call.
+    """
+
+    def __init__(self, acc):
+        self.acc = acc
+        features = getattr(acc, "features", None)
+        self.features = list(features) if features is not None else None
+        self.update_stats = CallStats()
+        self.get_stats_stats = CallStats()
+        if hasattr(acc, "get_stats_batch"):
+            # FeatureGenerator checks hasattr(acc, "get_stats_batch")
+            self.get_stats_batch = self._get_stats_batch
+
+    def __getattr__(self, name):
+        if name == "acc":
+            raise AttributeError(name)
+        return getattr(self.acc, name)
+
+    @property
+    def name(self):
+        # the checkpoints record the accumulators by name, with or without the profiler
+        return getattr(self.acc, "name", type(self.acc).__name__)
+
+    @property
+    def key(self):
+        return "%s(%s)" % (type(self.acc).__name__, ",".join(self.features or []))
+
+    def update_acc(self, row):
+        wall, cpu = time.perf_counter(), time.process_time()
+        self.acc.update_acc(row)
+        self._add(self.update_stats, wall, cpu)
+
+    def get_stats(self, row, item):
+        wall, cpu = time.perf_counter(), time.process_time()
+        value = self.acc.get_stats(row, item)
+        self._add(self.get_stats_stats, wall, cpu)
+        if self.features is None:
+            self.features = list(value) if isinstance(value, dict) else [self.acc.name]
+        return value
+
+    def _get_stats_batch(self, row, items):
+        wall, cpu = time.perf_counter(), time.process_time()
+        columns = self.acc.get_stats_batch(row, items)
+        self._add(self.get_stats_stats, wall, cpu)
+        if self.features is None:
+            self.features = list(columns)
+        return columns
+
+    @staticmethod
+    def _add(stats, wall, cpu):
+        stats.calls += 1
+        stats.wall += time.perf_counter() - wall
+        stats.cpu += time.process_time() - cpu
+
+    def get_state(self):
+        return get_state(self.acc)
+
+    def set_state(self, state):
+        set_state(self.acc, state)
+
+
+class Profiler:
+    """
+    Collects the timings of the profiled accumulators and shared state components (their own entries
+    of the report) and the number of processed rows and clickouts and saves them as a json report.
+    """
+
+    def __init__(self, accumulators, components, report_path):
+        self.accumulators = [ProfiledAccumulator(acc) for acc in accumulators]
+        self.components = [ProfiledAccumulator(component) for component in components]
+        self.report_path = report_path
+        self.rows = 0
+        self.clickouts = 0
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+
+    def add_row(self, row):
+        self.rows += 1
+        if row["action_type"] == "clickout item":
+            self.clickouts += 1
+
+    def report(self):
+        wall = time.perf_counter() - self.start_wall
+        accumulators = [
+            {
+                "accumulator": acc.key,
+                "component": acc in self.components,
+                "update_acc": acc.update_stats.to_dict(),
+                "get_stats": acc.get_stats_stats.to_dict(),
+                "wall": acc.update_stats.wall + acc.get_stats_stats.wall,
+                "cpu": acc.update_stats.cpu + acc.get_stats_stats.cpu,
+            }
+            for acc in self.components + self.accumulators
+        ]
+        return {
+            "rows": self.rows,
+            "clickouts": self.clickouts,
+            "wall": wall,
+            "cpu": time.process_time() - self.start_cpu,
+            "rows_per_s": self.rows / wall if wall else 0.0,
+            "clickouts_per_s": self.clickouts / wall if wall else 0.0,
+            "accumulators": sorted(accumulators, key=lambda acc: acc["wall"], reverse=True),
+        }
+
+    def save(self):
+        with open(self.report_path, "wt") as out:
+            json.dump(self.report(), out, indent=2)
@@ -0,0 +1,387 @@
+import csv
+import heapq
+import os
+import shutil
+import tempfile
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from itertools import groupby
+
+import click
+import joblib
+import numpy as np
+import sys
+sys.path.append('/Users/josang-yeon/2020/tobigs/tobigs_reco_conf/recsys2019/src')
+from recsys.utils import group_time
+
+# the columns of events_sorted.csv (join_datasets.py)
+EVENT_COLUMNS = [
+    "user_id",
+    "session_id",
+    "timestamp",
+    "step",
+    "action_type",
+    "reference",
+    "platform",
+    "city",
+    "device",
+    "current_filters",
+    "impressions",
+    "prices",
+    "src",
+    "is_test",
+    "fake_impressions",
+    "fake_prices",
+    "clickout_step_rev",
+    "clickout_step",
+    "clickout_max_step",
+    "dt",
+    "is_val",
+]
+
+# roughly the shares of the action types in the competition data
+ACTION_TYPES = {
+    "interaction item image": 0.56,
+    "clickout item": 0.14,
+    "filter selection": 0.05,
+    "search for destination": 0.05,
+    "change of sort order": 0.04,
+    "interaction item info": 0.04,
+    "interaction item rating": 0.04,
+    "interaction item deals": 0.03,
+    "search for item": 0.03,
+    "search for poi": 0.02,
+}
+ITEM_ACTIONS = {
+    "interaction item image",
+    "interaction item info",
+    "interaction item rating",
+    "interaction item deals",
+    "search for item",
+}
+# actions after which the next clickout shows a new list
+NEW_LIST_ACTIONS = {"filter selection", "search for destination", "change of sort order", "search for poi"}
+FILTERS = ["Sort by Price", "Sort by Popularity", "Best Value", "Focus on Rating", "Free WiFi (Combined)", "Pool"]
+FILTERS += ["Hotel", "Hostel", "3 Star", "4 Star", "5 Star", "Breakfast Included", "Good Rating", "Excellent Rating"]
+SORT_ORDERS = ["price only", "distance only", "rating only", "price and recommended", "our recommendations"]
+SORT_ORDERS += ["distance and recommended", "rating and recommended", "interaction sort button"]
+PLATFORMS = ["US", "DE", "UK", "BR", "MX", "AU", "IN", "JP", "IT", "FR", "ES", "CA", "TR", "PL", "NL", "AT"]
+DEVICES = ["mobile", "desktop", "tablet"]
+START_TIMESTAMP = 1541030400  # 2018-11-01
+DAY = 24 * 3600
+
+
+class SyntheticEvents:
+    """
+    Generates users with sessions of events like in events_sorted.csv. Items are drawn with Zipf popularity
+    (item of popularity rank r with probability ~ 1 / r ** zipf) and the clicks prefer the top of the list.
+
+    The users of the last 2 days are the test users, the last clickout of their sessions has no reference
+    (is_test=1). The last clickout of every user on the last day before them is the validation one (is_val=1).
+    """
+
+    def __init__(
+        self,
+        n_items=10000,
+        sessions_per_user=2.0,
+        actions_per_session=10.0,
+        impressions_per_clickout=25,
+        zipf=1.0,
+        n_cities=200,
+        n_pois=300,
+        days=8,
+        test_days=2,
+        seed=0,
+    ):
+        self.rng = np.random.RandomState(seed)
+        self.n_items = n_items
+        self.sessions_per_user = sessions_per_user
+        self.actions_per_session = actions_per_session
+        self.impressions_per_clickout = impressions_per_clickout
+        self.days = days
+        self.test_days = test_days
+        self.val_day = date_of(START_TIMESTAMP + (days - test_days - 1) * DAY)
+
+        # item ids are not ordered by popularity
+        self.item_ids = 1000 + self.rng.permutation(n_items)
+        popularity = 1.0 / np.arange(1, n_items + 1) ** zipf
+        self.popularity_cdf = np.cumsum(popularity / popularity.sum())
+        self.base_prices = np.exp(self.rng.normal(4.5, 0.6, n_items))
+        self.cities = ["City %d, Country %d" % (n, n % 40) for n in range(n_cities)]
+        self.pois = ["POI %d" % n for n in range(n_pois)]
+        self.action_types = list(ACTION_TYPES)
+        self.action_p = np.array(list(ACTION_TYPES.values())) / sum(ACTION_TYPES.values())
+        rank_bias = 1.0 / np.arange(1, impressions_per_clickout + 1)
+        self.rank_cdfs = [np.cumsum(rank_bias[:n] / rank_bias[:n].sum()) for n in range(1, len(rank_bias) + 1)]
+
+        # artifacts
+        self.price_sum = np.zeros(n_items)
+        self.price_count = np.zeros(n_items, dtype=np.int64)
+        self.item_pois = defaultdict(set)
+        self.click_offsets = Counter()
+
+    def popular_items(self, n):
+        """
+        n different items (indices) drawn by popularity
+        """
+        n = min(n, self.n_items)
+        items = {}
+        while len(items) < n:
+            for item in np.searchsorted(self.popularity_cdf, self.rng.random_sample(2 * n + 5)).tolist():
+                items[min(item, self.n_items - 1)] = None
+        return list(items)[:n]
+
+    def clicked_rank(self, n):
+        return min(int(np.searchsorted(self.rank_cdfs[n - 1], self.rng.random_sample())), n - 1)
+
+    def impression_list(self):
+        if self.rng.random_sample() < 0.7:
+            n = self.impressions_per_clickout
+        else:
+            n = int(self.rng.randint(1, self.impressions_per_clickout + 1))
+        items = self.popular_items(n)
+        prices = np.rint(self.base_prices[items] * self.rng.uniform(0.85, 1.15, len(items))).astype(int).tolist()
+        return items, prices
+
+    def user_events(self, user_n, is_test_user):
+        user_id = "U%08d" % user_n
+        if is_test_user:
+            start = START_TIMESTAMP + (self.days - self.test_days) * DAY
+            end = START_TIMESTAMP + self.days * DAY
+        else:
+            start, end = START_TIMESTAMP, START_TIMESTAMP + (self.days - self.test_days) * DAY
+        timestamp = int(self.rng.randint(start, end))
+        rows = []
+        for session_n in range(1 + self.rng.poisson(self.sessions_per_user - 1)):
+            if rows and timestamp >= end:
+                break
+            session_id = "%s_%d" % (user_id, session_n)
+            rows.extend(self.session_events(user_id, session_id, timestamp, is_test_user))
+            timestamp = rows[-1]["timestamp"] + int(self.rng.exponential(6 * 3600))
+        self.add_click_offsets(rows)
+        for row in rows:
+            row["dt"] = date_of(row["timestamp"])
+        val_clickouts = [row for row in rows if row["action_type"] == "clickout item" and row["dt"] == self.val_day]
+        if val_clickouts:
+            val_clickouts[-1]["is_val"] = 1
+        return rows
+
+    def session_events(self, user_id, session_id, timestamp, is_test_user):
+        platform = PLATFORMS[int(self.rng.randint(len(PLATFORMS)))]
+        device = DEVICES[int(self.rng.randint(len(DEVICES)))]
+        city = self.cities[int(self.rng.randint(len(self.cities)))]
+        filters = []
+        items, prices = None, None
+        n_actions = 1 + self.rng.poisson(self.actions_per_session - 1)
+        action_types = self.rng.choice(len(self.action_types), size=n_actions, p=self.action_p).tolist()
+        rows = []
+        for step, action_n in enumerate(action_types, 1):
+            action_type = self.action_types[action_n]
+            timestamp += int(self.rng.exponential(30))
+            row = {
+                "user_id": user_id,
+                "session_id": session_id,
+                "timestamp": timestamp,
+                "step": step,
+                "action_type": action_type,
+                "reference": "",
+                "platform": platform,
+                "city": city,
+                "device": device,
+                "current_filters": "",
+                "impressions": "",
+                "prices": "",
+                "src": "test" if is_test_user else "train",
+                "is_test": 0,
+                "is_val": 0,
+                "_items": None,
+                "_prices": None,
+            }
+            if action_type == "clickout item":
+                if items is None:
+                    items, prices = self.impression_list()
+                    np.add.at(self.price_sum, items, prices)
+                    np.add.at(self.price_count, items, 1)
+                if self.rng.random_sample() < 0.02:
+                    clicked = self.popular_items(1)[0]
+                else:
+                    clicked = items[self.clicked_rank(len(items))]
+                row["reference"] = str(self.item_ids[clicked])
+                row["current_filters"] = "|".join(filters)
+                row["impressions"] = "|".join(map(str, self.item_ids[items].tolist()))
+                row["prices"] = "|".join(map(str, prices))
+                row["_items"], row["_prices"] = items, prices
+            elif action_type in ITEM_ACTIONS:
+                if items is not None and action_type != "search for item":
+                    row["reference"] = str(self.item_ids[items[self.clicked_rank(len(items))]])
+                else:
+                    row["reference"] = str(self.item_ids[self.popular_items(1)[0]])
+            elif action_type == "filter selection":
+                row["reference"] = FILTERS[int(self.rng.randint(len(FILTERS)))]
+                filters = (filters + [row["reference"]])[-3:]
+            elif action_type == "change of sort order":
+                row["reference"] = SORT_ORDERS[int(self.rng.randint(len(SORT_ORDERS)))]
+            elif action_type == "search for destination":
+                city = row["city"] = row["reference"] = self.cities[int(self.rng.randint(len(self.cities)))]
+            elif action_type == "search for poi":
+                row["reference"] = self.pois[int(self.rng.randint(len(self.pois)))]
+            if action_type in NEW_LIST_ACTIONS and self.rng.random_sample() < 0.5:
+                items, prices = None, None
+            rows.append(row)
+
+        clickouts = [row for row in rows if row["action_type"] == "clickout item"]
+        if is_test_user and clickouts:
+            clickouts[-1]["reference"] = ""
+            clickouts[-1]["is_test"] = 1
+        self.add_derived_columns(rows)
+        return rows
+
+    def add_derived_columns(self, rows):
+        """
+        The columns join_datasets.py adds, per session
+        """
+        fake_impressions, fake_prices, fake_items = "", "", None
+        for row in reversed(rows):
+            if row["impressions"]:
+                fake_impressions, fake_prices, fake_items = row["impressions"], row["prices"], row["_items"]
+            row["fake_impressions"], row["fake_prices"] = fake_impressions, fake_prices
+            if row["action_type"] == "search for poi" and fake_items is not None:
+                for item in fake_items:
+                    self.item_pois[int(self.item_ids[item])].add(row["reference"])
+        steps = Counter(row["action_type"] for row in rows)
+        seen = Counter()
+        for row in rows:
+            seen[row["action_type"]] += 1
+            row["clickout_step"] = seen[row["action_type"]]
+            row["clickout_step_rev"] = steps[row["action_type"]] - seen[row["action_type"]] + 1
+            row["clickout_max_step"] = steps[row["action_type"]]
+
+    def add_click_offsets(self, rows):
+        """
+        Offsets between the clicked positions of consecutive clickouts of the same list (generate_click_indices.py)
+        """
+        clickouts = [row for row in rows if row["action_type"] == "clickout item" and row["reference"]]
+        for _, same_list in groupby(clickouts, lambda row: row["impressions"]):
+            indices = []
+            for row in same_list:
+                impressions = row["impressions"].split("|")
+                if row["reference"] in impressions:
+                    indices.append((row["timestamp"], impressions.index(row["reference"])))
+            for (t1, c1), (t2, c2) in zip(indices[:-1], indices[1:]):
+                if t2 - t1 <= 120:
+                    self.click_offsets[(c2 - c1, group_time(t2 - t1))] += 1
+
+    def item_metadata_map(self, n_properties=157):
+        item_properties = defaultdict(set)
+        for item_id in self.item_ids.tolist():
+            n = int(self.rng.randint(1, min(40, n_properties) + 1))
+            item_properties[item_id] = set(self.rng.choice(n_properties, size=n, replace=False).tolist())
+        return item_properties
+
+    def item_prices(self):
+        shown = self.price_count > 0
+        return dict(zip(self.item_ids[shown].tolist(), (self.price_sum[shown] / self.price_count[shown]).tolist()))
+
+    def click_probs_by_index(self):
+        """
+        P(click offset | time group), the missing (offset, time group) pairs count as 1 like in the pivot table
+        of generate_click_indices.py
+        """
+        offsets = sorted({offset for offset, _ in self.click_offsets}) or list(range(-24, 25))
+        times = sorted({time for _, time in self.click_offsets}) or sorted({group_time(t) for t in range(121)})
+        probs = {}
+        for time in times:
+            counts = [self.click_offsets.get((offset, time), 1.0) for offset in offsets]
+            for offset, count in zip(offsets, counts):
+                probs[(offset, time)] = count / sum(counts)
+        return probs
+
+
+def date_of(timestamp):
+    return str(datetime.fromtimestamp(timestamp, timezone.utc).date())
+
+
+def sort_key(row):
+    return int(row[2]), row[0], int(row[3])
+
+
+def write_run(rows, path):
+    rows.sort(key=lambda row: (row["timestamp"], row["user_id"], row["step"]))
+    with open(path, "wt") as out:
+        writer = csv.writer(out, lineterminator="\n")
+        for row in rows:
+            writer.writerow([row[column] for column in EVENT_COLUMNS])
+
+
+def read_run(path):
+    with open(path) as inp:
+        yield from csv.reader(inp)
+
+
+@click.command()
+@click.option("--output-dir", default="../../../data", help="Directory for events_sorted.csv and the artifacts")
+@click.option("--n-users", type=int, default=10000, help="Number of users")
+@click.option("--sessions-per-user", type=float, default=2.0, help="Mean number of sessions per user")
+@click.option("--actions-per-session", type=float, default=10.0, help="Mean number of actions per session")
+@click.option("--impressions-per-clickout", type=int, default=25, help="Maximum number of impressions per clickout")
+@click.option("--n-items", type=int, default=10000, help="Size of the item catalog")
+@click.option("--zipf", type=float, default=1.0, help="Exponent of the Zipf item popularity")
+@click.option("--test-users", type=float, default=0.1, help="Share of the test users")
+@click.option("--chunk-users", type=int, default=20000, help="Users per sorted run (bounds the memory)")
+@click.option("--seed", type=int, default=0, help="Random seed")
+def main(
+    output_dir,
+    n_users,
+    sessions_per_user,
+    actions_per_session,
+    impressions_per_clickout,
+    n_items,
+    zipf,
+    test_users,
+    chunk_users,
+    seed,
+):
+    """
+    Writes a synthetic events_sorted.csv (about n_users * sessions_per_user * actions_per_session rows) and the
+    item_metadata_map, item_pois, item_prices and click_probs_by_index artifacts made from it,
+    so the feature generation can be run and benchmarked without the competition data.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    events = SyntheticEvents(
+        n_items=n_items,
+        sessions_per_user=sessions_per_user,
+        actions_per_session=actions_per_session,
+        impressions_per_clickout=impressions_per_clickout,
+        zipf=zipf,
+        seed=seed,
+    )
+    is_test_user = events.rng.random_sample(n_users) < test_users
+
+    # every chunk of users is sorted to a run file and the runs are merged
+    runs_dir = tempfile.mkdtemp(prefix="synthetic_runs_", dir=output_dir)
+    run_paths = []
+    n_rows = 0
+    for chunk_start in range(0, n_users, chunk_users):
+        rows = []
+        for user_n in range(chunk_start, min(chunk_start + chunk_users, n_users)):
+            rows.extend(events.user_events(user_n, bool(is_test_user[user_n])))
+        run_paths.append(os.path.join(runs_dir, "%05d.csv" % len(run_paths)))
+        write_run(rows, run_paths[-1])
+        n_rows += len(rows)
+        print("Generated %d users, %d rows" % (min(chunk_start + chunk_users, n_users), n_rows))
+
+    with open(os.path.join(output_dir, "events_sorted.csv"), "wt") as out:
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow(EVENT_COLUMNS)
+        writer.writerows(heapq.merge(*[read_run(path) for path in run_paths], key=sort_key))
+    shutil.rmtree(runs_dir)
+
+    joblib.dump(events.item_metadata_map(), os.path.join(output_dir, "item_metadata_map.joblib"), compress=3)
+    joblib.dump(events.item_pois, os.path.join(output_dir, "item_pois.joblib"), compress=3)
+    joblib.dump(events.item_prices(), os.path.join(output_dir, "item_prices.joblib"), compress=3)
+    joblib.dump(events.click_probs_by_index(), os.path.join(output_dir, "click_probs_by_index.joblib"), compress=3)
+    print("Saved %d events of %d users to %s" % (n_rows, n_users, output_dir))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 from multiprocessing import Pool
 from recsys.data_generator.accumulators import get_accumulators, logger, group_accumulators
+from recsys.data_generator.frames import event_records, preprocess_events
 
 class FeatureGenerator:
     def __init__(self, limit, accumulators, save_only_features=False, input_df=None):
@@ -11,16 +12,11 @@ class FeatureGenerator:
         print("Number of accumulators %d" % len(self.accumulators))
 
 
-    def preprocess(self, row):
-        row["timestamp"] = row["timestamp"].astype(int)
-        row["fake_impressions_raw"] = row["fake_impressions"]
-        row["fake_impressions"] = row["fake_impressions"].map(lambda x: x.split("|"))
-        row["fake_index_interacted"] = row.apply(
-            lambda x: x["fake_impressions"].index(x["reference"]) 
-            if x["reference"] in x["fake_impressions"] 
-            else -1000, axis=1)
-        
-        return row
+    def preprocess(self, df):
+        """
+        Vectorized version of the per row preparation of the csv path (see frames.py)
+        """
+        return preprocess_events(df)
 
     def calculate_features_per_item(self, clickout_id, item_id, price, rank, row):
         obs = row.copy()
@@ -37,10 +33,12 @@ class FeatureGenerator:
         self.update_obs_with_acc(obs, row)
         del obs["fake_impressions"]
         del obs["fake_impressions_raw"]
+        del obs["fake_impressions_fp"]
         del obs["fake_prices"]
         del obs["impressions"]
-        del obs["impressions_hash"]
         del obs["impressions_raw"]
+        del obs["impressions_fp"]
+        del obs["impressions_set_fp"]
         del obs["prices"]
         del obs["action_type"]
         return obs
@@ -67,22 +65,13 @@ class FeatureGenerator:
 
 
     def read_rows(self):
-        dr = self.input.iterrows()
         print("Reading rows")
-        for i, row in dr:
+        for row in event_records(self.input):
             yield row
 
     def process_rows(self, rows):
         for clickout_id, row in enumerate(rows):            
             if row["action_type"] == "clickout item":
-                row["impressions_raw"] = row["impressions"]
-                row["impressions"] = row["impressions"].split("|")
-                row["impressions_hash"] = "|".join(sorted(row["impressions"]))
-                row["index_clicked"] = (
-                    row["impressions"].index(row["reference"]) if row["reference"] in row["impressions"] else -1000
-                )
-                row["prices"] = list(map(int, row["prices"].split("|")))
-                row["price_clicked"] = row["prices"][row["index_clicked"]] if row["index_clicked"] >= 0 else 0
                 for rank, (item_id, price) in enumerate(zip(row["impressions"], row["prices"])):
                     obs = self.calculate_features_per_item(clickout_id, item_id, price, rank, row)
                     yield obs
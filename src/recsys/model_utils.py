@@ -5,6 +5,7 @@ from lightgbm import LGBMRanker
 import sys
 sys.path.append('/Users/josang-yeon/2020/tobigs/tobigs_reco_conf/recsys2019/src')
 
+from recsys.data_generator.feature_store import read_split
 from recsys.metric import mrr_fast
 from recsys.submission import group_clickouts
 from recsys.utils import group_lengths, reduce_mem_usage, timer
@@ -70,12 +71,22 @@ class Model:
 
 
 class ModelTrain:
-    def __init__(self, models, datapath, n_jobs=-2, reduce_df_memory=False, load_feather=False):
+    def __init__(self, models, datapath, n_jobs=-2, reduce_df_memory=False, load_feather=False, clickouts=None):
+        """
+        clickouts is the clickout table of the split output (see SplitWriter), then datapath is the impression
+        table and the clickouts of the impressions which are read are joined to it
+        """
         self.models = models
         self.datapath = datapath
         self.n_jobs = n_jobs
         self.reduce_df_memory = reduce_df_memory
         self.load_feather = load_feather
+        self.clickouts = clickouts
+
+    def read_data(self, nrows=None):
+        if self.clickouts is not None:
+            return read_split(self.datapath, nrows=nrows, clickouts=self.clickouts)
+        return pd.read_csv(self.datapath, nrows=nrows)
 
     def validate_models(self, n_users, n_debug=None):
         df_train, df_val = self.load_train_val(n_users, n_debug=n_debug)
@@ -109,9 +120,9 @@ class ModelTrain:
     def load_train_val(self, n_users, n_debug=None):
         with timer("Reading training data"):
             if n_debug:
-                df_all = pd.read_csv(self.datapath, nrows=n_debug)
+                df_all = self.read_data(nrows=n_debug)
             else:
-                df_all = pd.read_csv(self.datapath)
+                df_all = self.read_data()
                 if self.reduce_df_memory:
                     df_all = reduce_mem_usage(df_all)
                 if n_users:
@@ -131,7 +142,7 @@ class ModelTrain:
 
     def load_train_test(self, n_users):
         with timer("Reading training and testing data"):
-            df_all = pd.read_csv(self.datapath)
+            df_all = self.read_data()
             if self.reduce_df_memory:
                 df_all = reduce_mem_usage(df_all)
             df_test = df_all[df_all["is_test"] == 1]
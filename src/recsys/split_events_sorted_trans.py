@@ -1,34 +1,84 @@
+import os
+
 import numpy as np
-import datatable as dt
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 import sys
 sys.path.append('/Users/josang-yeon/2020/tobigs/tobigs_reco_conf/recsys2019/src')
 
+from recsys.data_generator.feature_store import FeatureStore
 from recsys.log_utils import get_logger
 from tqdm import tqdm
 
 logger = get_logger()
 
-logger.info("Starting splitting")
-
-df = dt.fread("../../data/events_sorted_trans_all.csv")
-filenames = []
-for i in tqdm(range(df.shape[0])):
-    if (df[i, "is_val"] == False) and (df[i, "is_test"] == False):
-        find = int(df[i, "clickout_id"]) % 25
-        filenames.append(f"01_train_{find:04d}.csv")
-    elif (df[i, "is_val"] == True) and (df[i, "is_test"] == False):
-        find = int(df[i, "clickout_id"]) % 2
-        filenames.append(f"02_val_{find:04d}.csv")
-    elif df[i, "is_test"] == True:
-        find = int(df[i, "clickout_id"]) % 4
-        filenames.append(f"03_test_{find:04d}.csv")
+
+def split_rows(is_val, is_test, clickout_id):
+    """
+    Yields the chunk name and the row indices of every chunk (the same split as the csv version below)
+    """
+    is_val = is_val.astype(bool)
+    is_test = is_test.astype(bool)
+    splits = {
+        "01_train_%04d": (~is_val & ~is_test, clickout_id % 25),
+        "02_val_%04d": (is_val & ~is_test, clickout_id % 2),
+        "03_test_%04d": (is_test, clickout_id % 4),
+    }
+    for pattern, (mask, find) in splits.items():
+        for n in np.unique(find[mask]):
+            yield pattern % n, np.where(mask & (find == n))[0]
+
+
+def split_parquet(path, output_dir):
+    """
+    Saves the rows of every chunk of the parquet output as a parquet file. The table goes through pandas,
+    pyarrow 0.12 has neither Table.take nor ChunkedArray.to_numpy.
+    """
+    df = pq.read_table(path).to_pandas()
+    os.makedirs(output_dir, exist_ok=True)
+    for name, rows in tqdm(list(split_rows(df["is_val"].values, df["is_test"].values, df["clickout_id"].values))):
+        table = pa.Table.from_pandas(df.iloc[rows], preserve_index=False)
+        pq.write_table(table, os.path.join(output_dir, name + ".parquet"))
+
+
+def main():
+    logger.info("Starting splitting")
+
+    if os.path.exists("../../data/events_sorted_trans_all.json"):
+        # column store: only the columns needed for splitting are read and every split is saved as row indices,
+        # VectorizeChunks reads the rows straight from the store
+        store = FeatureStore("../../data/events_sorted_trans_all.json")
+        os.makedirs("../../data/proc/raw_rows/", exist_ok=True)
+        for name, rows in split_rows(store.column("is_val"), store.column("is_test"), store.column("clickout_id")):
+            np.save("../../data/proc/raw_rows/" + name + ".npy", rows)
+    elif os.path.exists("../../data/events_sorted_trans_all.parquet"):
+        split_parquet("../../data/events_sorted_trans_all.parquet", "../../data/proc/raw_parquet/")
     else:
-        raise (ValueError("Shouldn't happen"))
+        import datatable as dt
+
+        df = dt.fread("../../data/events_sorted_trans_all.csv")
+        filenames = []
+        for i in tqdm(range(df.shape[0])):
+            if (df[i, "is_val"] == False) and (df[i, "is_test"] == False):
+                find = int(df[i, "clickout_id"]) % 25
+                filenames.append(f"01_train_{find:04d}.csv")
+            elif (df[i, "is_val"] == True) and (df[i, "is_test"] == False):
+                find = int(df[i, "clickout_id"]) % 2
+                filenames.append(f"02_val_{find:04d}.csv")
+            elif df[i, "is_test"] == True:
+                find = int(df[i, "clickout_id"]) % 4
+                filenames.append(f"03_test_{find:04d}.csv")
+            else:
+                raise (ValueError("Shouldn't happen"))
+
+        filenames = np.array(filenames)
+
+        for filename in tqdm(set(filenames)):
+            df[np.where(filenames == filename)[0], :].to_csv("../../data/proc/raw_csv/" + filename)
 
-filenames = np.array(filenames)
+    logger.info("End splitting")
 
-for filename in tqdm(set(filenames)):
-    df[np.where(filenames == filename)[0], :].to_csv("../../data/proc/raw_csv/" + filename)
 
-logger.info("End splitting")
+if __name__ == "__main__":
+    main()
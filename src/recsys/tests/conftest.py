@@ -0,0 +1,28 @@
+import pytest
+from click.testing import CliRunner
+
+from recsys.data_prep import generate_synthetic_data
+
+
+@pytest.fixture(scope="session")
+def synthetic_data(tmp_path_factory):
+    """
+    Directory with events_sorted.csv and the artifacts of a small synthetic dataset
+    """
+    data_dir = tmp_path_factory.mktemp("synthetic") / "data"
+    result = CliRunner().invoke(
+        generate_synthetic_data.main, ["--output-dir", str(data_dir), "--n-users", "60", "--n-items", "300"]
+    )
+    assert result.exit_code == 0, result.output
+    return data_dir
+
+
+@pytest.fixture
+def run_dir(synthetic_data, monkeypatch):
+    """
+    The accumulators read the artifacts from ../../data, the test runs two directories below the data
+    """
+    path = synthetic_data.parent / "x" / "y"
+    path.mkdir(parents=True, exist_ok=True)
+    monkeypatch.chdir(str(path))
+    return path
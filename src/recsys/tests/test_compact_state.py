@@ -0,0 +1,106 @@
+import random
+from collections import Counter, defaultdict
+
+import pytest
+
+from recsys.data_generator.compact_state import DenseCounter, Interner, KeyClicks, PackedDict, SortedSums
+
+
+def test_packed_dict_round_trip():
+    users, items = Interner("user_id"), Interner("item_id")
+    table = PackedDict([users, items], [20, 20])
+    expected = {}
+    for n in range(200):
+        key = ("user%d" % (n % 7), n % 13)
+        table[key] = n
+        expected[key] = n
+    assert len(table) == len(expected)
+    assert table.to_dict() == expected
+    assert all(table[key] == value for key, value in expected.items())
+
+
+def test_packed_dict_lookup_does_not_intern():
+    users = Interner("user_id")
+    table = PackedDict([users, Interner()], [16, 16])
+    table[("a", 1)] = 1
+    assert ("b", 1) not in table
+    assert table.get(("a", 2), 0) == 0
+    assert users.lookup("b") is None
+    with pytest.raises(KeyError):
+        table[("b", 1)]
+
+
+def test_packed_dict_default_factory():
+    table = PackedDict([Interner(), Interner()], [8, 8], default_factory=list)
+    table[("a", "x")].append(1)
+    table[("a", "x")].append(2)
+    assert table.to_dict() == {("a", "x"): [1, 2]}
+
+
+def test_packed_dict_bits():
+    with pytest.raises(ValueError):
+        PackedDict([Interner(), Interner()], [32, 32])
+    table = PackedDict([Interner()], [2])
+    for n in range(4):
+        table[(n,)] = n
+    with pytest.raises(OverflowError):
+        table[(4,)] = 4
+
+
+def test_dense_counter_grows_past_capacity():
+    counter = DenseCounter(Interner(), capacity=2)
+    keys = [random.Random(0).randint(0, 50) for _ in range(500)]
+    for key in keys:
+        counter.add(key)
+    assert counter.to_dict() == Counter(keys)
+    assert len(counter) == len(set(keys))
+    assert counter.get("missing") == 0
+
+
+def test_dense_counter_add_many():
+    counter = DenseCounter(Interner(), width=2, capacity=1)
+    counter.add_many(["a", "b", "a", "c"], [0, 1, 0, 1], n=[1, 2, 3, 4])
+    counter.add("a", column=1)
+    assert counter.row("a") == [4, 1]
+    assert counter.row("b") == [0, 2]
+    assert counter.row("missing") == [0, 0]
+    assert counter.to_dict() == {"a": {0: 4, 1: 1}, "b": {0: 0, 1: 2}, "c": {0: 0, 1: 4}}
+
+
+@pytest.mark.parametrize("unique", [False, True])
+def test_sorted_sums_abs_diffs(unique):
+    rng = random.Random(1)
+    values = [rng.randint(0, 100) for _ in range(300)]
+    sorted_sums = SortedSums(unique)
+    for value in values:
+        sorted_sums.add(value)
+    expected = set(values) if unique else values
+    assert len(sorted_sums) == len(expected)
+    for x in [-5, 0, 37, 50, 100, 250]:
+        assert sorted_sums.abs_diffs(x) == sum(abs(value - x) for value in expected)
+    from_values = SortedSums.from_values(values, unique)
+    assert (from_values.values, from_values.sums) == (sorted_sums.values, sorted_sums.sums)
+
+
+def test_sorted_sums_empty():
+    assert SortedSums().abs_diffs(10) == 0
+    assert len(SortedSums.from_values([])) == 0
+
+
+def test_key_clicks_other_users():
+    rng = random.Random(2)
+    clicks = [(rng.choice("abc"), rng.choice("uvw"), rng.randint(1, 5)) for _ in range(200)]
+    key_clicks = KeyClicks()
+    for key, user_id, item_id in clicks:
+        key_clicks.add(key, user_id, item_id)
+    assert len(key_clicks) == len(set(clicks))
+    counts = defaultdict(int)
+    for key, user_id, item_id in clicks:
+        counts[(key, user_id, item_id)] += 1
+    for key in "abcd":
+        for user_id in "uvwx":
+            others = [n for (k, u, _), n in counts.items() if k == key and u != user_id]
+            assert key_clicks.other_users_clicks(key, user_id) == sum(others)
+            for item_id in range(7):
+                others = [n for (k, u, i), n in counts.items() if k == key and u != user_id and i == item_id]
+                assert key_clicks.other_users_item_clicks(key, user_id, item_id) == sum(others)
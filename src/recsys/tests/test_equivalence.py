@@ -0,0 +1,62 @@
+import json
+import os
+
+import pytest
+from click.testing import CliRunner
+
+from recsys.data_generator import equivalence
+from recsys.data_generator.accumulators import get_accumulators
+from recsys.data_generator.equivalence import compare_outputs, is_equivalent, read_output, run_generator
+from recsys.data_generator.feature_store import read_split
+
+
+def test_generators_are_equivalent_on_synthetic_data(synthetic_data, run_dir, tmp_path):
+    report = str(tmp_path / "report.json")
+    args = ["--input", str(synthetic_data / "events_sorted.csv"), "--workdir", str(tmp_path), "--report", report]
+    for mode in ["per_item", "store", "columns", "parquet", "split", "sharded"]:
+        args += ["--candidate", mode]
+    result = CliRunner().invoke(equivalence.main, args)
+    assert result.exit_code == 0, result.output
+    with open(report) as inp:
+        reports = json.load(inp)
+    assert sorted(reports) == ["columns", "parquet", "per_item", "sharded", "split", "store"]
+    assert all(mode_report["rows"][0] > 0 for mode_report in reports.values())
+    assert os.path.exists(str(tmp_path / "columns" / "part.json"))
+
+
+@pytest.fixture
+def reference(synthetic_data, run_dir, tmp_path):
+    input = str(synthetic_data / "events_sorted.csv")
+    return input, read_output(equivalence.run_csv(input, str(tmp_path), 800, None))
+
+
+@pytest.mark.parametrize("mode", ["resume", "push_event", "split"])
+def test_mode_is_equivalent_to_csv(reference, tmp_path, mode):
+    input, expected = reference
+    report = compare_outputs(expected, read_output(equivalence.MODES[mode](input, str(tmp_path), 800, None)))
+    assert report["rows"][0] > 0
+    assert is_equivalent(report), report
+
+
+def test_split_parquet_reads_the_columns(reference, tmp_path):
+    input, expected = reference
+    path = run_generator(input, str(tmp_path / "split.parquet"), 800, None, split_output=True, output_format="parquet")
+    columns = ["clickout_id", "rank", "item_id", "user_id", "was_clicked"]
+    df = read_split(path, columns=columns)
+    report = compare_outputs(expected[columns], df[columns])
+    assert is_equivalent(report), report
+
+
+def test_pruned_features_are_equivalent_to_csv(reference, tmp_path):
+    input, expected = reference
+    features = ["alltime_filters", "most_similar_item_interaction", "identical_impressions_item_clicks"]
+    save_as = str(tmp_path / "pruned.csv")
+    generator = equivalence.FeatureGenerator(
+        limit=800, accumulators=get_accumulators(features=features), input=input, save_as=save_as
+    )
+    generator.generate_features()
+    df = read_output(save_as)
+    assert set(features) <= set(df.columns)
+    assert len(df.columns) < len(expected.columns)
+    report = compare_outputs(expected[list(df.columns)], df)
+    assert is_equivalent(report), report
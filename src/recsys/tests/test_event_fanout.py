@@ -0,0 +1,76 @@
+import time
+from multiprocessing import Event, Process, Queue
+from threading import Thread
+
+import pytest
+
+from recsys.data_generator import event_fanout
+from recsys.data_generator.equivalence import compare_outputs, is_equivalent, read_output, run_generator
+
+
+def read_all(ring, reader, start, results):
+    start.wait()
+    results.put((reader, list(ring.read(reader))))
+
+
+@pytest.fixture(params=["shared_memory", "queue"])
+def ring_class(request):
+    if request.param == "queue":
+        return event_fanout.QueueRing
+    if event_fanout.SharedMemory is None:
+        pytest.skip("multiprocessing.shared_memory needs python 3.8")
+    return event_fanout.EventRing
+
+
+def test_ring_wraps_around_and_waits_for_the_slowest_reader(ring_class):
+    ring = ring_class(2, n_slots=2, slot_size=4096)
+    # 8 batches in 2 slots, the last one does not fit into a slot of the shared memory ring and is split
+    batches = [[{"n": n, "m": m} for m in range(n % 3 + 1)] for n in range(7)]
+    batches.append([{"n": 7, "text": "x" * 1500} for _ in range(5)])
+    starts = [Event(), Event()]
+    results = Queue()
+    readers = [Process(target=read_all, args=(ring, reader, start, results)) for reader, start in enumerate(starts)]
+    published = []
+
+    def publish():
+        for batch in batches:
+            ring.publish(batch)
+            published.append(batch)
+        ring.close()
+
+    writer = Thread(target=publish)
+    try:
+        for p in readers:
+            p.start()
+        ring.workers = readers
+        starts[0].set()
+        writer.start()
+        time.sleep(1)
+        # the second reader has not read anything yet, the writer waits for it once both slots are full
+        assert len(published) == 2
+        starts[1].set()
+        outputs = dict(results.get(timeout=60) for _ in readers)
+        writer.join(60)
+        for p in readers:
+            p.join(60)
+    finally:
+        ring.unlink()
+    expected = [row for batch in batches for row in batch]
+    assert outputs == {0: expected, 1: expected}
+    assert [p.exitcode for p in readers] == [0, 0]
+
+
+@pytest.mark.parametrize("shared_memory", [True, False])
+def test_fan_out_matches_single_process(synthetic_data, run_dir, tmp_path, monkeypatch, shared_memory):
+    if not shared_memory:
+        monkeypatch.setattr(event_fanout, "SharedMemory", None)
+    elif event_fanout.SharedMemory is None:
+        pytest.skip("multiprocessing.shared_memory needs python 3.8")
+    input = str(synthetic_data / "events_sorted.csv")
+    save_as = str(tmp_path / "fan_out_%03d.csv")
+    event_fanout.fan_out([0, 3], input, save_as, limit=400, n_slots=2, slot_size=64 * 1024, batch_size=50)
+    for hashn in [0, 3]:
+        reference = run_generator(input, str(tmp_path / ("single_%03d.csv" % hashn)), 400, hashn)
+        report = compare_outputs(read_output(reference), read_output(save_as % hashn))
+        assert is_equivalent(report), report
+        assert report["rows"][0] > 0
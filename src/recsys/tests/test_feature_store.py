@@ -0,0 +1,74 @@
+import os
+
+import numpy as np
+import pytest
+
+from recsys.data_generator.feature_store import PART_META, ColumnStoreWriter, FeatureStore, write_manifest
+
+COLUMNS = ["clickout_id", "price", "name", "mixed"]
+
+
+def feature_rows(n):
+    # the price gets floats and the mixed column strings in the later chunks
+    return [[i, i if i < 40 else i + 0.5, "h%d" % (i % 5), i if i < 70 else "s%d" % i] for i in range(n)]
+
+
+@pytest.fixture
+def store(tmp_path):
+    path = str(tmp_path / "part")
+    writer = ColumnStoreWriter(path, COLUMNS, chunk_size=16)
+    for row in feature_rows(100):
+        writer.writerow(row)
+    writer.close()
+    return FeatureStore(os.path.join(path, PART_META))
+
+
+def test_chunks_are_written_as_the_rows_arrive(tmp_path):
+    path = str(tmp_path / "part")
+    writer = ColumnStoreWriter(path, COLUMNS, chunk_size=16)
+    for row in feature_rows(40):
+        writer.writerow(row)
+    assert writer.buffered == 40 - 32
+    assert len([name for name in os.listdir(path) if name.startswith("0000.")]) == 2
+
+
+def test_read_columns(store):
+    expected = feature_rows(100)
+    df = store.read()
+    assert len(df) == 100
+    assert df["clickout_id"].tolist() == list(range(100))
+    assert df["price"].dtype == np.float64
+    assert df["price"].tolist() == [float(row[1]) for row in expected]
+    assert df["name"].tolist() == [row[2] for row in expected]
+    # numbers in the chunks without strings are read as the csv has them
+    assert df["mixed"].tolist() == [str(row[3]) for row in expected]
+
+
+@pytest.mark.parametrize("kind", ["indices", "mask"])
+def test_read_rows(store, kind):
+    full = store.read()
+    indices = np.array([99, 3, 17, 17, 64, 0, 50])
+    if kind == "mask":
+        indices = np.unique(indices)
+        rows = np.zeros(len(store), dtype=bool)
+        rows[indices] = True
+    else:
+        rows = indices
+    df = store.read(rows=rows)
+    for name in COLUMNS:
+        assert df[name].tolist() == full[name].iloc[indices].tolist()
+    assert len(store.read(rows=[])) == 0
+
+
+def test_manifest_of_parts(tmp_path):
+    paths = []
+    for n, columns in enumerate([["clickout_id", "a"], ["clickout_id", "b"]]):
+        paths.append(str(tmp_path / ("part%d" % n)))
+        writer = ColumnStoreWriter(paths[-1], columns, chunk_size=7)
+        for i in range(20):
+            writer.writerow([i, i * (n + 2)])
+        writer.close()
+    manifest = str(tmp_path / "all.json")
+    write_manifest(manifest, paths)
+    df = FeatureStore(manifest).read(rows=[1, 19])
+    assert df.to_dict("list") == {"clickout_id": [1, 19], "a": [2, 38], "b": [3, 57]}
@@ -0,0 +1,40 @@
+import pytest
+
+from recsys.data_generator.fingerprints import FingerprintCheck, fingerprint, impressions_fingerprints
+
+
+def impressions_row(impressions, fake_impressions):
+    raw = "|".join(impressions)
+    impressions_fp, impressions_set_fp = impressions_fingerprints(raw, impressions)
+    return {
+        "impressions": impressions,
+        "impressions_raw": raw,
+        "impressions_fp": impressions_fp,
+        "impressions_set_fp": impressions_set_fp,
+        "fake_impressions_raw": fake_impressions,
+        "fake_impressions_fp": fingerprint(fake_impressions),
+    }
+
+
+def test_impressions_fingerprints():
+    raw_fp, set_fp = impressions_fingerprints("2|1|3", ["2", "1", "3"])
+    assert raw_fp == fingerprint("2|1|3")
+    assert raw_fp != impressions_fingerprints("1|2|3", ["1", "2", "3"])[0]
+    assert set_fp == impressions_fingerprints("1|2|3", ["1", "2", "3"])[1]
+
+
+def test_fingerprint_check_accepts_repeated_lists():
+    check = FingerprintCheck()
+    for impressions in (["1", "2"], ["2", "1"], ["1", "2"], ["3"]):
+        check.check(impressions_row(impressions, "|".join(impressions)))
+    # a row without the impressions (not a clickout) only has the fake ones
+    check.check({"fake_impressions_raw": "1|2", "fake_impressions_fp": fingerprint("1|2")})
+
+
+def test_fingerprint_check_raises_on_collision():
+    check = FingerprintCheck()
+    check.check(impressions_row(["1", "2"], "1|2"))
+    row = impressions_row(["3", "4"], "3|4")
+    row["impressions_fp"] = fingerprint("1|2")
+    with pytest.raises(ValueError, match="collision"):
+        check.check(row)
@@ -0,0 +1,47 @@
+import random
+
+import joblib
+import pytest
+
+from recsys.data_generator.jaccard_sim import ItemPriceSim, JaccardItemSim
+
+
+@pytest.fixture
+def item_sets(tmp_path):
+    rng = random.Random(0)
+    # more than 64 values, the bit arrays have several words
+    imm = {item_id: set(rng.sample(range(150), rng.randint(0, 30))) for item_id in range(100)}
+    path = str(tmp_path / "imm.joblib")
+    joblib.dump(imm, path)
+    return path
+
+
+@pytest.mark.parametrize("max_words", [64, 1])
+def test_list_to_items_matches_list_to_item(item_sets, max_words):
+    sim = JaccardItemSim(item_sets, max_words=max_words)
+    assert (sim.bits is None) == (max_words == 1)
+    rng = random.Random(1)
+    for _ in range(20):
+        other_items = rng.sample(range(100), rng.randint(1, 10))
+        items = rng.sample(range(100), 25)
+        assert sim.list_to_items(other_items, items) == [sim.list_to_item(other_items, item) for item in items]
+    assert sim.list_to_items([], [1, 2]) == [0, 0]
+
+
+def test_two_items_cache(item_sets):
+    sim = JaccardItemSim(item_sets, cache_size=3)
+    values = [sim.two_items(1, item_id) for item_id in range(1, 10)]
+    assert len(sim.pairs) == 3
+    assert [sim.two_items(1, item_id) for item_id in range(1, 10)] == values
+    assert sim.two_items(1, 0) == 0
+
+
+def test_price_list_to_items_matches_list_to_item(tmp_path):
+    rng = random.Random(2)
+    path = str(tmp_path / "prices.joblib")
+    joblib.dump({item_id: rng.randint(20, 300) for item_id in range(50)}, path)
+    sim = ItemPriceSim(path)
+    items = list(range(40, 60))
+    for other_items in ([], [55, 56], rng.sample(range(60), 15)):
+        expected = [sim.list_to_item(other_items, item) for item in items]
+        assert sim.list_to_items(other_items, items) == pytest.approx(expected)
@@ -0,0 +1,42 @@
+from recsys.data_generator.minhash import MinHashLsh, exact_similar_users, jaccard, top_similar_users
+
+
+def test_same_items_are_candidates():
+    index = MinHashLsh(bands=8, rows=2)
+    for item_id in range(20):
+        index.add("a", item_id)
+        index.add("b", item_id)
+    for item_id in range(100, 120):
+        index.add("c", item_id)
+    assert index.candidates("a") == {"b"}
+    assert index.candidates("c") == set()
+    assert index.candidates("unknown") == set()
+
+
+def test_one_bucket_per_band():
+    index = MinHashLsh(bands=4, rows=3)
+    for n in range(300):
+        index.add("user%d" % (n % 10), n % 37)
+    signature = index.signatures["user0"].copy()
+    index.add("user0", 0)
+    assert (index.signatures["user0"] == signature).all()
+    for buckets in index.buckets:
+        assert sum(len(users) for users in buckets.values()) == 10
+        assert all(users for users in buckets.values())
+
+
+def test_top_similar_users():
+    users_items = {
+        "a": dict.fromkeys([1, 2, 3]),
+        "b": dict.fromkeys([1, 2]),
+        "c": dict.fromkeys([2, 3]),
+        "d": dict.fromkeys([9]),
+    }
+    items_users = {}
+    for user_id, items in users_items.items():
+        for item_id in items:
+            items_users.setdefault(item_id, {})[user_id] = None
+    assert jaccard(users_items["a"], users_items["b"]) == 2 / 3
+    # the ties are ordered by the user id
+    assert exact_similar_users("a", users_items, items_users, 2, "jaccard") == ["b", "c"]
+    assert top_similar_users(["d", "c", "b"], users_items["a"], users_items, 3, "intersection") == ["b", "c"]
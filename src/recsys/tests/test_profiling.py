@@ -0,0 +1,46 @@
+import json
+
+import pytest
+
+from recsys.data_generator.accumulators import AllFilters, UserItemGraph
+from recsys.data_generator.equivalence import compare_outputs, is_equivalent, read_output, run_generator
+from recsys.data_generator.profiling import ProfiledAccumulator
+
+
+def test_profiled_accumulator_forwards_name_and_features():
+    acc = ProfiledAccumulator(AllFilters())
+    assert acc.name == "AllFilters"
+    assert acc.key == "AllFilters(alltime_filters)"
+    assert ProfiledAccumulator(UserItemGraph()).name == "user_item_graph"
+
+
+def test_profile_reports_the_shared_components(synthetic_data, run_dir, tmp_path):
+    profile = str(tmp_path / "profile.json")
+    run_generator(str(synthetic_data / "events_sorted.csv"), str(tmp_path / "out.csv"), 500, None, profile=profile)
+    with open(profile) as inp:
+        report = json.load(inp)
+    components = [entry for entry in report["accumulators"] if entry["component"]]
+    assert {entry["accumulator"] for entry in components} >= {"UserItemGraph()", "UserItemInteractions()"}
+    assert all(entry["update_acc"]["calls"] > 0 for entry in components)
+    assert all(not entry["accumulator"].endswith("()") for entry in report["accumulators"] if not entry["component"])
+
+
+@pytest.mark.parametrize("first_profile, resumed_profile", [(True, False), (False, True)])
+def test_checkpoint_resumes_with_or_without_profile(synthetic_data, run_dir, tmp_path, first_profile, resumed_profile):
+    input = str(synthetic_data / "events_sorted.csv")
+    reference = run_generator(input, str(tmp_path / "reference.csv"), 800, None)
+    save_as = str(tmp_path / "resumed.csv")
+    checkpoint = save_as + ".checkpoint"
+    profile = str(tmp_path / "profile.json")
+    run_generator(input, save_as, 400, None, checkpoint_path=checkpoint, profile=profile if first_profile else None)
+    run_generator(
+        input,
+        save_as,
+        800,
+        None,
+        checkpoint_path=checkpoint,
+        resume_from=checkpoint,
+        profile=profile if resumed_profile else None,
+    )
+    report = compare_outputs(read_output(reference), read_output(save_as))
+    assert is_equivalent(report), report
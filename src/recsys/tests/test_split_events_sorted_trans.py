@@ -0,0 +1,58 @@
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from recsys.data_generator.feature_store import ParquetBatchWriter, read_parquet_frame
+from recsys.split_events_sorted_trans import split_parquet, split_rows
+
+
+@pytest.fixture
+def parquet_output(tmp_path):
+    """
+    A parquet feature output of 200 rows in row groups of 16 rows, the price is an int column
+    until a float arrives and the name has missing values (empty strings, like in the csv)
+    """
+    columns = ["clickout_id", "rank", "is_val", "is_test", "item_id", "price", "name"]
+    rows = [
+        [n // 4, n % 4, int(n % 7 == 0), int(n % 11 == 0), 1000 + n, n * 10 if n < 150 else n + 0.5, "h%d" % n]
+        for n in range(200)
+    ]
+    for row in rows[::3]:
+        row[-1] = None
+    path = str(tmp_path / "events_sorted_trans_all.parquet")
+    writer = ParquetBatchWriter(path, columns, batch_size=16)
+    for row in rows:
+        writer.writerow(row)
+    writer.close()
+    expected = pd.DataFrame(rows, columns=columns)
+    expected["name"] = expected["name"].fillna("")
+    return path, expected
+
+
+def test_split_parquet_round_trip(parquet_output, tmp_path):
+    path, expected = parquet_output
+    output_dir = str(tmp_path / "raw_parquet")
+    split_parquet(path, output_dir)
+    splits = dict(split_rows(expected["is_val"].values, expected["is_test"].values, expected["clickout_id"].values))
+    names = [os.path.basename(fn)[: -len(".parquet")] for fn in glob.glob(os.path.join(output_dir, "*.parquet"))]
+    assert sorted(names) == sorted(splits)
+    for name, rows in splits.items():
+        df = read_parquet_frame(os.path.join(output_dir, name + ".parquet"))
+        pd.testing.assert_frame_equal(df, expected.iloc[rows].reset_index(drop=True), check_dtype=False)
+    assert sum(len(rows) for rows in splits.values()) == len(expected)
+
+
+def test_vectorize_chunks_reads_the_split(parquet_output, tmp_path):
+    from recsys.vectorizers import VectorizeChunks
+
+    path, expected = parquet_output
+    output_dir = str(tmp_path / "raw_parquet")
+    split_parquet(path, output_dir)
+    chunks = VectorizeChunks(None, os.path.join(output_dir, "*.parquet"), str(tmp_path / "vectorized"))
+    df = pd.concat([chunks.read_chunk(fn) for fn in sorted(glob.glob(chunks.input_files))], ignore_index=True)
+    df = df.sort_values(["clickout_id", "rank"]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(df, expected, check_dtype=False)
+    assert df["name"].dtype == np.dtype(object)
@@ -28,6 +28,20 @@ ITEM_STATS_POPULARITY = pathlib.Path().absolute().parents[1] / "data" / "item_so
 
 
 class FeatureEng(BaseEstimator, TransformerMixin):
+    # features of the accumulators transform reads
+    input_features = [
+        "last_event_ts",
+        "actions_tracker",
+        "last_item_clickout",
+        "last_poi_item_clicks",
+        "last_poi_item_impressions",
+        "clickout_user_item_clicks",
+        "clickout_user_item_impressions",
+        "last_item_index",
+        "last_poi",
+        "alltime_filters",
+    ]
+
     def __init__(self):
         pass
 
@@ -1,3 +1,4 @@
+import os
 import sys
 sys.path.append('/Users/josang-yeon/2020/tobigs/tobigs_reco_conf/recsys2019/src')
 
@@ -9,10 +10,27 @@ logger = get_logger()
 if __name__ == "__main__":
     logger = get_logger()
     logger.info("Starting vectorizing")
-    vectorize_chunks = VectorizeChunks(
-        vectorizer=lambda: make_vectorizer_1(),
-        input_files="../../data/proc/raw_csv/*.csv",
-        output_folder="../../data/proc/vectorizer_1/",
-        n_jobs=7
-    )
+    if os.path.exists("../../data/events_sorted_trans_all.json"):
+        # chunks split from the column store
+        vectorize_chunks = VectorizeChunks(
+            vectorizer=lambda: make_vectorizer_1(),
+            input_files="../../data/proc/raw_rows/*.npy",
+            output_folder="../../data/proc/vectorizer_1/",
+            n_jobs=7,
+            feature_store="../../data/events_sorted_trans_all.json",
+        )
+    elif os.path.exists("../../data/events_sorted_trans_all.parquet"):
+        vectorize_chunks = VectorizeChunks(
+            vectorizer=lambda: make_vectorizer_1(),
+            input_files="../../data/proc/raw_parquet/*.parquet",
+            output_folder="../../data/proc/vectorizer_1/",
+            n_jobs=7,
+        )
+    else:
+        vectorize_chunks = VectorizeChunks(
+            vectorizer=lambda: make_vectorizer_1(),
+            input_files="../../data/proc/raw_csv/*.csv",
+            output_folder="../../data/proc/vectorizer_1/",
+            n_jobs=7
+        )
     vectorize_chunks.vectorize_all()
@@ -9,6 +9,13 @@ from joblib import Parallel, delayed
 import sys
 sys.path.append('/Users/josang-yeon/2020/tobigs/tobigs_reco_conf/recsys2019/src')
 
+from recsys.data_generator.feature_store import (
+    FeatureStore,
+    join_clickouts,
+    read_clickouts,
+    read_parquet_frame,
+    table_columns,
+)
 from recsys.transformers import (
     FeatureEng,
     FeaturesAtAbsoluteRank,
@@ -367,18 +374,78 @@ def make_vectorizer_1(
     )
 
 
+def make_vectorizer_1_features(
+    categorical_features=categorical_features_py,
+    numerical_features=numerical_features_py,
+    numerical_features_offset_2=numerical_features_offset_2,
+    numerical_features_for_ranking=numerical_features_for_ranking_py,
+):
+    """
+    Columns read by make_vectorizer_1 called with the same arguments. It can be passed as the requested features
+    to get_accumulators, so only the accumulators the vectorizer needs are calculated.
+    """
+    return sorted(
+        set(categorical_features)
+        | set(numerical_features)
+        | set(numerical_features_offset_2)
+        | set(numerical_features_for_ranking)
+        | set(FeatureEng.input_features)
+        | {"alltime_filters", "last_10_actions", "last_poi", "price_vs_mean_price"}
+    )
+
+
 class VectorizeChunks:
-    def __init__(self, vectorizer, input_files, output_folder, join_only=False, n_jobs=-2):
+    def __init__(
+        self,
+        vectorizer,
+        input_files,
+        output_folder,
+        join_only=False,
+        n_jobs=-2,
+        feature_store=None,
+        columns=None,
+        clickouts=None,
+    ):
+        """
+        With feature_store (path to the manifest of the column store) input_files are .npy files with the row
+        indices of every chunk (see split_events_sorted_trans.py) and only the columns are read from the store.
+        Chunks can also be .parquet files.
+
+        clickouts is the clickout table of the split output (see SplitWriter), then the chunks are parts of
+        the impression table and the clickouts of every chunk are joined to it by clickout_id.
+        """
         self.vectorizer = vectorizer
         self.input_files = input_files
         self.output_folder = output_folder
         self.join_only = join_only
         self.n_jobs = n_jobs
+        self.feature_store = feature_store
+        self.columns = columns
+        self.clickouts = clickouts
+
+    def read_chunk(self, fn):
+        if self.clickouts is None:
+            return self.read_impressions(fn, self.columns)
+        columns = self.columns
+        clickout_columns = None
+        if columns is not None:
+            in_clickouts = set(table_columns(self.clickouts))
+            clickout_columns = [name for name in columns if name in in_clickouts]
+            columns = ["clickout_id"] + [name for name in columns if name not in in_clickouts]
+        df = self.read_impressions(fn, columns)
+        return join_clickouts(df, read_clickouts(self.clickouts, df["clickout_id"], clickout_columns))
+
+    def read_impressions(self, fn, columns):
+        if self.feature_store is not None:
+            return FeatureStore(self.feature_store).read(columns=columns, rows=np.load(fn))
+        if fn.endswith(".parquet"):
+            return read_parquet_frame(fn, columns=columns)
+        return pd.read_csv(fn)
 
     def vectorize_all(self):
         # fit vectorizers using the last chunk (I guess the test distribution is more important than training)
         if not self.join_only:
-            df = pd.read_csv(sorted(glob.glob(self.input_files))[-1])
+            df = self.read_chunk(sorted(glob.glob(self.input_files))[-1])
             self.vectorizer = self.vectorizer()
             self.vectorizer.fit(df)
         filenames = Parallel(n_jobs=self.n_jobs)(
@@ -415,15 +482,16 @@ class VectorizeChunks:
 
     def vectorize_one(self, fn):
         logger.info(f"Vectorize {fn}")
-        fname_h5 = fn.split("/")[-1].replace(".csv", ".h5")
-        fname_npz = fn.split("/")[-1].replace(".csv", ".npz")
+        fname = os.path.splitext(fn.split("/")[-1])[0]
+        fname_h5 = fname + ".h5"
+        fname_npz = fname + ".npz"
         metadata_save_as = os.path.join(self.output_folder, "chunks", fname_h5)
         sparse_matrix_save_as = os.path.join(self.output_folder, "chunks", fname_npz)
 
         if self.join_only or os.path.exists(metadata_save_as):
             return (fname_h5, fname_npz)
 
-        df = pd.read_csv(fn)
+        df = self.read_chunk(fn)
         mat = self.vectorizer.transform(df)
 
         df[